@@ -12,7 +12,19 @@ def reload_module():
         from imp import reload
 
     from . import ui_utils
+    from . import script_tree_dcc
+    from . import script_tree_backup
+    from . import script_tree_merge
+    from . import script_tree_mirror
+    from . import script_tree_settings
     from . import script_tree_utils
+    from . import script_tree_search
+    from . import script_tree_catalog
+    from . import script_tree_fuzzy
+    from . import script_tree_models
+    from . import script_tree_watcher
+    from . import script_tree_runner
+    from . import script_tree_telemetry
 
     if os.path.basename(sys.executable) == "maya.exe":
         from . import script_tree_dcc_maya as dcc_actions
@@ -26,7 +38,24 @@ def reload_module():
         shortcut.setEnabled(0)
         del shortcut
 
+    # finish the queued backups, the reloaded module starts its own writer
+    script_tree_utils.backup_writer.stop()
+    script_tree_settings.flush_all()
+    script_tree_utils.script_mirror.flush()
+
     reload(ui_utils)
-    reload(script_tree_utils)
+    reload(script_tree_dcc)
+    reload(script_tree_merge)
     reload(dcc_actions)
+    reload(script_tree_backup)
+    reload(script_tree_mirror)
+    reload(script_tree_settings)
+    reload(script_tree_utils)
+    reload(script_tree_search)
+    reload(script_tree_catalog)
+    reload(script_tree_fuzzy)
+    reload(script_tree_models)
+    reload(script_tree_watcher)
+    reload(script_tree_runner)
+    reload(script_tree_telemetry)
     reload(script_tree_ui)
@@ -0,0 +1,953 @@
+import collections
+import datetime
+import errno
+import difflib
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+BackupVersion = collections.namedtuple("BackupVersion", ["time", "hash", "size"])
+BackupJob = collections.namedtuple("BackupJob", ["script_path", "content", "time"])
+RetentionPolicy = collections.namedtuple("RetentionPolicy", ["keep_all_days", "keep_daily_days"])
+RetentionResult = collections.namedtuple("RetentionResult", ["removed_count", "archived_count", "reclaimed_bytes"])
+TreeSnapshotResult = collections.namedtuple("TreeSnapshotResult", ["snapshot_path", "copied_count", "linked_count",
+                                                                   "failed_count", "copied_bytes"])
+
+BLOB_FOLDER_NAME = "_blobs"
+BLOB_EXTENSION = ".z"
+COMPRESSION_LEVEL = 6
+
+TREE_SNAPSHOT_PREFIX = "ScriptTree_BACKUP_"
+TREE_SNAPSHOT_PARTIAL_NAME = "ScriptTree_BACKUP.partial"
+TREE_SNAPSHOT_MANIFEST_NAME = ".script_tree_snapshot.json"
+TREE_SNAPSHOT_ARCHIVE_EXTENSION = ".zip"
+
+LEGACY_BACKUP_TAG = "_BACKUP_"
+BLOB_MIN_COLLECT_AGE = 3600  # blobs younger than this might belong to a manifest that another session is writing
+BLOB_LOCK_NAME = ".lock"
+BLOB_LOCK_TIMEOUT = 30.0
+BLOB_LOCK_STALE_AGE = 120.0  # a lock file not refreshed for this long was left behind by a session that crashed
+BLOB_LOCK_REFRESH_INTERVAL = 10.0
+
+
+def get_content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+def write_file_atomic(file_path, data):
+    """
+    Write to a temp file next to file_path first, so a crash never leaves a half written file behind
+    """
+    folder_path = os.path.dirname(file_path)
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+
+    temp_path = file_path + ".tmp"
+    with io.open(temp_path, "wb") as fp:
+        fp.write(data)
+    replace_file(temp_path, file_path)
+
+
+def replace_file(source_path, target_path):
+    """
+    Move source_path over target_path in one step, readers see either the old or the new file
+    """
+    if hasattr(os, "replace"):
+        os.replace(source_path, target_path)
+        return
+
+    # python 2 has no atomic overwrite on windows, there's a short window without target_path
+    if os.path.exists(target_path) and os.name == "nt":
+        os.remove(target_path)
+    os.rename(source_path, target_path)
+
+
+class FileLock(object):
+    """
+    Lock shared by every process using lock_path, held while the lock file exists.
+
+    The lock file names the host and process holding it, and its mtime is refreshed every refresh_interval seconds
+    while it's held. Only a lock file that hasn't been refreshed for stale_age seconds is taken over,
+    a long retention pass on a slow share keeps its lock.
+    """
+
+    def __init__(self, lock_path, timeout=BLOB_LOCK_TIMEOUT, stale_age=BLOB_LOCK_STALE_AGE,
+                 refresh_interval=BLOB_LOCK_REFRESH_INTERVAL):
+        self.lock_path = lock_path
+        self.timeout = timeout
+        self.stale_age = stale_age
+        self.refresh_interval = refresh_interval
+
+        self._release_event = threading.Event()
+        self._refresh_thread = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        """
+        :raise OSError: if the lock couldn't be taken within timeout seconds
+        """
+        folder_path = os.path.dirname(self.lock_path)
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+
+        owner = "{} {}".format(socket.gethostname(), os.getpid())
+        end_time = time.time() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                try:
+                    os.write(fd, owner.encode("utf-8"))
+                finally:
+                    os.close(fd)
+                break
+
+            if self._remove_if_stale():
+                continue
+            if time.time() > end_time:
+                raise OSError(errno.ETIMEDOUT, "Timed out waiting for lock", self.lock_path)
+            time.sleep(0.05)
+
+        self._release_event.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh, name="ScriptTreeLockRefresh")
+        self._refresh_thread.daemon = True
+        self._refresh_thread.start()
+
+    def release(self):
+        self._release_event.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+            self._refresh_thread = None
+
+        try:
+            os.remove(self.lock_path)
+        except OSError as e:
+            logging.warning("Failed to release lock {}: {}".format(self.lock_path, e))
+
+    def _refresh(self):
+        while not self._release_event.wait(self.refresh_interval):
+            try:
+                os.utime(self.lock_path, None)
+            except OSError as e:
+                logging.warning("Failed to refresh lock {}: {}".format(self.lock_path, e))
+
+    def _remove_if_stale(self):
+        try:
+            lock_age = time.time() - os.path.getmtime(self.lock_path)
+            if lock_age <= self.stale_age:
+                return False
+
+            with io.open(self.lock_path, "rb") as fp:
+                owner = fp.read().decode("utf-8", "replace")
+            logging.warning("Removing lock {} of {}, it hasn't been refreshed for {:.0f}s".format(
+                self.lock_path, owner or "an unknown process", lock_age))
+            os.remove(self.lock_path)
+            return True
+        except (IOError, OSError):
+            return False  # released in the meantime
+
+
+def format_size(byte_count):
+    for unit in ("B", "KB", "MB"):
+        if abs(byte_count) < 1024:
+            return "{:.0f}{}".format(byte_count, unit)
+        byte_count /= 1024.0
+    return "{:.1f}GB".format(byte_count)
+
+
+def get_versions_to_keep(version_times, policy, now=None):
+    """
+    Thin out backup times: keep everything younger than keep_all_days,
+    the newest per day up to keep_daily_days, and the newest per month after that.
+    The newest time is always kept.
+
+    :param version_times: list of epoch times
+    :param policy: RetentionPolicy
+    :param now: epoch time to count ages from
+    :return: set of indices into version_times
+    """
+    if not version_times:
+        return set()
+    now = time.time() if now is None else now
+
+    kept_indices = set()
+    kept_buckets = {}
+    for index in sorted(range(len(version_times)), key=lambda i: version_times[i], reverse=True):
+        version_time = version_times[index]
+        age_days = (now - version_time) / 86400.0
+        if age_days < policy.keep_all_days:
+            kept_indices.add(index)
+            continue
+
+        date = datetime.datetime.fromtimestamp(version_time)
+        if age_days < policy.keep_daily_days:
+            bucket = ("day", date.year, date.month, date.day)
+        else:
+            bucket = ("month", date.year, date.month)
+
+        # newest first, so the first version seen in a bucket is the one to keep
+        if bucket not in kept_buckets:
+            kept_buckets[bucket] = index
+            kept_indices.add(index)
+
+    kept_indices.add(max(range(len(version_times)), key=lambda i: version_times[i]))
+    return kept_indices
+
+
+def get_unified_diff(old_lines, new_lines, old_name="", new_name="", context=3):
+    """
+    Same output as difflib.unified_diff without line endings,
+    but the unchanged lines at the start and end are skipped before diffing,
+    most versions of a long script only differ in a few places.
+
+    :return: list of diff lines
+    """
+    line_count = min(len(old_lines), len(new_lines))
+    start = 0
+    while start < line_count and old_lines[start] == new_lines[start]:
+        start += 1
+    end = 0
+    while end < line_count - start and old_lines[-1 - end] == new_lines[-1 - end]:
+        end += 1
+
+    start = max(0, start - context)
+    end = max(0, end - context)
+    matcher = difflib.SequenceMatcher(None, old_lines[start:len(old_lines) - end],
+                                      new_lines[start:len(new_lines) - end], autojunk=False)
+
+    diff_lines = []
+    for group in matcher.get_grouped_opcodes(context):
+        if not diff_lines:
+            diff_lines.append("--- {}".format(old_name))
+            diff_lines.append("+++ {}".format(new_name))
+
+        old_range = _format_diff_range(group[0][1] + start, group[-1][2] + start)
+        new_range = _format_diff_range(group[0][3] + start, group[-1][4] + start)
+        diff_lines.append("@@ -{} +{} @@".format(old_range, new_range))
+
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                diff_lines.extend(" " + line for line in old_lines[start + i1:start + i2])
+                continue
+            if tag in ("replace", "delete"):
+                diff_lines.extend("-" + line for line in old_lines[start + i1:start + i2])
+            if tag in ("replace", "insert"):
+                diff_lines.extend("+" + line for line in new_lines[start + j1:start + j2])
+    return diff_lines
+
+
+def _format_diff_range(start, stop):
+    length = stop - start
+    first_line = start + 1
+    if length == 1:
+        return str(first_line)
+    if not length:
+        first_line -= 1
+    return "{},{}".format(first_line, length)
+
+
+def get_unique_file_size(file_path):
+    """
+    Bytes freed by removing file_path, hardlinked files only free their space with their last link
+    """
+    try:
+        stat_result = os.stat(file_path)
+    except OSError:
+        return 0
+    return stat_result.st_size if stat_result.st_nlink <= 1 else 0
+
+
+def get_unique_folder_size(folder_path):
+    return sum(get_unique_file_size(os.path.join(dir_path, file_name))
+               for dir_path, dir_names, file_names in os.walk(folder_path)
+               for file_name in file_names)
+
+
+class BackupStore(object):
+    """
+    Content addressed script backups.
+
+    Each unique file content is stored once as a zlib compressed blob named by its sha1,
+    and each script has a manifest listing its versions (time, hash, size) oldest first.
+    Backing up content that matches the latest version writes nothing.
+    """
+
+    def __init__(self, backup_folder):
+        self.backup_folder = backup_folder
+        self.blob_folder = os.path.join(backup_folder, BLOB_FOLDER_NAME)
+        self.lock = threading.RLock()  # guards manifests and blobs against the writer thread while pruning
+        self.blob_lock_path = os.path.join(self.blob_folder, BLOB_LOCK_NAME)  # same, against other sessions
+
+    def get_script_folder(self, script_path):
+        file_name, file_extension = os.path.splitext(os.path.basename(script_path))
+        return os.path.join(self.backup_folder, file_name)
+
+    def get_manifest_path(self, script_path):
+        # scripts with the same name in different folders share a backup folder, the path hash keeps them apart
+        normalized_path = os.path.normcase(script_path.replace("\\", "/"))
+        path_hash = hashlib.md5(normalized_path.encode("utf-8")).hexdigest()[:10]
+        return os.path.join(self.get_script_folder(script_path), "versions_{}.json".format(path_hash))
+
+    def get_blob_path(self, content_hash):
+        return os.path.join(self.blob_folder, content_hash[:2], content_hash + BLOB_EXTENSION)
+
+    def load_versions(self, script_path):
+        """
+        :return: list of BackupVersion, oldest first
+        """
+        return self._load_manifest(self.get_manifest_path(script_path)).get("versions", [])
+
+    def save_versions(self, script_path, versions):
+        self._save_manifest(self.get_manifest_path(script_path), script_path, versions)
+
+    @staticmethod
+    def _load_manifest(manifest_path):
+        if not os.path.exists(manifest_path):
+            return {}
+
+        try:
+            with io.open(manifest_path, "r", encoding="utf-8") as fp:
+                manifest = json.load(fp)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning("Failed to read backup manifest {}: {}".format(manifest_path, e))
+            return {}
+
+        manifest["versions"] = [BackupVersion(*version) for version in manifest.get("versions", [])]
+        return manifest
+
+    @staticmethod
+    def _save_manifest(manifest_path, script_path, versions):
+        manifest = {
+            "script_path": script_path,
+            "versions": [list(version) for version in versions],
+        }
+        write_file_atomic(manifest_path, json.dumps(manifest).encode("utf-8"))
+
+    def get_manifest_paths(self):
+        if not os.path.isdir(self.backup_folder):
+            return []
+
+        manifest_paths = []
+        for folder_name in os.listdir(self.backup_folder):
+            folder_path = os.path.join(self.backup_folder, folder_name)
+            if folder_name == BLOB_FOLDER_NAME or not os.path.isdir(folder_path):
+                continue
+            for file_name in os.listdir(folder_path):
+                if file_name.startswith("versions_") and file_name.endswith(".json"):
+                    manifest_paths.append(os.path.join(folder_path, file_name))
+        return manifest_paths
+
+    def backup_file(self, script_path):
+        """
+        :return: the new BackupVersion, or None if the content hasn't changed since the latest backup
+        """
+        with io.open(script_path, "rb") as fp:
+            content = fp.read()
+        return self.backup_content(script_path, content)
+
+    def backup_content(self, script_path, content, backup_time=None):
+        new_versions = self.backup_contents(script_path, [(backup_time or time.time(), content)])
+        return new_versions[0] if new_versions else None
+
+    def backup_contents(self, script_path, contents):
+        """
+        Back up several versions of one script with a single manifest read and write
+
+        :param script_path:
+        :param contents: list of (backup_time, content bytes), oldest first
+        :return: list of the new BackupVersions
+        """
+        with self.lock, FileLock(self.blob_lock_path):
+            return self._backup_contents(script_path, contents)
+
+    def _backup_contents(self, script_path, contents):
+        versions = self.load_versions(script_path)
+
+        new_versions = []
+        for backup_time, content in contents:
+            content_hash = get_content_hash(content)
+            if versions and versions[-1].hash == content_hash:
+                continue
+
+            blob_path = self.get_blob_path(content_hash)
+            if os.path.exists(blob_path):
+                os.utime(blob_path, None)  # referenced again, keeps the blob collector away from it
+            else:
+                write_file_atomic(blob_path, zlib.compress(content, COMPRESSION_LEVEL))
+
+            version = BackupVersion(backup_time, content_hash, len(content))
+            versions.append(version)
+            new_versions.append(version)
+
+        if new_versions:
+            self.save_versions(script_path, versions)
+        return new_versions
+
+    def read_content(self, content_hash):
+        with io.open(self.get_blob_path(content_hash), "rb") as fp:
+            return zlib.decompress(fp.read())
+
+    def restore_version(self, script_path, content_hash):
+        """
+        Overwrite script_path with a backed up version, the current content is backed up first
+        """
+        content = self.read_content(content_hash)
+        if os.path.exists(script_path):
+            self.backup_file(script_path)
+        write_file_atomic(script_path, content)
+        self.backup_content(script_path, content)
+
+    def apply_retention(self, policy, now=None, remove_legacy_backups=False):
+        """
+        Thin out the versions of every script according to policy and remove the blobs nothing refers to anymore.
+
+        :param policy: RetentionPolicy
+        :param now: epoch time to count ages from
+        :param remove_legacy_backups: thin out old style <name>_BACKUP_<time> copies by the same policy too
+        :return: RetentionResult
+        """
+        removed_count = 0
+        reclaimed_bytes = 0
+
+        with self.lock:
+            for manifest_path in self.get_manifest_paths():
+                if not self._thin_versions(manifest_path, policy, now):
+                    continue
+
+                # other sessions append versions under the shared lock, read the manifest again while holding it
+                with FileLock(self.blob_lock_path):
+                    removed_count += self._thin_versions(manifest_path, policy, now, save=True)
+
+            referenced_hashes = set()
+            for manifest_path in self.get_manifest_paths():
+                referenced_hashes.update(version.hash for version in self._load_manifest(manifest_path)["versions"])
+
+            reclaimed_bytes += self._remove_unreferenced_blobs(referenced_hashes, now)
+
+        if not remove_legacy_backups:
+            return RetentionResult(removed_count, 0, reclaimed_bytes)
+
+        legacy_removed_count, legacy_reclaimed_bytes = self._apply_legacy_retention(policy, now)
+        return RetentionResult(removed_count + legacy_removed_count, 0, reclaimed_bytes + legacy_reclaimed_bytes)
+
+    def _thin_versions(self, manifest_path, policy, now=None, save=False):
+        """
+        :return: number of versions of the manifest that policy removes, they're only removed if save is set
+        """
+        manifest = self._load_manifest(manifest_path)
+        versions = manifest.get("versions", [])
+        kept_indices = get_versions_to_keep([version.time for version in versions], policy, now)
+        if save and len(kept_indices) < len(versions):
+            kept_versions = [version for index, version in enumerate(versions) if index in kept_indices]
+            self._save_manifest(manifest_path, manifest.get("script_path", ""), kept_versions)
+        return len(versions) - len(kept_indices)
+
+    def _remove_unreferenced_blobs(self, referenced_hashes, now=None):
+        if not os.path.isdir(self.blob_folder):
+            return 0
+        now = time.time() if now is None else now
+
+        unreferenced_paths = []
+        for dir_path, dir_names, file_names in os.walk(self.blob_folder):
+            for file_name in file_names:
+                content_hash, extension = os.path.splitext(file_name)
+                if extension == BLOB_EXTENSION and content_hash not in referenced_hashes:
+                    unreferenced_paths.append(os.path.join(dir_path, file_name))
+        if not unreferenced_paths:
+            return 0
+
+        reclaimed_bytes = 0
+        # another session touches a blob when it reuses it, so the ages are checked under the shared lock
+        with FileLock(self.blob_lock_path):
+            for blob_path in unreferenced_paths:
+                try:
+                    stat_result = os.stat(blob_path)
+                    if now - stat_result.st_mtime < BLOB_MIN_COLLECT_AGE:
+                        continue
+                    os.remove(blob_path)
+                    reclaimed_bytes += stat_result.st_size
+                except OSError as e:
+                    logging.warning("Failed to remove backup blob {}: {}".format(blob_path, e))
+        return reclaimed_bytes
+
+    def _apply_legacy_retention(self, policy, now=None):
+        if not os.path.isdir(self.backup_folder):
+            return 0, 0
+
+        removed_count = 0
+        reclaimed_bytes = 0
+        for folder_name in os.listdir(self.backup_folder):
+            folder_path = os.path.join(self.backup_folder, folder_name)
+            if folder_name == BLOB_FOLDER_NAME or not os.path.isdir(folder_path):
+                continue
+
+            backups_per_script = collections.defaultdict(list)  # file name without the backup time: [(time, path)]
+            for file_name in os.listdir(folder_path):
+                base_name, extension = os.path.splitext(file_name)
+                script_name, tag, backup_time = base_name.rpartition(LEGACY_BACKUP_TAG)
+                if not tag or not backup_time.isdigit():
+                    continue
+                backups_per_script[script_name + extension].append((int(backup_time),
+                                                                    os.path.join(folder_path, file_name)))
+
+            for backups in backups_per_script.values():
+                kept_indices = get_versions_to_keep([backup[0] for backup in backups], policy, now)
+                for index, (_, backup_path) in enumerate(backups):
+                    if index in kept_indices:
+                        continue
+                    file_size = get_unique_file_size(backup_path)
+                    try:
+                        os.remove(backup_path)
+                    except OSError as e:
+                        logging.warning("Failed to remove backup {}: {}".format(backup_path, e))
+                        continue
+                    removed_count += 1
+                    reclaimed_bytes += file_size
+
+        return removed_count, reclaimed_bytes
+
+
+class BackupWriter(object):
+    """
+    Writes backups to a BackupStore on a background thread, so a slow backup folder never blocks a save.
+
+    Queued backups are grouped per script into batches, failed batches are retried with an increasing delay.
+    The queue is bounded, submit returns False instead of blocking when it's full.
+    """
+
+    def __init__(self, store, max_queue_size=256, batch_size=32, max_retries=5, retry_delay=2.0):
+        self.store = store
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self.queue = queue.Queue(max_queue_size)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def submit(self, script_path, content=None):
+        """
+        :param script_path:
+        :param content: bytes to back up, None reads script_path on the writer thread
+        :return: False if the backup couldn't be queued
+        """
+        if self._stop_event.is_set():
+            return False
+
+        self._start_thread()
+        try:
+            self.queue.put_nowait(BackupJob(script_path, content, time.time()))
+        except queue.Full:
+            return False
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued backup has been written
+
+        :return: False if the timeout ran out first
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                if self._thread is None or not self._thread.is_alive():
+                    return False
+                remaining_time = None if end_time is None else end_time - time.time()
+                if remaining_time is not None and remaining_time <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining_time)
+        return True
+
+    def stop(self, timeout=10.0):
+        """
+        Flush the queue and stop the writer thread, further submits are refused
+        """
+        flushed = self.flush(timeout)
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if not flushed:
+            logging.warning("ScriptTree backups still queued at shutdown: {}".format(self.queue.qsize()))
+        return flushed
+
+    def _start_thread(self):
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="ScriptTreeBackupWriter")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                jobs = [self.queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._write_jobs(jobs)
+            finally:
+                for _ in jobs:
+                    self.queue.task_done()
+
+    def _write_jobs(self, jobs):
+        jobs_per_script = collections.OrderedDict()
+        for job in jobs:
+            jobs_per_script.setdefault(job.script_path, []).append(job)
+
+        for script_path, script_jobs in jobs_per_script.items():
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self._write_script_jobs(script_path, script_jobs)
+                    break
+                except (IOError, OSError) as e:
+                    if attempt == self.max_retries:
+                        logging.error("Failed to back up {}: {}".format(script_path, e))
+                        break
+                    logging.warning("Backup of {} failed, retrying: {}".format(script_path, e))
+                    time.sleep(self.retry_delay * (attempt + 1))
+
+    def _write_script_jobs(self, script_path, script_jobs):
+        contents = []
+        for job in script_jobs:
+            content = job.content
+            if content is None:
+                if not os.path.exists(script_path):
+                    continue
+                with io.open(script_path, "rb") as fp:
+                    content = fp.read()
+            contents.append((job.time, content))
+
+        if contents:
+            self.store.backup_contents(script_path, contents)
+
+
+class VersionDiffer(object):
+    """
+    Diffs between versions in a BackupStore, by content hash.
+
+    The lines of recently used versions and the resulting diffs are cached,
+    so stepping back and forth through the history doesn't decompress or diff anything twice.
+    Safe to use from worker threads.
+    """
+
+    def __init__(self, store, max_cached_contents=32, max_cached_diffs=64):
+        self.store = store
+        self.max_cached_contents = max_cached_contents
+        self.max_cached_diffs = max_cached_diffs
+        self._content_cache = collections.OrderedDict()  # content_hash: list of lines
+        self._diff_cache = collections.OrderedDict()  # (old_hash, new_hash, context): list of diff lines
+        self._lock = threading.Lock()
+
+    def get_lines(self, content_hash):
+        with self._lock:
+            lines = self._content_cache.pop(content_hash, None)
+        if lines is None:
+            lines = self.store.read_content(content_hash).decode("utf-8", "replace").splitlines()
+        self._cache_lines(content_hash, lines)
+        return lines
+
+    def get_file_hash(self, file_path):
+        """
+        Read a file that might not be backed up, so it can be diffed against versions by its hash
+        """
+        with io.open(file_path, "rb") as fp:
+            content = fp.read()
+        content_hash = get_content_hash(content)
+        self._cache_lines(content_hash, content.decode("utf-8", "replace").splitlines())
+        return content_hash
+
+    def _cache_lines(self, content_hash, lines):
+        with self._lock:
+            self._content_cache[content_hash] = lines
+            while len(self._content_cache) > self.max_cached_contents:
+                self._content_cache.popitem(last=False)
+
+    def get_diff(self, old_hash, new_hash, old_name="", new_name="", context=3):
+        """
+        :return: list of unified diff lines, empty if both versions are the same
+        """
+        if old_hash == new_hash:
+            return []
+
+        key = (old_hash, new_hash, context)
+        with self._lock:
+            diff_lines = self._diff_cache.pop(key, None)
+        if diff_lines is None:
+            diff_lines = get_unified_diff(self.get_lines(old_hash), self.get_lines(new_hash),
+                                          old_name, new_name, context)
+
+        with self._lock:
+            self._diff_cache[key] = diff_lines
+            while len(self._diff_cache) > self.max_cached_diffs:
+                self._diff_cache.popitem(last=False)
+        return diff_lines
+
+
+def walk_files(root_folder):
+    """
+    :return: dict of rel_path: (size, mtime) of every file under root_folder
+    """
+    file_states = {}
+    for folder_path, folder_names, file_names in os.walk(root_folder):
+        rel_folder = os.path.relpath(folder_path, root_folder).replace("\\", "/")
+        for file_name in file_names:
+            rel_path = file_name if rel_folder == "." else rel_folder + "/" + file_name
+            try:
+                stat_result = os.stat(os.path.join(folder_path, file_name))
+            except OSError:
+                continue
+            file_states[rel_path] = (stat_result.st_size, stat_result.st_mtime)
+    return file_states
+
+
+def _copy_file(paths):
+    source_path, target_path = paths
+    try:
+        shutil.copy2(source_path, target_path)
+        return source_path, None
+    except (IOError, OSError) as e:
+        return source_path, e
+
+
+class TreeSnapshotter(object):
+    """
+    Incremental snapshots of a script folder.
+
+    Files with the same size and modified time as in the previous snapshot are hardlinked to it,
+    so they cost no copy and no extra disk space, the rest is copied on a thread pool.
+    A snapshot is built in a partial folder and only renamed once complete,
+    an interrupted snapshot is resumed by the next one.
+    apply_retention thins out old snapshots and compacts the ones past the newest keep_count into zip archives.
+    """
+
+    def __init__(self, backup_folder, keep_count=20, thread_count=8):
+        self.backup_folder = backup_folder
+        self.keep_count = keep_count
+        self.thread_count = thread_count
+
+    def get_snapshots(self, include_archives=False):
+        """
+        :param include_archives: include the snapshots that have been compacted into zip archives
+        :return: paths of the complete snapshots, oldest first
+        """
+        return [snapshot_path for _, snapshot_path in self._get_snapshot_times(include_archives)]
+
+    def _get_snapshot_times(self, include_archives=False):
+        if not os.path.isdir(self.backup_folder):
+            return []
+
+        snapshots = []
+        for file_name in os.listdir(self.backup_folder):
+            if not file_name.startswith(TREE_SNAPSHOT_PREFIX):
+                continue
+
+            snapshot_path = os.path.join(self.backup_folder, file_name)
+            snapshot_name, extension = os.path.splitext(file_name)
+            if extension == TREE_SNAPSHOT_ARCHIVE_EXTENSION:
+                if not include_archives:
+                    continue
+            elif not os.path.isdir(snapshot_path):
+                continue
+            else:
+                snapshot_name = file_name
+
+            try:
+                snapshot_time = int(snapshot_name[len(TREE_SNAPSHOT_PREFIX):])
+            except ValueError:
+                continue
+            snapshots.append((snapshot_time, snapshot_path))
+        return sorted(snapshots)
+
+    @staticmethod
+    def load_manifest(snapshot_path):
+        """
+        :return: dict of rel_path: (size, mtime) of the source files when the snapshot was made
+        """
+        manifest_path = os.path.join(snapshot_path, TREE_SNAPSHOT_MANIFEST_NAME)
+        try:
+            with io.open(manifest_path, "r", encoding="utf-8") as fp:
+                return dict((rel_path, tuple(state)) for rel_path, state in json.load(fp).items())
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def create_snapshot(self, source_folder, progress_callback=None):
+        """
+        :param source_folder:
+        :param progress_callback: called with (done_count, total_count) while files are copied
+        :return: TreeSnapshotResult
+        """
+        source_states = walk_files(source_folder)
+        total_count = len(source_states)
+
+        previous_snapshots = self.get_snapshots()
+        previous_path = previous_snapshots[-1] if previous_snapshots else None
+        previous_states = self.load_manifest(previous_path) if previous_path else {}
+
+        partial_path = os.path.join(self.backup_folder, TREE_SNAPSHOT_PARTIAL_NAME)
+        partial_states = walk_files(partial_path) if os.path.isdir(partial_path) else {}
+        for rel_path in partial_states:
+            if rel_path not in source_states:
+                os.remove(os.path.join(partial_path, rel_path))
+
+        done_count = 0
+        linked_count = 0
+        copy_jobs = []
+        for rel_path, (size, mtime) in sorted(source_states.items()):
+            target_path = os.path.join(partial_path, rel_path)
+
+            # copy2 keeps the modified time, so files from an interrupted snapshot can be compared to the source
+            if partial_states.get(rel_path) == (size, mtime):
+                done_count += 1
+                continue
+
+            target_folder = os.path.dirname(target_path)
+            if not os.path.exists(target_folder):
+                os.makedirs(target_folder)
+            if os.path.exists(target_path):
+                os.remove(target_path)
+
+            if previous_states.get(rel_path) == (size, mtime) and self._link_file(previous_path, rel_path, target_path):
+                linked_count += 1
+                done_count += 1
+                continue
+
+            copy_jobs.append((os.path.join(source_folder, rel_path), target_path))
+
+        if progress_callback:
+            progress_callback(done_count, total_count)
+
+        failed_count = 0
+        copied_bytes = 0
+        if copy_jobs:
+            pool = ThreadPool(min(self.thread_count, len(copy_jobs)))
+            try:
+                for source_path, error in pool.imap_unordered(_copy_file, copy_jobs):
+                    done_count += 1
+                    if error is None:
+                        copied_bytes += os.path.getsize(source_path)
+                    else:
+                        failed_count += 1
+                        logging.warning("Failed to back up {}: {}".format(source_path, error))
+                    if progress_callback:
+                        progress_callback(done_count, total_count)
+            finally:
+                pool.close()
+                pool.join()
+
+        if failed_count:
+            # keep the partial folder, the next snapshot picks up where this one stopped
+            return TreeSnapshotResult(None, len(copy_jobs) - failed_count, linked_count, failed_count, copied_bytes)
+
+        if not os.path.exists(partial_path):
+            os.makedirs(partial_path)
+        manifest_data = json.dumps(dict((rel_path, list(state)) for rel_path, state in source_states.items()))
+        write_file_atomic(os.path.join(partial_path, TREE_SNAPSHOT_MANIFEST_NAME), manifest_data.encode("utf-8"))
+
+        snapshot_time = int(time.time())
+        if previous_snapshots:
+            snapshot_time = max(snapshot_time, int(os.path.basename(previous_path)[len(TREE_SNAPSHOT_PREFIX):]) + 1)
+        snapshot_path = os.path.join(self.backup_folder, TREE_SNAPSHOT_PREFIX + str(snapshot_time))
+        os.rename(partial_path, snapshot_path)
+
+        return TreeSnapshotResult(snapshot_path, len(copy_jobs), linked_count, 0, copied_bytes)
+
+    @staticmethod
+    def _link_file(previous_path, rel_path, target_path):
+        if not hasattr(os, "link"):  # python 2 on windows
+            return False
+        try:
+            os.link(os.path.join(previous_path, rel_path), target_path)
+            return True
+        except OSError:
+            return False  # missing from the previous snapshot, or the file system doesn't support hardlinks
+
+    def apply_retention(self, policy, now=None):
+        """
+        Remove the snapshots that policy doesn't keep, then compact every snapshot folder
+        past the newest keep_count into a zip archive. The newest snapshot is never compacted,
+        the next snapshot hardlinks to it.
+
+        :return: RetentionResult
+        """
+        snapshots = self._get_snapshot_times(include_archives=True)
+        kept_indices = get_versions_to_keep([snapshot[0] for snapshot in snapshots], policy, now)
+
+        removed_count = 0
+        reclaimed_bytes = 0
+        kept_snapshots = []
+        for index, (_, snapshot_path) in enumerate(snapshots):
+            if index in kept_indices:
+                kept_snapshots.append(snapshot_path)
+                continue
+
+            if os.path.isdir(snapshot_path):
+                reclaimed_bytes += get_unique_folder_size(snapshot_path)
+                shutil.rmtree(snapshot_path, ignore_errors=True)
+            else:
+                reclaimed_bytes += get_unique_file_size(snapshot_path)
+                os.remove(snapshot_path)
+            removed_count += 1
+
+        snapshot_folders = [snapshot_path for snapshot_path in kept_snapshots if os.path.isdir(snapshot_path)]
+        archived_count = 0
+        for snapshot_path in snapshot_folders[:max(0, len(snapshot_folders) - max(self.keep_count, 1))]:
+            try:
+                reclaimed_bytes += self.compact_snapshot(snapshot_path)
+                archived_count += 1
+            except (IOError, OSError, zipfile.BadZipfile) as e:
+                logging.warning("Failed to compact tree backup {}: {}".format(snapshot_path, e))
+
+        return RetentionResult(removed_count, archived_count, reclaimed_bytes)
+
+    @staticmethod
+    def compact_snapshot(snapshot_path):
+        """
+        Replace a snapshot folder by a zip archive of it
+
+        :return: bytes reclaimed
+        """
+        archive_path = snapshot_path + TREE_SNAPSHOT_ARCHIVE_EXTENSION
+        temp_path = archive_path + ".tmp"
+        with zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for dir_path, dir_names, file_names in os.walk(snapshot_path):
+                for file_name in file_names:
+                    file_path = os.path.join(dir_path, file_name)
+                    archive.write(file_path, os.path.relpath(file_path, snapshot_path))
+
+        replace_file(temp_path, archive_path)
+
+        freed_bytes = get_unique_folder_size(snapshot_path)
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        return freed_bytes - os.path.getsize(archive_path)
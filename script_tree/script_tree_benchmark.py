@@ -0,0 +1,76 @@
+"""
+Import time of the ScriptTree modules, every import is measured in a fresh interpreter so nothing is cached.
+
+Run it with the interpreter of the dcc, for Maya:
+    mayapy -m script_tree.script_tree_benchmark
+
+pymel.core is in the default list as a reference, the dcc module used to import it at startup.
+"""
+import os
+import subprocess
+import sys
+
+from .script_tree_search import get_pool_executable
+
+DEFAULT_MODULES = [
+    "script_tree",
+    "script_tree.script_tree_utils",
+    "script_tree.script_tree_ui",
+    "script_tree.script_tree_dcc_maya",
+    "pymel.core",
+]
+
+MEASURE_SCRIPT = "\n".join([
+    "import sys, time",
+    "sys.path.insert(0, {package_parent!r})",
+    "start_time = time.time()",
+    "import {module_name}",
+    "sys.stdout.write(repr(time.time() - start_time))",
+])
+
+
+def measure_import_time(module_name, executable=None, repeat=5):
+    """
+    :param module_name:
+    :param executable: python interpreter to measure with, defaults to this one (mayapy inside Maya)
+    :param repeat: number of fresh interpreters to measure in
+    :return: list of seconds, empty if the import failed
+    """
+    executable = executable or get_pool_executable() or sys.executable
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = MEASURE_SCRIPT.format(package_parent=package_parent, module_name=module_name)
+
+    import_times = []
+    for _ in range(repeat):
+        process = subprocess.Popen([executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            return []
+        import_times.append(float(stdout.decode("utf-8").strip().splitlines()[-1]))
+    return import_times
+
+
+def main(module_names=None, repeat=5, executable=None):
+    """
+    Print the best and median import time of every module
+
+    :return: dict of module_name: list of seconds
+    """
+    results = {}
+    name_width = max(len(module_name) for module_name in module_names or DEFAULT_MODULES)
+    for module_name in module_names or DEFAULT_MODULES:
+        import_times = sorted(measure_import_time(module_name, executable=executable, repeat=repeat))
+        results[module_name] = import_times
+
+        if import_times:
+            line = "{:.1f}ms best  {:.1f}ms median".format(import_times[0] * 1000,
+                                                            import_times[len(import_times) // 2] * 1000)
+        else:
+            line = "import failed"
+        print("{}  {}".format(module_name.ljust(name_width), line))
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
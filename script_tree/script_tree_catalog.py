@@ -0,0 +1,616 @@
+import array
+import collections
+import hashlib
+import io
+import logging
+import os
+import pickle
+
+from .script_tree_backup import get_content_hash, replace_file
+from .script_tree_search import SCRIPT_EXTENSIONS
+
+try:
+    from os import scandir
+except ImportError:  # python 2
+    scandir = None
+
+
+# entries: name: (is_dir, mtime, size), new_folders: name: ScriptCatalog of the sub folders that weren't known yet,
+# content_hashes: name: hash of the new and changed scripts, only when they were hashed
+FolderListing = collections.namedtuple("FolderListing", ["entries", "new_folders", "content_hashes"])
+
+
+def list_directory(folder_path):
+    """
+    Get (name, is_dir, mtime, size) of everything in folder_path.
+
+    scandir gets the file stats from the directory listing itself on Windows,
+    which saves a round trip per file on network drives.
+    """
+    entries = []
+    if scandir:
+        for dir_entry in scandir(folder_path):
+            try:
+                is_dir = dir_entry.is_dir()
+                stat_result = dir_entry.stat()
+            except OSError:
+                continue
+            entries.append((dir_entry.name, is_dir, stat_result.st_mtime, stat_result.st_size))
+    else:
+        for name in os.listdir(folder_path):
+            entry_path = os.path.join(folder_path, name)
+            try:
+                stat_result = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((name, os.path.isdir(entry_path), stat_result.st_mtime, stat_result.st_size))
+
+    return entries
+
+
+def read_folder(folder_path, known_entries=None, hash_contents=False):
+    """
+    List a single folder for ScriptCatalog.apply_folder_listing, sub folders that aren't in known_entries
+    are scanned completely. Only touches the file system, so it can run on a worker thread.
+
+    :param folder_path:
+    :param known_entries: dict of name: (is_dir, mtime, size) of the children the catalog already has
+    :param hash_contents: hash the scripts that are new or have a different mtime or size than in known_entries
+    :return: FolderListing
+    """
+    known_entries = known_entries or {}
+    try:
+        dir_entries = list_directory(folder_path)
+    except OSError:
+        dir_entries = []  # the folder itself was removed, its parent folder will get updated as well
+
+    entries = {}
+    new_folders = {}
+    content_hashes = {}
+    for name, is_dir, mtime, size in dir_entries:
+        if not is_dir and not name.lower().endswith(SCRIPT_EXTENSIONS):
+            continue
+        entries[name] = (is_dir, mtime, size)
+
+        known_entry = known_entries.get(name)
+        if is_dir and not (known_entry and known_entry[0]):
+            folder_catalog = ScriptCatalog(folder_path + "/" + name)
+            folder_catalog.scan()
+            if hash_contents:
+                folder_catalog.update_content_hashes()
+            new_folders[name] = folder_catalog
+
+        elif not is_dir and hash_contents and known_entry != (False, mtime, size):
+            try:
+                with io.open(folder_path + "/" + name, "rb") as fp:
+                    content_hashes[name] = get_content_hash(fp.read())
+            except (IOError, OSError):
+                continue
+
+    return FolderListing(entries, new_folders, content_hashes)
+
+
+SNAPSHOT_VERSION = 1
+
+DELETED = -2  # parent index of entries that have been removed by update_folder
+
+
+def get_snapshot_path(root_folder, cache_folder):
+    root_folder = root_folder.replace("\\", "/").rstrip("/")
+    root_hash = hashlib.md5(root_folder.lower().encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_folder, "catalog_{}.pickle".format(root_hash))
+
+
+class ScriptCatalog(object):
+    """
+    Every script and folder under root_folder, stored in flat parallel arrays.
+
+    Entry 0 is the root folder itself, every other entry has the index of its parent folder.
+    A full scan adds entries depth first with folders before files, sorted by name.
+    update_folder appends new entries to the end and marks removed ones as DELETED,
+    so existing entry indices never change until the next full scan.
+    """
+
+    def __init__(self, root_folder):
+        self.root_folder = root_folder.replace("\\", "/").rstrip("/")
+
+        self.rel_paths = []
+        self.names = []
+        self.lower_names = []
+        self.parents = array.array("i")
+        self.is_dir = bytearray()
+        self.mtimes = array.array("d")
+        self.sizes = array.array("d")
+        self.path_indices = {}
+        self.content_hashes = {}  # rel_path: hash of the script contents, filled by update_content_hashes
+        self.duplicates = {}  # rel_path: rel_path of the first script with the same contents, see MergedCatalog
+
+    def __len__(self):
+        return len(self.rel_paths)
+
+    def clear(self):
+        self.__init__(self.root_folder)
+
+    def add_entry(self, rel_path, parent, is_dir, mtime=0.0, size=0):
+        self.rel_paths.append(rel_path)
+        name = rel_path.rsplit("/", 1)[-1]
+        self.names.append(name)
+        self.lower_names.append(name.lower())
+        self.parents.append(parent)
+        self.is_dir.append(1 if is_dir else 0)
+        self.mtimes.append(mtime)
+        self.sizes.append(size)
+
+        index = len(self.rel_paths) - 1
+        self.path_indices[rel_path] = index
+        return index
+
+    def is_deleted(self, index):
+        return self.parents[index] == DELETED
+
+    def find_entry(self, rel_path):
+        return self.path_indices.get(rel_path)
+
+    def get_children(self, index):
+        return [child_index for child_index, parent in enumerate(self.parents) if parent == index]
+
+    def get_folder_paths(self, rel_folder=""):
+        """
+        :param rel_folder: only get the folders in this folder
+        :return: paths relative to rel_folder of every folder in it, including rel_folder itself as ""
+        """
+        prefix = rel_folder + "/" if rel_folder else ""
+        return [rel_path[len(prefix):] for index, rel_path in enumerate(self.rel_paths)
+                if self.is_dir[index] and not self.is_deleted(index)
+                and (rel_path == rel_folder or rel_path.startswith(prefix))]
+
+    def scan(self):
+        """
+        Rebuild the catalog from the file system
+
+        :return: list of (folder path, error) for the folders that couldn't be listed,
+            a failed scan shouldn't replace a catalog that was complete
+        """
+        self.clear()
+        if not os.path.isdir(self.root_folder):
+            return [(self.root_folder, "folder not found")]
+
+        scan_errors = []
+        root_index = self.add_entry("", -1, True)
+        self._scan_folder("", root_index, scan_errors)
+        return scan_errors
+
+    def _scan_folder(self, rel_folder, folder_index, scan_errors=None):
+        folder_path = self.get_full_path(folder_index)
+        try:
+            dir_entries = list_directory(folder_path)
+        except OSError as e:
+            if scan_errors is not None:
+                scan_errors.append((folder_path, e))
+            return
+
+        folders = sorted((entry for entry in dir_entries if entry[1]), key=lambda entry: entry[0].lower())
+        files = sorted((entry for entry in dir_entries
+                        if not entry[1] and entry[0].lower().endswith(SCRIPT_EXTENSIONS)),
+                       key=lambda entry: entry[0].lower())
+
+        for name, _, mtime, size in folders:
+            rel_path = rel_folder + "/" + name if rel_folder else name
+            child_index = self.add_entry(rel_path, folder_index, True, mtime, size)
+            self._scan_folder(rel_path, child_index, scan_errors)
+
+        for name, _, mtime, size in files:
+            rel_path = rel_folder + "/" + name if rel_folder else name
+            self.add_entry(rel_path, folder_index, False, mtime, size)
+
+    def get_child_states(self, rel_folder):
+        """
+        :return: dict of name: (is_dir, mtime, size) of the direct children of rel_folder, None if it isn't known
+        """
+        folder_index = self.find_entry(rel_folder)
+        if folder_index is None or not self.is_dir[folder_index]:
+            return None
+        return dict((self.names[index], (bool(self.is_dir[index]), self.mtimes[index], self.sizes[index]))
+                    for index in self.get_children(folder_index))
+
+    def update_folder(self, rel_folder):
+        """
+        Re-list a single folder and update its direct children, new sub folders are scanned completely.
+
+        :param rel_folder: folder path relative to the root folder
+        :return: (added, removed, changed) lists of entry indices of direct children, None if the folder isn't known
+        """
+        child_states = self.get_child_states(rel_folder)
+        if child_states is None:
+            return None
+        folder_path = self.get_full_path(self.find_entry(rel_folder))
+        return self.apply_folder_listing(rel_folder, read_folder(folder_path, child_states))
+
+    def apply_folder_listing(self, rel_folder, folder_listing):
+        """
+        Update the direct children of a folder from a listing made by read_folder, doesn't touch the file system
+
+        :param rel_folder: folder path relative to the root folder
+        :param folder_listing: FolderListing
+        :return: (added, removed, changed) lists of entry indices of direct children, None if the folder isn't known
+        """
+        folder_index = self.find_entry(rel_folder)
+        if folder_index is None or not self.is_dir[folder_index]:
+            return None
+
+        found_entries = folder_listing.entries
+        existing_entries = dict((self.names[index], index) for index in self.get_children(folder_index))
+
+        removed = []
+        changed = []
+        for name, index in existing_entries.items():
+            found_entry = found_entries.get(name)
+            if found_entry is None or bool(found_entry[0]) != bool(self.is_dir[index]):
+                removed.append(index)
+                continue
+
+            is_dir, mtime, size = found_entry
+            if not is_dir and (self.mtimes[index] != mtime or self.sizes[index] != size):
+                self.mtimes[index] = mtime
+                self.sizes[index] = size
+                changed.append(index)
+
+        for index in removed:
+            self._delete_subtree(index)
+        for index in changed:
+            self._set_content_hash(self.rel_paths[index], folder_listing.content_hashes.get(self.names[index]))
+        removed_names = set(self.names[index] for index in removed)
+
+        added = []
+        for name in sorted(found_entries, key=lambda entry_name: (not found_entries[entry_name][0], entry_name.lower())):
+            if name in existing_entries and name not in removed_names:
+                continue
+
+            is_dir, mtime, size = found_entries[name]
+            rel_path = rel_folder + "/" + name if rel_folder else name
+            child_index = self.add_entry(rel_path, folder_index, is_dir, mtime, size)
+            folder_catalog = folder_listing.new_folders.get(name) if is_dir else None
+            if folder_catalog is not None:
+                self._add_entries(rel_path, child_index, folder_catalog)
+            elif not is_dir:
+                self._set_content_hash(rel_path, folder_listing.content_hashes.get(name))
+            added.append(child_index)
+
+        return added, removed, changed
+
+    def _add_entries(self, rel_folder, folder_index, folder_catalog):
+        """
+        Copy every entry of folder_catalog into the folder at folder_index
+        """
+        entry_map = {0: folder_index}
+        for index in range(1, len(folder_catalog)):
+            if folder_catalog.is_deleted(index):
+                continue
+            entry_map[index] = self.add_entry(rel_folder + "/" + folder_catalog.rel_paths[index],
+                                              entry_map[folder_catalog.parents[index]],
+                                              folder_catalog.is_dir[index],
+                                              folder_catalog.mtimes[index],
+                                              folder_catalog.sizes[index])
+
+        for rel_path, content_hash in folder_catalog.content_hashes.items():
+            self.content_hashes[rel_folder + "/" + rel_path] = content_hash
+
+    def _set_content_hash(self, rel_path, content_hash):
+        # a script that wasn't hashed loses its old hash, it would mark the wrong scripts as duplicates
+        if content_hash is None:
+            self.content_hashes.pop(rel_path, None)
+        else:
+            self.content_hashes[rel_path] = content_hash
+
+    def _delete_subtree(self, index):
+        # children are always added after their parent, so one pass forward finds every descendant
+        deleted_entries = set([index])
+        for child_index in range(index + 1, len(self.parents)):
+            if self.parents[child_index] in deleted_entries:
+                deleted_entries.add(child_index)
+
+        for deleted_index in deleted_entries:
+            self.parents[deleted_index] = DELETED
+            if self.path_indices.get(self.rel_paths[deleted_index]) == deleted_index:
+                self.path_indices.pop(self.rel_paths[deleted_index])
+                self.content_hashes.pop(self.rel_paths[deleted_index], None)
+
+    def save_snapshot(self, snapshot_path):
+        """
+        Save the catalog to a local file so it can be shown straight away next time
+        """
+        snapshot_folder = os.path.dirname(snapshot_path)
+        if not os.path.exists(snapshot_folder):
+            os.makedirs(snapshot_folder)
+
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "root_folder": self.root_folder,
+            "rel_paths": self.rel_paths,
+            "parents": self.parents,
+            "is_dir": self.is_dir,
+            "mtimes": self.mtimes,
+            "sizes": self.sizes,
+            "content_hashes": self.content_hashes,
+        }
+
+        temp_path = snapshot_path + ".tmp"
+        with open(temp_path, "wb") as fp:
+            pickle.dump(data, fp, protocol=2)
+
+        replace_file(temp_path, snapshot_path)
+
+    def load_snapshot(self, snapshot_path):
+        """
+        :return: True if the snapshot was loaded
+        """
+        if not os.path.exists(snapshot_path):
+            return False
+
+        try:
+            with open(snapshot_path, "rb") as fp:
+                data = pickle.load(fp)
+        except Exception as e:
+            logging.warning("Failed to load catalog snapshot {}: {}".format(snapshot_path, e))
+            return False
+
+        if data.get("version") != SNAPSHOT_VERSION or data.get("root_folder") != self.root_folder:
+            return False
+
+        self.clear()
+        self.rel_paths = data["rel_paths"]
+        self.names = [rel_path.rsplit("/", 1)[-1] for rel_path in self.rel_paths]
+        self.lower_names = [name.lower() for name in self.names]
+        self.parents = data["parents"]
+        self.is_dir = data["is_dir"]
+        self.mtimes = data["mtimes"]
+        self.sizes = data["sizes"]
+        self.path_indices = dict((rel_path, index) for index, rel_path in enumerate(self.rel_paths)
+                                 if not self.is_deleted(index))
+        self.content_hashes = data.get("content_hashes", {})
+        return True
+
+    def get_file_states(self, rel_folder=""):
+        """
+        :param rel_folder: only get the entries in this folder, with paths relative to it
+        :return: dict of rel_path: (is_dir, mtime, size), folders don't store mtime or size since those change with their contents
+        """
+        prefix = rel_folder + "/" if rel_folder else ""
+        file_states = {}
+        for index, rel_path in enumerate(self.rel_paths):
+            if self.is_deleted(index):
+                continue
+            if rel_folder:
+                if rel_path == rel_folder:
+                    rel_path = ""
+                elif rel_path.startswith(prefix):
+                    rel_path = rel_path[len(prefix):]
+                else:
+                    continue
+            if self.is_dir[index]:
+                file_states[rel_path] = (True, 0.0, 0.0)
+            else:
+                file_states[rel_path] = (False, self.mtimes[index], self.sizes[index])
+        return file_states
+
+    def diff(self, other):
+        """
+        Compare against a newer scan of the same folder
+
+        :param other: ScriptCatalog
+        :return: (added, removed, changed) lists of relative paths
+        """
+        return diff_file_states(self.get_file_states(), other.get_file_states())
+
+    def get_full_path(self, index):
+        rel_path = self.rel_paths[index]
+        return self.root_folder + "/" + rel_path if rel_path else self.root_folder
+
+    def get_rel_path(self, full_path):
+        """
+        :return: full_path relative to the root folder, None if it isn't under the root folder
+        """
+        full_path = full_path.replace("\\", "/")
+        if full_path == self.root_folder:
+            return ""
+        if full_path.startswith(self.root_folder + "/"):
+            return full_path[len(self.root_folder) + 1:]
+        return None
+
+    def update_content_hashes(self, previous_catalog=None):
+        """
+        Hash the contents of every script, hashes of scripts with the same mtime and size in
+        previous_catalog are reused so only new and changed scripts are read.
+
+        :param previous_catalog: earlier ScriptCatalog of the same folder
+        """
+        previous_states = previous_catalog.get_file_states() if previous_catalog else {}
+        content_hashes = {}
+        for index, rel_path in enumerate(self.rel_paths):
+            if self.is_dir[index] or self.is_deleted(index):
+                continue
+
+            previous_hash = previous_catalog.content_hashes.get(rel_path) if previous_catalog else None
+            if previous_hash and previous_states.get(rel_path) == (False, self.mtimes[index], self.sizes[index]):
+                content_hashes[rel_path] = previous_hash
+                continue
+
+            try:
+                with io.open(self.get_full_path(index), "rb") as fp:
+                    content_hashes[rel_path] = get_content_hash(fp.read())
+            except (IOError, OSError):
+                continue
+        self.content_hashes = content_hashes
+
+    def get_script_states(self):
+        """
+        :return: dict of full path: (mtime, size) of every script, for SearchIndex.update_files
+        """
+        return dict((self.get_full_path(index), (self.mtimes[index], self.sizes[index]))
+                    for index in range(len(self.rel_paths))
+                    if not self.is_dir[index] and not self.is_deleted(index))
+
+    def get_script_paths(self):
+        """
+        :return: relative paths of every script in the catalog
+        """
+        return [rel_path for index, rel_path in enumerate(self.rel_paths)
+                if not self.is_dir[index] and not self.is_deleted(index)]
+
+    def filter(self, terms):
+        """
+        Get the indices of scripts whose name contains any of the terms, plus all folders above them
+
+        :param terms: list of lowercase strings
+        :return: set of entry indices
+        """
+        visible_entries = set()
+        if not len(self):
+            return visible_entries
+
+        visible_entries.add(0)
+        for index, lower_name in enumerate(self.lower_names):
+            if self.is_dir[index] or self.is_deleted(index):
+                continue
+
+            for term in terms:
+                if term in lower_name:
+                    break
+            else:
+                continue
+
+            while index not in visible_entries:
+                visible_entries.add(index)
+                index = self.parents[index]
+
+        return visible_entries
+
+
+def diff_file_states(states, other_states):
+    """
+    :param states: dict from ScriptCatalog.get_file_states
+    :param other_states: newer states of the same folder
+    :return: (added, removed, changed) lists of relative paths
+    """
+    added = sorted(rel_path for rel_path in other_states if rel_path not in states)
+    removed = sorted(rel_path for rel_path in states if rel_path not in other_states)
+    changed = sorted(rel_path for rel_path, state in other_states.items()
+                     if rel_path in states and states[rel_path] != state)
+    return added, removed, changed
+
+
+def get_root_labels(root_folders):
+    """
+    Unique names to show the root folders under, the folder name with a number added for duplicates
+
+    :return: list of labels in the same order as root_folders
+    """
+    labels = []
+    for root_folder in root_folders:
+        base_label = os.path.basename(root_folder.replace("\\", "/").rstrip("/")) or root_folder
+        label = base_label
+        suffix = 2
+        while label in labels:
+            label = "{} ({})".format(base_label, suffix)
+            suffix += 1
+        labels.append(label)
+    return labels
+
+
+class MergedCatalog(ScriptCatalog):
+    """
+    Several script folders shown as one tree, every root folder is a top level folder named by its label.
+
+    Entries are copied from the catalogs of the separate roots, which are scanned and cached on their own.
+    Scripts with the same contents as a script that came before them (in root order) are duplicates.
+    """
+
+    def __init__(self, root_folder=""):
+        super(MergedCatalog, self).__init__(root_folder)
+        self.roots = collections.OrderedDict()  # label: root folder
+
+    def clear(self):
+        roots = self.roots
+        self.__init__(self.root_folder)
+        self.roots = roots
+
+    def add_catalog(self, label, catalog):
+        """
+        Copy every entry of catalog into a folder called label
+        """
+        if not len(self):
+            self.add_entry("", -1, True)
+        self.roots[label] = catalog.root_folder
+
+        entry_map = {0: self.add_entry(label, 0, True)}
+        for index in range(1, len(catalog)):
+            if catalog.is_deleted(index):
+                continue
+            entry_map[index] = self.add_entry(label + "/" + catalog.rel_paths[index],
+                                              entry_map[catalog.parents[index]],
+                                              catalog.is_dir[index],
+                                              catalog.mtimes[index],
+                                              catalog.sizes[index])
+
+        first_paths = dict((content_hash, rel_path) for rel_path, content_hash in self.content_hashes.items()
+                           if rel_path not in self.duplicates)
+        for rel_path, content_hash in sorted(catalog.content_hashes.items()):
+            rel_path = label + "/" + rel_path
+            if rel_path not in self.path_indices:
+                continue
+            self.content_hashes[rel_path] = content_hash
+            if content_hash in first_paths:
+                self.duplicates[rel_path] = first_paths[content_hash]
+            else:
+                first_paths[content_hash] = rel_path
+
+    def apply_folder_listing(self, rel_folder, folder_listing):
+        result = super(MergedCatalog, self).apply_folder_listing(rel_folder, folder_listing)
+        if result is not None:
+            self.update_duplicates()
+        return result
+
+    def update_duplicates(self):
+        """
+        Mark every script with the same contents as a script in an earlier root folder, or earlier in the same one
+        """
+        root_order = dict((label, order) for order, label in enumerate(self.roots))
+        self.duplicates = {}
+        first_paths = {}
+        for rel_path in sorted(self.content_hashes,
+                               key=lambda path: (root_order.get(path.partition("/")[0], len(root_order)), path)):
+            content_hash = self.content_hashes[rel_path]
+            if content_hash in first_paths:
+                self.duplicates[rel_path] = first_paths[content_hash]
+            else:
+                first_paths[content_hash] = rel_path
+
+    def get_full_path(self, index):
+        label, _, rel_path = self.rel_paths[index].partition("/")
+        root_folder = self.roots.get(label)
+        if root_folder is None:
+            return ""
+        return root_folder + "/" + rel_path if rel_path else root_folder
+
+    def get_rel_path(self, full_path):
+        full_path = full_path.replace("\\", "/")
+        for label, root_folder in self.roots.items():
+            if full_path == root_folder:
+                return label
+            if full_path.startswith(root_folder + "/"):
+                return label + "/" + full_path[len(root_folder) + 1:]
+        return None
+
+
+def merge_catalogs(catalogs):
+    """
+    :param catalogs: list of ScriptCatalog, in order of priority
+    :return: the catalog itself if there is only one, a MergedCatalog otherwise
+    """
+    if len(catalogs) == 1:
+        return catalogs[0]
+
+    merged_catalog = MergedCatalog()
+    for label, catalog in zip(get_root_labels([catalog.root_folder for catalog in catalogs]), catalogs):
+        merged_catalog.add_catalog(label, catalog)
+    return merged_catalog
@@ -0,0 +1,37 @@
+import importlib
+import os
+import sys
+
+USING_MAYA = os.path.basename(sys.executable) == "maya.exe"
+
+if USING_MAYA:
+    dcc_name = "Maya"
+    dcc_module_name = "script_tree_dcc_maya"
+else:
+    dcc_name = "Motionbuilder"
+    dcc_module_name = "script_tree_dcc_mobu"
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is only imported when one of its attributes is first used,
+    so importing ScriptTree (from userSetup for example) doesn't pay for the dcc imports
+    """
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return "<LazyModule {}{}>".format(self._module_name, "" if self._module else " (not loaded)")
+
+
+dcc_actions = LazyModule(__name__.rpartition(".")[0] + "." + dcc_module_name)
@@ -1,10 +1,156 @@
+import collections
+import io
 import logging
 import os
+import sys
 
+from . import script_tree_merge
+from . import script_tree_utils as stu
 from . import ui_utils
-from PySide2 import QtWidgets
+from PySide2 import QtCore, QtWidgets
+
+from maya import cmds
+from maya import mel
+from maya import OpenMayaUI as omui
+
+if sys.version_info[0] >= 3:
+    long = int
+
+# state of the file when a tab was loaded or saved, so reloads can tell whether the file has really changed
+TabFileState = collections.namedtuple("TabFileState", ["mtime", "size", "text"])
+tab_file_states = {}  # cmd_exec: TabFileState
+
+
+def to_mel_string(value):
+    return '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def call_mel(proc_name, *args):
+    """
+    Call a global MEL procedure with python arguments, strings are quoted, bools and numbers are passed as is
+    """
+    mel_args = []
+    for arg in args:
+        if isinstance(arg, bool):
+            mel_args.append(str(int(arg)))
+        elif isinstance(arg, (int, float)):
+            mel_args.append(str(arg))
+        else:
+            mel_args.append(to_mel_string(arg))
+    return mel.eval("{}({});".format(proc_name, ", ".join(mel_args)))
+
+
+_executer_tabs = ""  # full path of the script editor tab layout, $gCommandExecuterTabs
+
+
+def get_executer_tabs():
+    """
+    The tab layout only changes when the script editor is rebuilt, so skip the MEL global lookup while it still exists
+    """
+    global _executer_tabs
+    if not _executer_tabs or not cmds.tabLayout(_executer_tabs, exists=True):
+        _executer_tabs = mel.eval("$script_tree_tmp = $gCommandExecuterTabs;")
+    return _executer_tabs
+
+
+def get_tab_cmd_executer(tabs, tab):
+    tab_path = "{}|{}".format(tabs, tab)
+    return "{}|{}".format(tab_path, cmds.formLayout(tab_path, q=True, childArray=True)[0])
+
+
+class ExecuterTabIndex(object):
+    """
+    Script path and cmdScrollFieldExecuter of every script editor tab, so lookups skip the UI queries.
+
+    A tab keeps its executer for as long as it exists, so those are cached per tab. Maya reuses the layout names
+    of closed tabs, so closed tabs are dropped with remove_tab and cached executers are checked to still exist.
+    The path of each tab is indexed when first needed, and again after invalidate(),
+    which the tab callbacks from hookup_tab_signals call whenever a tab is saved or loaded.
+    Cached hits are checked against the filename of the executer, so tabs renamed or closed by Maya itself are caught.
+    """
+
+    def __init__(self):
+        self.tabs = ""
+        self.tab_executers = {}  # tab name: cmd_exec
+        self.path_tabs = {}  # script path: tab name
+        self.valid = False
+
+    def invalidate(self, *args):
+        self.valid = False
+
+    def rebuild(self):
+        tabs = get_executer_tabs()
+        if tabs != self.tabs:
+            self.tabs = tabs
+            self.tab_executers = {}
+
+        tab_names = cmds.tabLayout(tabs, q=True, childArray=True) or []
+        tab_labels = cmds.tabLayout(tabs, q=True, tabLabel=True) or []
+        self.tab_executers = dict((tab, self._get_cached_executer(tab) or get_tab_cmd_executer(tabs, tab))
+                                  for tab in tab_names)
+        self.path_tabs = dict(zip(tab_labels, tab_names))
+        self.valid = True
+
+    def get_executer(self, tab):
+        tabs = get_executer_tabs()
+        if tabs != self.tabs:
+            self.rebuild()
+
+        cmd_exec = self._get_cached_executer(tab)
+        if cmd_exec is None:
+            cmd_exec = get_tab_cmd_executer(tabs, tab)
+            self.tab_executers[tab] = cmd_exec
+        return cmd_exec
+
+    def _get_cached_executer(self, tab):
+        cmd_exec = self.tab_executers.get(tab)
+        if cmd_exec is not None and not cmds.cmdScrollFieldExecuter(cmd_exec, exists=True):
+            del self.tab_executers[tab]  # the tab was closed and its name reused
+            return None
+        return cmd_exec
+
+    def add_tab(self, script_path, tab):
+        self.path_tabs[script_path] = tab
+
+    def remove_tab(self, tab):
+        self.tab_executers.pop(tab, None)
+        self.path_tabs = dict((script_path, path_tab) for script_path, path_tab in self.path_tabs.items()
+                              if path_tab != tab)
+        self.invalidate()
+
+    def find_tab(self, script_path, rebuild_on_miss=True):
+        """
+        :param script_path:
+        :param rebuild_on_miss: re-index the tabs if script_path isn't found, it might have been opened by Maya itself
+        :return: (tab, cmd_exec) of the tab that has script_path open, (None, None) if there isn't one
+        """
+        if not self.valid or get_executer_tabs() != self.tabs \
+                or (rebuild_on_miss and script_path not in self.path_tabs):
+            self.rebuild()
+        elif script_path in self.path_tabs and not self._is_tab_current(script_path):
+            self.rebuild()
+
+        tab = self.path_tabs.get(script_path)
+        if tab is None:
+            return None, None
+        return tab, self.tab_executers[tab]
+
+    def _is_tab_current(self, script_path):
+        cmd_exec = self.tab_executers.get(self.path_tabs[script_path])
+        try:
+            return cmd_exec is not None and cmds.cmdScrollFieldExecuter(cmd_exec, q=True, filename=True) == script_path
+        except RuntimeError:
+            return False  # the tab has been closed
+
+
+tab_index = ExecuterTabIndex()
+
+
+NEW_TAB_COMMANDS = {
+    ".py": 'buildNewExecuterTab(-1, "Python", "python", 0);',
+    ".mel": 'buildNewExecuterTab(-1, "MEL", "mel", 0);',
+}
 
-import pymel.core as pm
 
 def open_script(script_path):
     """
@@ -14,37 +160,149 @@ def open_script(script_path):
     :param script_path:
     :return:
     """
-    if pm.mel.selectExecuterTabByName(script_path):  # tab exists, switch to it
-        reload_selected_tab()
-        return
+    open_scripts([script_path])
 
-    script_ext = os.path.splitext(script_path)[-1].lower()
 
-    # create tab
-    if script_ext == ".py":
-        pm.mel.buildNewExecuterTab(-1, "Python", "python", 0)
-    elif script_ext == ".mel":
-        pm.mel.buildNewExecuterTab(-1, "MEL", "mel", 0)
+def open_scripts(script_paths, reload_open_scripts=True):
+    """
+    Open several scripts in the script editor.
 
-    tabs = pm.melGlobals["$gCommandExecuterTabs"]
-    tabs_layout = pm.tabLayout(tabs, q=True, ca=True)
+    The new tabs are built and renamed in a single MEL evaluation each, so the cost of opening
+    many scripts is mostly the file loads. The tab of the last script ends up selected.
 
-    # Select newly created tab
-    tabs_len = pm.tabLayout(tabs, q=True, numberOfChildren=True)
-    pm.tabLayout(tabs, e=True, selectTabIndex=tabs_len)
-    tab = tabs_layout[-1]
+    :param script_paths:
+    :param reload_open_scripts: reload scripts that already have a tab, otherwise they're left as they are
+    :return:
+    """
+    tabs = get_executer_tabs()
+
+    new_script_paths = []
+    last_tab = None
+    for path_number, script_path in enumerate(script_paths):
+        # re-indexing once is enough to catch tabs opened outside of ScriptTree
+        tab, cmd_exec = tab_index.find_tab(script_path, rebuild_on_miss=path_number == 0)
+        if tab:
+            if reload_open_scripts:
+                reload_tab(cmd_exec, script_path)
+            last_tab = tab
+            continue
+
+        last_tab = None
+        new_tab_command = NEW_TAB_COMMANDS.get(os.path.splitext(script_path)[-1].lower())
+        if new_tab_command is None:
+            logging.warning("Can't open in the script editor: {}".format(script_path))
+            continue
+        if script_path not in new_script_paths:
+            new_script_paths.append(script_path)
+
+    if new_script_paths:
+        mel.eval("\n".join(NEW_TAB_COMMANDS[os.path.splitext(script_path)[-1].lower()]
+                           for script_path in new_script_paths))
+        tab_names = cmds.tabLayout(tabs, q=True, childArray=True)
+        first_new_tab_index = len(tab_names) - len(new_script_paths)
+
+        # renameCurrentExecuterTab also updates the script editor globals, so each tab gets selected before renaming
+        rename_commands = []
+        new_cmd_executers = []
+        for tab_number, script_path in enumerate(new_script_paths, first_new_tab_index):
+            tab = tab_names[tab_number]
+            cmd_exec = tab_index.get_executer(tab)
+            load_tab(cmd_exec, script_path)
+            new_cmd_executers.append(cmd_exec)
+
+            rename_commands.append("tabLayout -e -selectTabIndex {} {};".format(tab_number + 1, to_mel_string(tabs)))
+            rename_commands.append("renameCurrentExecuterTab({}, 0);".format(to_mel_string(script_path)))
+        mel.eval("\n".join(rename_commands))
+
+        for cmd_exec in new_cmd_executers:
+            hookup_tab_signals(cmd_exec)
+        for tab, script_path in zip(tab_names[first_new_tab_index:], new_script_paths):
+            tab_index.add_tab(script_path, tab)
+
+    # the last new tab is selected by the renaming already
+    if last_tab:
+        cmds.tabLayout(tabs, e=True, selectTab=last_tab)
+
+
+def get_executer_text_edit(cmd_exec):
+    """
+    :return: the Qt text edit of a cmdScrollFieldExecuter, None if it can't be found
+    """
+    from shiboken2 import wrapInstance
+
+    control_ptr = omui.MQtUtil.findControl(cmd_exec)
+    if not control_ptr:
+        return None
+
+    widget = wrapInstance(long(control_ptr), QtWidgets.QWidget)
+    for text_edit_class in (QtWidgets.QPlainTextEdit, QtWidgets.QTextEdit):
+        if isinstance(widget, text_edit_class):
+            return widget
+        text_edit = widget.findChild(text_edit_class)
+        if text_edit:
+            return text_edit
+    return None
 
-    # add script contents
-    cmd_exec = pm.formLayout(tab, q=True, ca=True)[0]
-    pm.cmdScrollFieldExecuter(cmd_exec, e=True, loadFile=script_path)
 
-    # print(pm.cmdScrollFieldExecuter(cmd_exec, q=True, filename=True))
+def get_tab_states():
+    """
+    Path, cursor position and scroll position of every script editor tab that has a file
 
-    # rename tab
-    pm.mel.eval('renameCurrentExecuterTab("{}", 0);'.format(script_path))
+    :return: list of dicts, in tab order
+    """
+    tabs = get_executer_tabs()
+    tab_states = []
+    for tab in cmds.tabLayout(tabs, q=True, childArray=True) or []:
+        cmd_exec = tab_index.get_executer(tab)
+        script_path = cmds.cmdScrollFieldExecuter(cmd_exec, q=True, filename=True)
+        if not script_path:
+            continue
+
+        tab_state = {"path": script_path}
+        text_edit = get_executer_text_edit(cmd_exec)
+        if text_edit is not None:
+            tab_state["cursor"] = text_edit.textCursor().position()
+            tab_state["scroll"] = text_edit.verticalScrollBar().value()
+        tab_states.append(tab_state)
+    return tab_states
+
+
+def restore_tab_states(tab_states, selected_path=None):
+    """
+    Open the scripts of get_tab_states in one batch and put back the cursor and scroll positions,
+    scripts that are open already are left as they are
 
-    # hookup signals
-    hookup_tab_signals(cmd_exec)
+    :param tab_states: list of dicts from get_tab_states
+    :param selected_path: script to select afterwards, defaults to the last one
+    """
+    tab_states = [tab_state for tab_state in tab_states if os.path.exists(tab_state["path"])]
+    if not tab_states:
+        return
+
+    script_paths = [tab_state["path"] for tab_state in tab_states]
+    if selected_path in script_paths:
+        script_paths.remove(selected_path)
+        script_paths.append(selected_path)
+    open_scripts(script_paths, reload_open_scripts=False)
+
+    text_edits = []
+    for tab_state in tab_states:
+        tab, cmd_exec = tab_index.find_tab(tab_state["path"], rebuild_on_miss=False)
+        text_edit = get_executer_text_edit(cmd_exec) if cmd_exec else None
+        if text_edit is None or "cursor" not in tab_state:
+            continue
+
+        text_cursor = text_edit.textCursor()
+        text_cursor.setPosition(min(tab_state["cursor"], len(text_edit.toPlainText())))
+        text_edit.setTextCursor(text_cursor)
+        text_edits.append((text_edit, tab_state["scroll"]))
+
+    def restore_scroll_positions():
+        for text_edit, scroll_value in text_edits:
+            text_edit.verticalScrollBar().setValue(scroll_value)
+
+    # the scroll range is only known once the new tabs have been laid out
+    QtCore.QTimer.singleShot(0, restore_scroll_positions)
 
 
 def create_new_tab(default_script_content=""):
@@ -54,23 +312,22 @@ def create_new_tab(default_script_content=""):
     :param default_script_content:
     :return:
     """
-    pm.mel.buildNewExecuterTab(-1, "Python", "python", 0)
+    call_mel("buildNewExecuterTab", -1, "Python", "python", 0)
 
-    tabs = pm.melGlobals["$gCommandExecuterTabs"]
-    tabs_layout = pm.tabLayout(tabs, q=True, ca=True)
+    tabs = get_executer_tabs()
+    tabs_layout = cmds.tabLayout(tabs, q=True, childArray=True)
 
-    tabs_len = pm.tabLayout(tabs, q=True, numberOfChildren=True)
-    pm.tabLayout(tabs, e=True, selectTabIndex=tabs_len)  # select newly created tab
+    tabs_len = cmds.tabLayout(tabs, q=True, numberOfChildren=True)
+    cmds.tabLayout(tabs, e=True, selectTabIndex=tabs_len)  # select newly created tab
 
-    tab = tabs_layout[-1]
-    cmd_exec = pm.formLayout(tab, q=True, ca=True)[0]
+    cmd_exec = get_tab_cmd_executer(tabs, tabs_layout[-1])
 
-    pm.cmdScrollFieldExecuter(cmd_exec, e=True, text=default_script_content)
+    cmds.cmdScrollFieldExecuter(cmd_exec, e=True, text=default_script_content)
 
 
 def get_selected_script_path():
     cmd_exec = get_selected_cmd_executer()
-    return pm.cmdScrollFieldExecuter(cmd_exec, q=True, filename=True)
+    return cmds.cmdScrollFieldExecuter(cmd_exec, q=True, filename=True)
 
 
 def save_selected_tab(script_path=None):
@@ -79,32 +336,118 @@ def save_selected_tab(script_path=None):
 
     cmd_exec = get_selected_cmd_executer()
 
-    pm.cmdScrollFieldExecuter(cmd_exec, edit=True, saveFile=script_path)
+    cmds.cmdScrollFieldExecuter(cmd_exec, edit=True, saveFile=script_path)
+    store_tab_file_state(cmd_exec, script_path)
 
-    pm.mel.eval('renameCurrentExecuterTab("{}", 0);'.format(script_path))
+    call_mel("renameCurrentExecuterTab", script_path, 0)
     hookup_tab_signals(cmd_exec)
+    tab_index.invalidate()
 
     logging.info("Saved: {}".format(script_path))
 
 
 def reload_selected_tab():
     cmd_exec = get_selected_cmd_executer()
-    script_path = pm.cmdScrollFieldExecuter(cmd_exec, q=True, filename=True)
-    pm.cmdScrollFieldExecuter(cmd_exec, e=True, loadFile=script_path)
+    script_path = cmds.cmdScrollFieldExecuter(cmd_exec, q=True, filename=True)
+    if script_path:
+        reload_tab(cmd_exec, script_path)
+
+
+def read_script_text(script_path):
+    with io.open(stu.script_mirror.get_local_path(script_path), "rb") as fp:
+        return fp.read().decode("utf-8", "replace").replace("\r\n", "\n")
+
+
+def store_tab_file_state(cmd_exec, script_path):
+    try:
+        mirror_file = stu.script_mirror.get_file(script_path)
+    except OSError:
+        tab_file_states.pop(cmd_exec, None)
+        return
+    tab_text = cmds.cmdScrollFieldExecuter(cmd_exec, q=True, text=True)
+    tab_file_states[cmd_exec] = TabFileState(mirror_file.mtime, mirror_file.size, tab_text)
+
+
+def load_tab(cmd_exec, script_path):
+    # loadFile is what sets the file the tab saves to, so it gets the real path even for mirrored scripts
+    cmds.cmdScrollFieldExecuter(cmd_exec, e=True, loadFile=script_path)
+    store_tab_file_state(cmd_exec, script_path)
+
+
+def reload_tab(cmd_exec, script_path):
+    """
+    Reload a tab only when its file has changed since the tab was loaded or saved.
+
+    An unchanged modified time and size costs a single stat, a touched file with the same content costs a read.
+    If the tab has unsaved edits as well, the user can merge both changes, reload the file or keep the tab.
+
+    :return: True if the tab content was replaced
+    """
+    file_state = tab_file_states.get(cmd_exec)
+    try:
+        mirror_file = stu.script_mirror.get_file(script_path)  # the mirror skips the stat if it just checked
+    except OSError:
+        return False
+
+    if file_state is None:  # not loaded through ScriptTree, so there's nothing to compare with
+        load_tab(cmd_exec, script_path)
+        return True
+
+    if (mirror_file.mtime, mirror_file.size) == (file_state.mtime, file_state.size):
+        return False
+
+    file_text = read_script_text(script_path)
+    tab_text = cmds.cmdScrollFieldExecuter(cmd_exec, q=True, text=True)
+    if file_text in (file_state.text, tab_text):  # touched, or saved from somewhere else
+        tab_file_states[cmd_exec] = TabFileState(mirror_file.mtime, mirror_file.size, file_text)
+        return False
+
+    if tab_text == file_state.text:
+        load_tab(cmd_exec, script_path)
+        return True
+
+    message_box = QtWidgets.QMessageBox(ui_utils.get_app_window())
+    message_box.setWindowTitle("Script changed on disk")
+    message_box.setText("{}\nhas changed on disk, and the tab has unsaved changes.".format(script_path))
+    merge_button = message_box.addButton("Merge", QtWidgets.QMessageBox.AcceptRole)
+    reload_button = message_box.addButton("Reload from disk", QtWidgets.QMessageBox.DestructiveRole)
+    message_box.addButton("Keep tab", QtWidgets.QMessageBox.RejectRole)
+    message_box.exec_()
+
+    if message_box.clickedButton() == reload_button:
+        load_tab(cmd_exec, script_path)
+        return True
+
+    # the file on disk is the new base, so the same change isn't offered again
+    tab_file_states[cmd_exec] = TabFileState(mirror_file.mtime, mirror_file.size, file_text)
+    if message_box.clickedButton() != merge_button:
+        return False
+
+    merged_text, conflict_count = script_tree_merge.merge_text(file_state.text, tab_text, file_text)
+    cmds.cmdScrollFieldExecuter(cmd_exec, e=True, text=merged_text)
+    if conflict_count:
+        logging.warning("Merged {} with {} conflicts, marked with {}".format(script_path, conflict_count,
+                                                                            script_tree_merge.CONFLICT_START))
+    else:
+        logging.info("Merged: {}".format(script_path))
+    return True
 
 
 def delete_selected_tab():
-    pm.mel.eval("removeCurrentExecuterTab;")
+    tab = cmds.tabLayout(get_executer_tabs(), q=True, selectTab=True)
+    tab_file_states.pop(tab_index.get_executer(tab), None)
+    mel.eval("removeCurrentExecuterTab;")
+    tab_index.remove_tab(tab)
 
 
 def insert_pm_selected():
     cmd_exec = get_selected_cmd_executer()
-    pm.cmdScrollFieldExecuter(cmd_exec, edit=True, insertText="pm.selected()[0]")
+    cmds.cmdScrollFieldExecuter(cmd_exec, edit=True, insertText="pm.selected()[0]")
 
 
 def toggle_comment_selected_lines():
     cmd_exec = get_selected_cmd_executer()
-    selected_text = pm.cmdScrollFieldExecuter(cmd_exec, q=True, selectedText=True)
+    selected_text = cmds.cmdScrollFieldExecuter(cmd_exec, q=True, selectedText=True)
 
     comment_lines = "#" not in selected_text.split("\n")[0]
 
@@ -118,46 +461,63 @@ def toggle_comment_selected_lines():
         new_text_lines.append(new_line)
 
     new_text = "\n".join(new_text_lines)
-    pm.cmdScrollFieldExecuter(cmd_exec, e=True, insertText=new_text)
+    cmds.cmdScrollFieldExecuter(cmd_exec, e=True, insertText=new_text)
 
 
 def get_selected_script_text():
     cmd_exec = get_selected_cmd_executer()
-    return pm.cmdScrollFieldExecuter(cmd_exec, q=True, selectedText=True)
+    return cmds.cmdScrollFieldExecuter(cmd_exec, q=True, selectedText=True)
+
+
+def get_selected_tab_text():
+    return cmds.cmdScrollFieldExecuter(get_selected_cmd_executer(), q=True, text=True)
+
+
+def get_selected_tab_file_text():
+    """
+    :return: text of the selected tab's file as of when the tab was last loaded, saved or checked against it,
+        None if the tab wasn't loaded through ScriptTree
+    """
+    file_state = tab_file_states.get(get_selected_cmd_executer())
+    return file_state.text if file_state else None
 
 
 def clear_script_output():
-    pm.scriptEditorInfo(clearHistory=True)
+    cmds.scriptEditorInfo(clearHistory=True)
 
 
 def save_script_editor():
-    pm.mel.syncExecuterBackupFiles()
+    mel.eval("syncExecuterBackupFiles;")
     logging.info("Script Editor Saved")
 
 
 def get_selected_cmd_executer():
-    tab_layout = pm.ui.TabLayout(pm.melGlobals["$gCommandExecuterTabs"])
-    return pm.formLayout(tab_layout.getSelectTab(), q=True, ca=True)[0]
+    return tab_index.get_executer(cmds.tabLayout(get_executer_tabs(), q=True, selectTab=True))
+
+
+def _tab_file_changed(value):
+    tab_index.invalidate()
+    call_mel("executerTabFileChanged", value)
 
 
 def hookup_tab_signals(cmd_exec):
-    pm.cmdScrollFieldExecuter(cmd_exec, e=True,
-                              modificationChangedCommand=lambda x: pm.mel.executerTabModificationChanged(x))
-    pm.cmdScrollFieldExecuter(cmd_exec, e=True, fileChangedCommand=lambda x: pm.mel.executerTabFileChanged(x))
+    cmds.cmdScrollFieldExecuter(cmd_exec, e=True,
+                                modificationChangedCommand=lambda x: call_mel("executerTabModificationChanged", x),
+                                fileChangedCommand=_tab_file_changed)
 
 
 def open_search_dialog():
-    pm.mel.createSearchAndReplaceWindow()
+    mel.eval("createSearchAndReplaceWindow;")
     # Just creating the window isn't properly bringing it too focus, so I add this line to make sure it shows
-    pm.showWindow("commandSearchAndReplaceWnd")
+    cmds.showWindow("commandSearchAndReplaceWnd")
 
 
 def eval_deferred(func):
-    pm.evalDeferred(func)
+    cmds.evalDeferred(func)
 
 
 def add_to_repeat_commands(exec_command):
-    pm.repeatLast(ac=exec_command)
+    cmds.repeatLast(addCommand=exec_command)
 
 
 def get_script_editor_widget():
@@ -14,6 +14,19 @@ def open_script(script_path):
     pass
 
 
+def open_scripts(script_paths, reload_open_scripts=True):
+    for script_path in script_paths:
+        open_script(script_path)
+
+
+def get_tab_states():
+    return []
+
+
+def restore_tab_states(tab_states, selected_path=None):
+    pass
+
+
 def create_new_tab(default_script_content=""):
     """
     Create Tab and fill with content of default_script_content
@@ -53,6 +66,14 @@ def get_selected_script_text():
     cmd_exec = get_selected_cmd_executer()
     pass
 
+def get_selected_tab_text():
+    cmd_exec = get_selected_cmd_executer()
+    pass
+
+def get_selected_tab_file_text():
+    cmd_exec = get_selected_cmd_executer()
+    pass
+
 def clear_script_output():
     pass
 
@@ -0,0 +1,194 @@
+import heapq
+import re
+import time
+
+BOUNDARY_CHARACTERS = "/\\_-. "
+
+SCORE_MATCH = 16
+SCORE_BOUNDARY = 8
+SCORE_CONSECUTIVE = 6
+PENALTY_GAP = 1
+MAX_GAP_PENALTY = 12
+SCORE_RECENT = 40  # bonus for a script that was just used, halves every RECENT_HALF_LIFE
+RECENT_HALF_LIFE = 7 * 24 * 60 * 60
+
+MAX_QUERY_LENGTH = 48  # every query character is a regex group, keep it well below the group limit
+SHORTLIST_FACTOR = 4  # how many times the result limit gets fully scored, the rest is ranked by match span
+
+
+def _character_bit(character):
+    if "a" <= character <= "z":
+        return 1 << (ord(character) - ord("a"))
+    if "0" <= character <= "9":
+        return 1 << (26 + ord(character) - ord("0"))
+    if character == "_":
+        return 1 << 36
+    return 1 << 37
+
+
+CHARACTER_BITS = dict((chr(i), _character_bit(chr(i))) for i in range(128))
+OTHER_CHARACTER_BIT = 1 << 37
+
+
+def get_character_mask(text):
+    """
+    Bitmask of which characters exist in text, used to throw away paths that can't match before scoring them
+    """
+    mask = 0
+    get_bit = CHARACTER_BITS.get
+    for character in set(text):
+        mask |= get_bit(character, OTHER_CHARACTER_BIT)
+    return mask
+
+
+def get_recency_bonus(last_used_time, now=None):
+    if not last_used_time:
+        return 0.0
+    now = now or time.time()
+    age = max(0.0, now - last_used_time)
+    return SCORE_RECENT * 0.5 ** (age / RECENT_HALF_LIFE)
+
+
+def compile_query_pattern(query):
+    """
+    Regex that finds query as a subsequence, taking the first possible position for every character.
+
+    Negated character classes instead of lazy wildcards so the regex engine never has to backtrack.
+    """
+    parts = []
+    for i, character in enumerate(query):
+        escaped = re.escape(character)
+        if i == 0:
+            parts.append("({})".format(escaped))
+        else:
+            parts.append("[^{}]*({})".format(escaped, escaped))
+    return re.compile("".join(parts))
+
+
+def score_match(text, match, query_length):
+    score = 0
+    previous_position = None
+    for group_index in range(1, query_length + 1):
+        position = match.start(group_index)
+        score += SCORE_MATCH
+
+        if position == 0 or text[position - 1] in BOUNDARY_CHARACTERS:
+            score += SCORE_BOUNDARY
+
+        if previous_position is not None:
+            gap = position - previous_position - 1
+            if gap == 0:
+                score += SCORE_CONSECUTIVE
+            else:
+                score -= min(gap * PENALTY_GAP, MAX_GAP_PENALTY)
+
+        previous_position = position
+
+    return score
+
+
+class FuzzyMatcher(object):
+    """
+    fzf style subsequence matching over a fixed list of paths.
+
+    Lowercase paths, file names and character masks are computed once when the matcher is created.
+    Matches in the file name always rank above matches that need the folder names.
+    While typing, each query only re-checks the paths that matched the query before it.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.lower_paths = [path.lower() for path in self.paths]
+        self.lower_names = [lower_path[lower_path.rfind("/") + 1:] for lower_path in self.lower_paths]
+        self.path_masks = [get_character_mask(lower_path) for lower_path in self.lower_paths]
+        self.name_masks = [get_character_mask(lower_name) for lower_name in self.lower_names]
+        self.path_indices = dict((path, index) for index, path in enumerate(self.paths))
+
+        self._last_query = ""
+        self._last_name_hits = None  # indices of paths that matched the last query in their file name
+        self._last_path_hits = None  # indices of paths that matched the last query anywhere, None if not searched
+
+    def __len__(self):
+        return len(self.paths)
+
+    def search(self, query, limit=50, last_used_times=None):
+        """
+        :param query: text to match
+        :param limit: max number of results
+        :param last_used_times: dict of path: time.time() of when the script was last used
+        :return: list of (score, path), best match first
+        """
+        query = query.lower().replace(" ", "")[:MAX_QUERY_LENGTH]
+        if not query:
+            return []
+
+        narrowing = self._last_query and query.startswith(self._last_query)
+        query_mask = get_character_mask(query)
+        pattern = compile_query_pattern(query)
+
+        # matches in the file name
+        name_candidates = self._last_name_hits if narrowing else range(len(self.paths))
+        name_hits = self._find_hits(name_candidates, self.name_masks, self.lower_names, query_mask, pattern)
+
+        # matches in the full path, only needed when the file names don't fill up the results
+        path_hits = []
+        all_path_hits = None
+        if len(name_hits) < limit:
+            if narrowing and self._last_path_hits is not None:
+                path_candidates = self._last_path_hits
+            else:
+                path_candidates = range(len(self.paths))
+            path_hits = self._find_hits(path_candidates, self.path_masks, self.lower_paths, query_mask, pattern)
+            all_path_hits = [index for index, _ in path_hits]
+
+            name_hit_indices = set(index for index, _ in name_hits)
+            path_hits = [hit for hit in path_hits if hit[0] not in name_hit_indices]
+
+        self._last_query = query
+        self._last_name_hits = [index for index, _ in name_hits]
+        self._last_path_hits = all_path_hits
+
+        # recently used scripts always get scored, so the recency bonus can lift them into the results
+        last_used_times = last_used_times or {}
+        recent_indices = [self.path_indices[path] for path in last_used_times if path in self.path_indices]
+        recent_name_hits = self._find_hits(recent_indices, self.name_masks, self.lower_names, query_mask, pattern)
+        recent_name_indices = set(index for index, _ in recent_name_hits)
+        recent_path_hits = self._find_hits([index for index in recent_indices if index not in recent_name_indices],
+                                           self.path_masks, self.lower_paths, query_mask, pattern)
+
+        results = self._rank_hits(name_hits, recent_name_hits, self.lower_names, len(query), limit, last_used_times)
+        if len(results) < limit:
+            results += self._rank_hits(path_hits, recent_path_hits, self.lower_paths, len(query),
+                                       limit - len(results), last_used_times)
+        return results
+
+    @staticmethod
+    def _find_hits(candidates, masks, texts, query_mask, pattern):
+        search = pattern.search
+        hits = []
+        for index in candidates:
+            if masks[index] & query_mask != query_mask:
+                continue
+            match = search(texts[index])
+            if match:
+                hits.append((index, match))
+        return hits
+
+    def _rank_hits(self, hits, recent_hits, texts, query_length, limit, last_used_times):
+        """
+        Fully score the tightest matches plus the recently used ones, then take the best of those
+        """
+        shortlist = heapq.nsmallest(limit * SHORTLIST_FACTOR, hits, key=lambda hit: hit[1].end() - hit[1].start())
+        shortlisted = set(index for index, _ in shortlist)
+        shortlist += [hit for hit in recent_hits if hit[0] not in shortlisted]
+
+        now = time.time()
+        scored_paths = []
+        for index, match in shortlist:
+            path = self.paths[index]
+            score = score_match(texts[index], match, query_length)
+            score += get_recency_bonus(last_used_times.get(path), now)
+            scored_paths.append((score, -len(path), path))
+
+        best_matches = heapq.nlargest(limit, scored_paths)
+        return [(score, path) for score, _, path in best_matches]
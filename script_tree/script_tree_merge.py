@@ -0,0 +1,87 @@
+import difflib
+
+CONFLICT_START = "<<<<<<< script editor"
+CONFLICT_SEPARATOR = "======="
+CONFLICT_END = ">>>>>>> file on disk"
+
+
+def get_changes(base_lines, other_lines):
+    """
+    :return: list of (base_start, base_end, new_lines), the regions of base_lines that other_lines replaced
+    """
+    matcher = difflib.SequenceMatcher(None, base_lines, other_lines, autojunk=False)
+    return [(i1, i2, other_lines[j1:j2]) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+
+def apply_changes(base_lines, start, end, changes):
+    """
+    :return: base_lines[start:end] with changes applied, changes have to lie within start and end
+    """
+    lines = []
+    position = start
+    for change_start, change_end, new_lines in changes:
+        lines.extend(base_lines[position:change_start])
+        lines.extend(new_lines)
+        position = change_end
+    lines.extend(base_lines[position:end])
+    return lines
+
+
+def merge_lines(base_lines, ours_lines, theirs_lines):
+    """
+    Three way merge of two edited versions of base_lines.
+
+    Changes from one side are taken as they are, overlapping or touching changes from both sides
+    are kept when they're identical and marked as a conflict otherwise.
+
+    :return: (merged lines, conflict count)
+    """
+    tagged_changes = [(change, 0) for change in get_changes(base_lines, ours_lines)]
+    tagged_changes += [(change, 1) for change in get_changes(base_lines, theirs_lines)]
+    tagged_changes.sort(key=lambda tagged_change: (tagged_change[0][0], tagged_change[0][1]))
+
+    # group changes that overlap or touch in the base
+    clusters = []
+    for change, side in tagged_changes:
+        if clusters and change[0] <= clusters[-1][1]:
+            cluster = clusters[-1]
+            cluster[1] = max(cluster[1], change[1])
+            cluster[2][side].append(change)
+        else:
+            side_changes = ([], [])
+            side_changes[side].append(change)
+            clusters.append([change[0], change[1], side_changes])
+
+    merged_lines = []
+    conflict_count = 0
+    position = 0
+    for start, end, (ours_changes, theirs_changes) in clusters:
+        merged_lines.extend(base_lines[position:start])
+        position = end
+
+        ours_region = apply_changes(base_lines, start, end, ours_changes)
+        theirs_region = apply_changes(base_lines, start, end, theirs_changes)
+        if not theirs_changes or ours_region == theirs_region:
+            merged_lines.extend(ours_region)
+        elif not ours_changes:
+            merged_lines.extend(theirs_region)
+        else:
+            conflict_count += 1
+            merged_lines.append(CONFLICT_START)
+            merged_lines.extend(ours_region)
+            merged_lines.append(CONFLICT_SEPARATOR)
+            merged_lines.extend(theirs_region)
+            merged_lines.append(CONFLICT_END)
+
+    merged_lines.extend(base_lines[position:])
+    return merged_lines, conflict_count
+
+
+def merge_text(base_text, ours_text, theirs_text):
+    """
+    merge_lines for whole texts
+
+    :return: (merged text, conflict count)
+    """
+    merged_lines, conflict_count = merge_lines(base_text.split("\n"), ours_text.split("\n"), theirs_text.split("\n"))
+    return "\n".join(merged_lines), conflict_count
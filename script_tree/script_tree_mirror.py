@@ -0,0 +1,239 @@
+import collections
+import errno
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from .script_tree_backup import replace_file, write_file_atomic
+
+MirrorEntry = collections.namedtuple("MirrorEntry", ["local_name", "mtime", "size", "used_time"])
+MirrorFile = collections.namedtuple("MirrorFile", ["path", "mtime", "size"])  # mtime and size of the original
+
+MIRROR_INDEX_NAME = "mirror_index.json"
+
+
+def get_local_name(file_path):
+    path_hash = hashlib.sha1(os.path.normcase(file_path).encode("utf-8")).hexdigest()
+    return path_hash + os.path.splitext(file_path)[-1].lower()
+
+
+class ScriptMirror(object):
+    """
+    Local read-through copies of the scripts in network folders.
+
+    Reading a script stats the original and only copies it when its mtime or size differ from the local copy,
+    so repeated runs, opens and searches read from local disk. A script that was checked less than
+    validate_interval seconds ago isn't checked again. Copies are evicted least recently used first once they
+    take up more than max_size bytes, down to evict_ratio of it so the next copies don't evict again.
+
+    Copies run outside the lock, only one thread copies a given script and the others wait for it.
+    Scripts that are being copied are never evicted.
+    The index is written at most every index_save_interval seconds, and on flush.
+
+    When the share can't be reached, or offline is set, the local copies are used as they are.
+    Scripts without a local copy fail right away when offline is set, instead of waiting on the share.
+    """
+
+    def __init__(self, cache_folder, max_size=512 * 1024 * 1024, validate_interval=2.0, index_save_interval=30.0,
+                 evict_ratio=0.9):
+        self.cache_folder = cache_folder
+        self.index_path = os.path.join(cache_folder, MIRROR_INDEX_NAME)
+        self.max_size = max_size
+        self.validate_interval = validate_interval
+        self.index_save_interval = index_save_interval
+        self.evict_ratio = evict_ratio
+
+        self.mirrored_folders = []
+        self.offline = False
+        self.lock = threading.RLock()
+
+        self.entries = None  # file_path: MirrorEntry, loaded on first use
+        self.total_size = 0  # size of every entry combined
+        self.validated_times = {}  # file_path: time.time() the original was last checked
+        self.copy_events = {}  # file_path: threading.Event set once its copy is done
+        self.index_dirty = False
+        self.index_save_time = time.time()
+
+    def set_mirrored_folders(self, folder_paths):
+        self.mirrored_folders = [folder_path.replace("\\", "/").rstrip("/") for folder_path in folder_paths]
+
+    def is_mirrored(self, file_path):
+        file_path = file_path.replace("\\", "/")
+        return any(file_path.startswith(folder_path + "/") for folder_path in self.mirrored_folders)
+
+    def get_cache_path(self, local_name):
+        return os.path.join(self.cache_folder, local_name)
+
+    def get_local_path(self, file_path):
+        """
+        :return: path to read file_path from, file_path itself if it isn't mirrored
+        """
+        return self.get_file(file_path).path
+
+    def get_file(self, file_path):
+        """
+        Get the local copy of file_path, copying it first if it's missing or out of date
+
+        :return: MirrorFile, with the mtime and size of the original as of the last check
+        """
+        if not self.is_mirrored(file_path):
+            stat_result = os.stat(file_path)
+            return MirrorFile(file_path, stat_result.st_mtime, stat_result.st_size)
+
+        file_path = file_path.replace("\\", "/")
+        while True:
+            with self.lock:
+                copy_event = self.copy_events.get(file_path)
+                if copy_event is None:
+                    mirror_file, stat_result = self._check_file(file_path)
+                    if mirror_file is not None:
+                        return mirror_file
+                    copy_event = self.copy_events[file_path] = threading.Event()
+                    break
+
+            copy_event.wait()  # another thread is copying it, use its copy
+
+        try:
+            return self._copy_file(file_path, stat_result)
+        finally:
+            with self.lock:
+                self.copy_events.pop(file_path).set()
+            self._save_index_if_due()
+
+    def _check_file(self, file_path):
+        """
+        :return: (MirrorFile, None) if the local copy can be used, (None, stat_result of the original) if not
+        """
+        self._load_index()
+        now = time.time()
+
+        entry = self.entries.get(file_path)
+        local_path = self.get_cache_path(entry.local_name) if entry else ""
+        has_local_copy = bool(entry) and os.path.exists(local_path)
+
+        recently_validated = now - self.validated_times.get(file_path, 0) < self.validate_interval
+        if has_local_copy and (self.offline or recently_validated):
+            return self._use_entry(file_path, entry, now), None
+        if self.offline:
+            raise OSError(errno.ENOENT, "No local copy to use while offline", file_path)
+
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            if not has_local_copy:
+                raise
+            logging.warning("Can't reach {}, using the local copy".format(file_path))
+            return self._use_entry(file_path, entry, now), None
+
+        self.validated_times[file_path] = now
+        if has_local_copy and (entry.mtime, entry.size) == (stat_result.st_mtime, stat_result.st_size):
+            return self._use_entry(file_path, entry, now), None
+        return None, stat_result
+
+    def _use_entry(self, file_path, entry, now):
+        self.entries[file_path] = entry._replace(used_time=now)
+        self.index_dirty = True
+        return MirrorFile(self.get_cache_path(entry.local_name), entry.mtime, entry.size)
+
+    def _copy_file(self, file_path, stat_result):
+        local_name = get_local_name(file_path)
+        local_path = self.get_cache_path(local_name)
+        try:
+            if not os.path.exists(self.cache_folder):
+                os.makedirs(self.cache_folder)
+
+            temp_path = local_path + ".tmp"
+            shutil.copyfile(file_path, temp_path)
+            replace_file(temp_path, local_path)
+        except (IOError, OSError) as e:
+            logging.warning("Failed to copy {} to the local mirror: {}".format(file_path, e))
+            return MirrorFile(file_path, stat_result.st_mtime, stat_result.st_size)
+
+        with self.lock:
+            self._set_entry(file_path, MirrorEntry(local_name, stat_result.st_mtime, stat_result.st_size, time.time()))
+            if self.total_size > self.max_size:
+                self._evict_entries()
+        return MirrorFile(local_path, stat_result.st_mtime, stat_result.st_size)
+
+    def _set_entry(self, file_path, entry):
+        previous_entry = self.entries.get(file_path)
+        if previous_entry:
+            self.total_size -= previous_entry.size
+        self.entries[file_path] = entry
+        self.total_size += entry.size
+        self.index_dirty = True
+
+    def _evict_entries(self):
+        target_size = self.max_size * self.evict_ratio
+        for file_path in sorted(self.entries, key=lambda path: self.entries[path].used_time):
+            if self.total_size <= target_size:
+                break
+            if file_path in self.copy_events:
+                continue  # pinned, another thread is copying it right now
+
+            entry = self.entries.pop(file_path)
+            self.validated_times.pop(file_path, None)
+            self.total_size -= entry.size
+            try:
+                os.remove(self.get_cache_path(entry.local_name))
+            except OSError:
+                pass
+        self.index_dirty = True
+
+    def _load_index(self):
+        if self.entries is not None:
+            return
+
+        self.entries = {}
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with io.open(self.index_path, "r", encoding="utf-8") as fp:
+                data = json.load(fp)
+            self.entries = dict((file_path, MirrorEntry(*entry)) for file_path, entry in data.items())
+            self.total_size = sum(entry.size for entry in self.entries.values())
+        except (IOError, OSError, ValueError, TypeError) as e:
+            logging.warning("Failed to read the mirror index {}: {}".format(self.index_path, e))
+
+    def save_index(self):
+        with self.lock:
+            if self.entries is None:
+                return
+            try:
+                data = dict((file_path, list(entry)) for file_path, entry in self.entries.items())
+                write_file_atomic(self.index_path, json.dumps(data).encode("utf-8"))
+                self.index_dirty = False
+                self.index_save_time = time.time()
+            except (IOError, OSError) as e:
+                logging.warning("Failed to write the mirror index {}: {}".format(self.index_path, e))
+
+    def _save_index_if_due(self):
+        if self.index_dirty and time.time() - self.index_save_time > self.index_save_interval:
+            self.save_index()
+
+    def flush(self):
+        """
+        Save the new copies and last used times, call once a batch of reads is done
+        """
+        if self.index_dirty:
+            self.save_index()
+
+    def clear(self):
+        with self.lock:
+            self._load_index()
+            for file_path, entry in self.entries.items():
+                if file_path in self.copy_events:
+                    continue  # the copy in progress adds it again
+                try:
+                    os.remove(self.get_cache_path(entry.local_name))
+                except OSError:
+                    pass
+            self.entries = {}
+            self.total_size = 0
+            self.validated_times = {}
+            self.save_index()
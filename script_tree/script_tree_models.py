@@ -0,0 +1,257 @@
+import bisect
+
+from PySide2 import QtCore, QtGui, QtWidgets
+
+from . import script_tree_catalog
+from . import script_tree_telemetry
+
+
+class CatalogNode(object):
+    __slots__ = ("entry", "parent", "children", "row")
+
+    def __init__(self, entry, parent=None, row=0):
+        self.entry = entry  # index in the ScriptCatalog
+        self.parent = parent
+        self.children = []
+        self.row = row
+
+
+class ScriptCatalogModel(QtCore.QAbstractItemModel):
+    """
+    Tree model of a ScriptCatalog, the file system is only touched when the catalog is scanned
+    """
+
+    def __init__(self, parent=None):
+        super(ScriptCatalogModel, self).__init__(parent)
+        self.catalog = script_tree_catalog.ScriptCatalog("")
+        self.root_node = None
+        self.nodes = []
+        self.run_stats = {}  # full script path: RunStats
+
+        icon_provider = QtWidgets.QFileIconProvider()
+        self.folder_icon = icon_provider.icon(QtWidgets.QFileIconProvider.Folder)
+        self.file_icon = icon_provider.icon(QtWidgets.QFileIconProvider.File)
+
+    def set_catalog(self, catalog, run_stats=None):
+        """
+        :param catalog: ScriptCatalog
+        :param run_stats: dict of full script path: RunStats, shown in the second column
+        """
+        self.beginResetModel()
+        self.catalog = catalog
+        self.run_stats = run_stats or {}
+        self._build_nodes()
+        self.endResetModel()
+
+    def _build_nodes(self):
+        self.nodes = []
+        self.root_node = None
+        self._add_new_nodes()
+
+    def _add_new_nodes(self, on_new_child=None):
+        """
+        Create nodes for every catalog entry that doesn't have one yet.
+
+        :param on_new_child: called with (parent_node, node) for each new node that goes under an existing node,
+            after the whole new sub tree has been built. Appended directly to the parent if not defined.
+        """
+        first_new_entry = len(self.nodes)
+        new_children = []
+        for entry in range(first_new_entry, len(self.catalog)):
+            if self.catalog.is_deleted(entry):
+                self.nodes.append(None)
+                continue
+
+            parent_entry = self.catalog.parents[entry]
+            parent_node = self.nodes[parent_entry] if parent_entry >= 0 else None
+
+            node = CatalogNode(entry, parent_node)
+            self.nodes.append(node)
+
+            if parent_node is None:
+                self.root_node = node
+            elif on_new_child and parent_node.entry < first_new_entry:
+                new_children.append((parent_node, node))
+            else:
+                node.row = len(parent_node.children)
+                parent_node.children.append(node)
+
+        for parent_node, node in new_children:
+            on_new_child(parent_node, node)
+
+    def update_run_stats(self, script_path, run_stats):
+        self.run_stats[script_path] = run_stats
+
+        rel_path = self.catalog.get_rel_path(script_path)
+        if not rel_path:
+            return
+
+        self.update_entries([self.catalog.find_entry(rel_path)])
+
+    def update_entries(self, entries):
+        """
+        Redraw the rows of the given catalog entries, entries without a row are skipped
+        """
+        for entry in entries:
+            node = self.nodes[entry] if entry is not None and entry < len(self.nodes) else None
+            if node is not None:
+                self.dataChanged.emit(self.createIndex(node.row, 0, node), self.createIndex(node.row, 1, node))
+
+    def _index_from_node(self, node):
+        if node is None or node is self.root_node:
+            return QtCore.QModelIndex()
+        return self.createIndex(node.row, 0, node)
+
+    def _sort_key(self, node):
+        return not self.catalog.is_dir[node.entry], self.catalog.lower_names[node.entry]
+
+    def update_folder(self, folder_entry, removed_entries):
+        """
+        Sync the children of a single folder after ScriptCatalog.update_folder, the rest of the tree is untouched
+
+        :param folder_entry: catalog index of the folder that was updated
+        :param removed_entries: catalog indices that were removed from the folder
+        """
+        folder_node = self.nodes[folder_entry]
+        if folder_node is None:
+            return
+
+        folder_index = self._index_from_node(folder_node)
+
+        removed_entries = set(removed_entries)
+        for node in reversed(list(folder_node.children)):
+            if node.entry not in removed_entries:
+                continue
+
+            self.beginRemoveRows(folder_index, node.row, node.row)
+            folder_node.children.pop(node.row)
+            self._update_rows(folder_node, node.row)
+            self.endRemoveRows()
+
+        for entry in range(len(self.nodes)):
+            if self.nodes[entry] is not None and self.catalog.is_deleted(entry):
+                self.nodes[entry] = None
+
+        self._add_new_nodes(on_new_child=self._insert_child)
+
+    def _insert_child(self, parent_node, node):
+        keys = [self._sort_key(child) for child in parent_node.children]
+        row = bisect.bisect(keys, self._sort_key(node))
+
+        self.beginInsertRows(self._index_from_node(parent_node), row, row)
+        parent_node.children.insert(row, node)
+        self._update_rows(parent_node, row)
+        self.endInsertRows()
+
+    @staticmethod
+    def _update_rows(parent_node, first_row):
+        for row in range(first_row, len(parent_node.children)):
+            parent_node.children[row].row = row
+
+    def node_from_index(self, index):
+        if index.isValid():
+            return index.internalPointer()
+        return self.root_node
+
+    def file_path(self, index):
+        node = self.node_from_index(index)
+        if node is None:
+            return ""
+        return self.catalog.get_full_path(node.entry)
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        parent_node = self.node_from_index(parent)
+        if parent_node is None or row < 0 or row >= len(parent_node.children):
+            return QtCore.QModelIndex()
+        return self.createIndex(row, column, parent_node.children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+
+        return self._index_from_node(index.internalPointer().parent)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        node = self.node_from_index(parent)
+        return len(node.children) if node else 0
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 2
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        return self.rowCount(parent) > 0
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        entry = index.internalPointer().entry
+
+        if index.column() == 1:
+            if role == QtCore.Qt.DisplayRole and not self.catalog.is_dir[entry]:
+                run_stats = self.run_stats.get(self.catalog.get_full_path(entry))
+                if run_stats:
+                    return script_tree_telemetry.format_run_stats(run_stats)
+            if role == QtCore.Qt.ForegroundRole:
+                return QtWidgets.QApplication.palette().color(QtGui.QPalette.Disabled, QtGui.QPalette.Text)
+            return None
+
+        if role == QtCore.Qt.DisplayRole:
+            return self.catalog.names[entry]
+
+        if role == QtCore.Qt.ForegroundRole and self.catalog.rel_paths[entry] in self.catalog.duplicates:
+            return QtWidgets.QApplication.palette().color(QtGui.QPalette.Disabled, QtGui.QPalette.Text)
+
+        if role == QtCore.Qt.DecorationRole:
+            return self.folder_icon if self.catalog.is_dir[entry] else self.file_icon
+
+        if role == QtCore.Qt.ToolTipRole:
+            full_path = self.catalog.get_full_path(entry)
+            tool_tip = full_path
+
+            original_entry = self.catalog.find_entry(self.catalog.duplicates.get(self.catalog.rel_paths[entry]))
+            if original_entry is not None:
+                tool_tip += "\nSame contents as {}".format(self.catalog.get_full_path(original_entry))
+
+            run_stats = self.run_stats.get(full_path)
+            if run_stats:
+                tool_tip += "\n{} runs, {} failed, p50 {}, p95 {}".format(
+                    run_stats.run_count,
+                    run_stats.failure_count,
+                    script_tree_telemetry.format_duration(run_stats.p50),
+                    script_tree_telemetry.format_duration(run_stats.p95))
+            return tool_tip
+
+        return None
+
+
+class ScriptCatalogFilterModel(QtCore.QSortFilterProxyModel):
+    """
+    Only shows the catalog entries from the last filter pass, the filtering itself is done by ScriptCatalog.filter
+    """
+
+    def __init__(self, parent=None):
+        super(ScriptCatalogFilterModel, self).__init__(parent)
+        self.visible_entries = None
+
+    def set_visible_entries(self, visible_entries):
+        """
+        :param visible_entries: set of catalog entry indices, or None to show everything
+        """
+        self.visible_entries = visible_entries
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if self.visible_entries is None:
+            return True
+
+        source_model = self.sourceModel()  # type: ScriptCatalogModel
+        parent_node = source_model.node_from_index(source_parent)
+        if parent_node is None:
+            return False
+        return parent_node.children[source_row].entry in self.visible_entries
+
+    def file_path(self, index):
+        return self.sourceModel().file_path(self.mapToSource(index))
@@ -0,0 +1,245 @@
+import cProfile
+import collections
+import hashlib
+import io
+import logging
+import marshal
+import os
+import pstats
+import struct
+import sys
+import time
+import types
+
+from .script_tree_backup import replace_file
+
+if sys.version_info[0] >= 3:
+    from importlib.util import MAGIC_NUMBER
+else:
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
+
+process_time = getattr(time, "process_time", None) or time.clock
+
+HotFunction = collections.namedtuple("HotFunction", ["name", "file_path", "line_number", "call_count",
+                                                     "total_time", "cumulative_time"])
+
+# the magic number changes with the bytecode format, so cache files from other interpreters are never loaded
+CACHE_HEADER = struct.Struct("<4sdd")  # magic, mtime, size
+CACHE_FILE_EXTENSION = ".stc"
+
+
+def compile_file(file_path, source_path=None):
+    """
+    :param source_path: read the source from here instead, a local copy of file_path for example
+    """
+    with io.open(source_path or file_path, "rb") as fp:
+        source = fp.read()
+    return compile(source, file_path, "exec", dont_inherit=True)
+
+
+class CodeCache(object):
+    """
+    Compiled code objects of scripts, kept in memory and in a local cache folder.
+
+    Entries are keyed by path and validated by the mtime and size of the script,
+    so a repeated run costs a single stat when the script hasn't changed.
+    Both levels evict the least recently used scripts first.
+
+    With a ScriptMirror the mtime and size come from the mirror, and scripts are compiled from the local copy.
+    """
+
+    def __init__(self, cache_folder, max_memory_entries=64, max_disk_entries=1000, mirror=None):
+        self.cache_folder = cache_folder
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.mirror = mirror
+        self._memory_cache = collections.OrderedDict()  # file_path: (mtime, size, code)
+
+    def get_code(self, file_path):
+        if self.mirror:
+            source_path, mtime, size = self.mirror.get_file(file_path)
+        else:
+            stat_result = os.stat(file_path)
+            source_path, mtime, size = file_path, stat_result.st_mtime, stat_result.st_size
+
+        cached = self._memory_cache.pop(file_path, None)
+        if cached and cached[0] == mtime and cached[1] == size:
+            code = cached[2]
+        else:
+            code = self._load_from_disk(file_path, mtime, size)
+            if code is None:
+                code = compile_file(file_path, source_path)
+                self._save_to_disk(file_path, mtime, size, code)
+
+        # re-insert so the most recently used script is last
+        self._memory_cache[file_path] = (mtime, size, code)
+        while len(self._memory_cache) > self.max_memory_entries:
+            self._memory_cache.popitem(last=False)
+
+        return code
+
+    def clear(self):
+        self._memory_cache.clear()
+
+    def get_cache_path(self, file_path):
+        path_hash = hashlib.sha1(os.path.normcase(file_path).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_folder, path_hash + CACHE_FILE_EXTENSION)
+
+    def _load_from_disk(self, file_path, mtime, size):
+        cache_path = self.get_cache_path(file_path)
+        try:
+            with open(cache_path, "rb") as fp:
+                header = fp.read(CACHE_HEADER.size)
+                if len(header) != CACHE_HEADER.size or CACHE_HEADER.unpack(header) != (MAGIC_NUMBER, mtime, size):
+                    return None
+                code = marshal.loads(fp.read())
+            os.utime(cache_path, None)  # mark as recently used for the eviction
+            return code
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def _save_to_disk(self, file_path, mtime, size, code):
+        try:
+            if not os.path.exists(self.cache_folder):
+                os.makedirs(self.cache_folder)
+
+            cache_path = self.get_cache_path(file_path)
+            temp_path = cache_path + ".tmp"
+            with open(temp_path, "wb") as fp:
+                fp.write(CACHE_HEADER.pack(MAGIC_NUMBER, mtime, size))
+                fp.write(marshal.dumps(code))
+
+            replace_file(temp_path, cache_path)
+
+            self._evict_disk_entries()
+        except (IOError, OSError) as e:
+            logging.warning("Failed to write code cache for {}: {}".format(file_path, e))
+
+    def _evict_disk_entries(self):
+        cache_files = [os.path.join(self.cache_folder, file_name) for file_name in os.listdir(self.cache_folder)
+                       if file_name.endswith(CACHE_FILE_EXTENSION)]
+        if len(cache_files) <= self.max_disk_entries:
+            return
+
+        cache_files.sort(key=os.path.getmtime)
+        for cache_path in cache_files[:len(cache_files) - self.max_disk_entries]:
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+
+
+def run_path(file_path, init_globals=None, run_name="__main__", code_cache=None):
+    """
+    Same as runpy.run_path for a python file, but takes the compiled code from code_cache if there is one
+
+    :param file_path:
+    :param init_globals: dict of globals the script starts with
+    :param run_name: __name__ of the script
+    :param code_cache: CodeCache
+    :return: dict of the globals after the script has run
+    """
+    code = code_cache.get_code(file_path) if code_cache else compile_file(file_path)
+
+    module = types.ModuleType(run_name)
+    module_globals = module.__dict__
+    if init_globals is not None:
+        module_globals.update(init_globals)
+    module_globals.update(__name__=run_name,
+                          __file__=file_path,
+                          __cached__=None,
+                          __doc__=None,
+                          __loader__=None,
+                          __package__=None,
+                          __spec__=None)
+
+    # like runpy, the script is the __main__ module while it runs
+    previous_module = sys.modules.get(run_name)
+    previous_argv = sys.argv[0] if sys.argv else None
+    sys.modules[run_name] = module
+    if sys.argv:
+        sys.argv[0] = file_path
+
+    try:
+        exec(code, module_globals)
+    finally:
+        if previous_module is not None:
+            sys.modules[run_name] = previous_module
+        else:
+            sys.modules.pop(run_name, None)
+        if sys.argv:
+            sys.argv[0] = previous_argv
+
+    return module_globals.copy()
+
+
+class ProfiledRun(object):
+    """
+    Result of profile_path
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.profile = cProfile.Profile()
+        self.prof_path = ""
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.exception = None
+
+    @classmethod
+    def load(cls, file_path, prof_path):
+        """
+        ProfiledRun of a saved .prof file, which only has the total profiled time, cpu_time is None
+        """
+        profiled_run = cls(file_path)
+        profiled_run.profile = None
+        profiled_run.prof_path = prof_path
+        profiled_run.wall_time = pstats.Stats(prof_path).total_tt
+        profiled_run.cpu_time = None
+        return profiled_run
+
+    def get_hot_functions(self, count=30, sort_by="tottime"):
+        """
+        :param count: max number of functions
+        :param sort_by: "tottime" for time spent in the function itself, "cumtime" to include what it calls
+        :return: list of HotFunction, slowest first
+        """
+        stats = pstats.Stats(self.profile or self.prof_path).stats
+        hot_functions = []
+        for (function_file, line_number, function_name), (_, call_count, total_time, cumulative_time, _) in stats.items():
+            hot_functions.append(HotFunction(function_name, function_file, line_number, call_count,
+                                             total_time, cumulative_time))
+
+        sort_index = 5 if sort_by == "cumtime" else 4
+        hot_functions.sort(key=lambda hot_function: hot_function[sort_index], reverse=True)
+        return hot_functions[:count]
+
+    def save(self, prof_path):
+        prof_folder = os.path.dirname(prof_path)
+        if not os.path.exists(prof_folder):
+            os.makedirs(prof_folder)
+        self.profile.dump_stats(prof_path)
+
+
+def profile_path(file_path, init_globals=None, run_name="__main__", code_cache=None):
+    """
+    run_path under cProfile, exceptions from the script are stored on the result instead of raised
+
+    :return: ProfiledRun
+    """
+    profiled_run = ProfiledRun(file_path)
+
+    start_wall_time = time.time()
+    start_cpu_time = process_time()
+    profiled_run.profile.enable()
+    try:
+        run_path(file_path, init_globals=init_globals, run_name=run_name, code_cache=code_cache)
+    except Exception as e:
+        profiled_run.exception = e
+    finally:
+        profiled_run.profile.disable()
+        profiled_run.wall_time = time.time() - start_wall_time
+        profiled_run.cpu_time = process_time() - start_cpu_time
+
+    return profiled_run
@@ -0,0 +1,558 @@
+import bisect
+import collections
+import hashlib
+import io
+import logging
+import mmap
+import multiprocessing
+import os
+import pickle
+import re
+import sys
+import threading
+import time
+
+from .script_tree_backup import replace_file
+
+SCRIPT_EXTENSIONS = (".py", ".mel")
+
+DEFAULT_MAX_FILE_SIZE = 2 * 1024 * 1024
+BINARY_CHECK_SIZE = 8192
+MMAP_THRESHOLD = 256 * 1024
+
+FILES_PER_CHUNK = 64
+MIN_FILES_FOR_POOL = 512  # starting the processes costs more than scanning fewer files than this
+
+INDEX_VERSION = 1
+
+token_pattern = re.compile(r"\w+")
+
+SearchMatch = collections.namedtuple("SearchMatch", ["file_path", "line_number", "line_text"])
+
+
+def iter_script_files(root_folder, extensions=SCRIPT_EXTENSIONS):
+    """
+    Walk root_folder and yield (file_path, mtime, size) for every script file
+
+    :param root_folder:
+    :param extensions:
+    :return:
+    """
+    for dir_path, dir_names, file_names in os.walk(root_folder):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if not file_name.lower().endswith(extensions):
+                continue
+
+            file_path = os.path.join(dir_path, file_name).replace("\\", "/")
+            try:
+                stat_result = os.stat(file_path)
+            except OSError:
+                continue
+
+            yield file_path, stat_result.st_mtime, stat_result.st_size
+
+
+def read_script_text(file_path):
+    with io.open(file_path, "rb") as fp:
+        data = fp.read()
+    return data.decode("utf-8", "replace")
+
+
+def get_tokens(text):
+    return set(token_pattern.findall(text.lower()))
+
+
+class ContentMatcher(object):
+    """
+    Finds the lines in a file that match a literal string or a regular expression.
+
+    Matching is done on raw bytes so files don't have to be decoded unless they contain a match.
+    Case insensitive literal search is the exception, it decodes and lowercases the text the same way
+    SearchIndex tokenizes it, so non-ASCII text matches whatever the index returns.
+    Only holds plain values until it's used, so it can be sent to the scanner processes.
+    """
+
+    def __init__(self, search_string, use_regex=False, case_sensitive=False):
+        self.search_string = search_string
+        self.use_regex = use_regex
+        self.case_sensitive = case_sensitive
+        self._pattern = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pattern"] = None  # compiled regex objects aren't always picklable
+        return state
+
+    @property
+    def pattern(self):
+        if self._pattern is None:
+            if self.needs_copy():
+                self._pattern = self.search_string.lower()
+            elif self.use_regex:
+                flags = re.MULTILINE if self.case_sensitive else re.MULTILINE | re.IGNORECASE
+                self._pattern = re.compile(self.search_string.encode("utf-8"), flags)
+            else:
+                self._pattern = self.search_string.encode("utf-8")
+        return self._pattern
+
+    def needs_copy(self):
+        """ case insensitive literal search has to decode and lowercase the whole file first """
+        return not self.use_regex and not self.case_sensitive
+
+    def find(self, data, position):
+        """
+        :return: start index of the next match from position, or -1 if there are no more matches
+        """
+        if self.use_regex:
+            match = self.pattern.search(data, position)
+            return match.start() if match else -1
+        return data.find(self.pattern, position)
+
+    def find_lines(self, file_path, data):
+        """
+        Yield a SearchMatch for every line in data that matches, each line is only yielded once
+        """
+        lines = None
+        if self.needs_copy():
+            text = data.decode("utf-8", "replace")
+            haystack = text.lower()
+            newline = u"\n"
+        else:
+            haystack = data
+            newline = b"\n"
+
+        line_number = 1
+        counted_to = 0
+        position = self.find(haystack, 0)
+        while position != -1:
+            line_start = haystack.rfind(newline, 0, position) + 1
+            line_end = haystack.find(newline, position)
+            if line_end == -1:
+                line_end = len(haystack)
+
+            line_number += haystack[counted_to:line_start].count(newline)
+            counted_to = line_start
+
+            if haystack is data:
+                line_text = data[line_start:line_end].decode("utf-8", "replace")
+            else:
+                # lowercasing can change the length of some characters, take the line from the original text
+                if lines is None:
+                    lines = text.split(u"\n")
+                line_text = lines[line_number - 1]
+            yield SearchMatch(file_path, line_number, line_text.strip())
+
+            if line_end >= len(haystack):
+                break
+            position = self.find(haystack, line_end + 1)
+
+
+def search_file(file_path, matcher, max_file_size=DEFAULT_MAX_FILE_SIZE, read_path=None):
+    """
+    Search a single file, skipping files that are empty, too big or look like binaries
+
+    :param file_path:
+    :param matcher: ContentMatcher
+    :param max_file_size: in bytes
+    :param read_path: read the file from here instead, a local copy of file_path for example
+    :return: list of SearchMatch
+    """
+    read_path = read_path or file_path
+    try:
+        file_size = os.path.getsize(read_path)
+        if not file_size or file_size > max_file_size:
+            return []
+
+        with io.open(read_path, "rb") as fp:
+            if file_size > MMAP_THRESHOLD and not matcher.needs_copy():
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = fp.read()
+
+            try:
+                if b"\0" in data[:BINARY_CHECK_SIZE]:
+                    return []
+                return list(matcher.find_lines(file_path, data))
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+
+    except (IOError, OSError, ValueError) as e:
+        logging.warning("Failed to read {}: {}".format(file_path, e))
+        return []
+
+
+def _scan_chunk(args):
+    """ Runs in the scanner processes, has to be a top level function so it can be pickled """
+    file_paths, matcher, max_file_size, read_paths = args
+
+    chunk_matches = []
+    for file_path, read_path in zip(file_paths, read_paths):
+        chunk_matches.extend(search_file(file_path, matcher, max_file_size, read_path))
+    return chunk_matches
+
+
+def get_pool_executable():
+    """
+    Get a python interpreter that can run the scanner processes.
+
+    Inside Maya sys.executable is maya.exe, which would launch a whole new Maya, so use mayapy instead.
+    """
+    executable_name = os.path.basename(sys.executable).lower()
+    if executable_name.startswith("python"):
+        return sys.executable
+
+    if executable_name in ("maya.exe", "maya.bin", "maya"):
+        mayapy_name = "mayapy.exe" if executable_name.endswith(".exe") else "mayapy"
+        mayapy_path = os.path.join(os.path.dirname(sys.executable), mayapy_name)
+        if os.path.exists(mayapy_path):
+            return mayapy_path
+
+    return None
+
+
+def create_process_pool(processes=None):
+    executable = get_pool_executable()
+    if executable is None:
+        return None
+
+    try:
+        if hasattr(multiprocessing, "get_context"):
+            # don't fork, that would copy the whole DCC session into every process
+            context = multiprocessing.get_context("spawn")
+        else:
+            context = multiprocessing
+        context.set_executable(executable)
+        return context.Pool(processes)
+
+    except Exception as e:
+        logging.warning("Failed to start search processes, searching in a single thread: {}".format(e))
+        return None
+
+
+def scan_files(file_paths, matcher, max_file_size=DEFAULT_MAX_FILE_SIZE, processes=None, is_cancelled=None,
+               get_read_path=None):
+    """
+    Search file_paths with matcher, split across a process pool when there's enough files to make it worth it.
+
+    Matches are yielded in the same order as file_paths.
+
+    :param file_paths: list of file paths
+    :param matcher: ContentMatcher
+    :param max_file_size: in bytes, bigger files are skipped
+    :param processes: number of scanner processes, defaults to the cpu count
+    :param is_cancelled: optional function, the scan stops early if it returns True
+    :param get_read_path: optional function that gives the path to read a file from, ScriptMirror.get_local_path
+        for example. Called here and not in the scanner processes.
+    :return: generator of SearchMatch
+    """
+    matcher.pattern  # compile now so bad regexes are raised here and not in the scanner processes
+
+    # a generator, so local copies are made while the earlier chunks are already being searched
+    chunk_args = (get_chunk_args(file_paths[i:i + FILES_PER_CHUNK], matcher, max_file_size, get_read_path)
+                  for i in range(0, len(file_paths), FILES_PER_CHUNK))
+
+    pool = create_process_pool(processes) if len(file_paths) >= MIN_FILES_FOR_POOL else None
+    if pool:
+        chunk_results = pool.imap(_scan_chunk, chunk_args)  # imap keeps the results in file order
+    else:
+        chunk_results = (_scan_chunk(args) for args in chunk_args)
+
+    try:
+        for chunk_matches in chunk_results:
+            if is_cancelled and is_cancelled():
+                break
+
+            for match in chunk_matches:
+                yield match
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+def get_chunk_args(file_paths, matcher, max_file_size, get_read_path=None):
+    read_paths = []
+    for file_path in file_paths:
+        try:
+            read_paths.append(get_read_path(file_path) if get_read_path else None)
+        except (IOError, OSError):
+            read_paths.append(None)
+    return file_paths, matcher, max_file_size, read_paths
+
+
+def scan_folder(root_folder, matcher, **kwargs):
+    """
+    Brute force search of every script in root_folder, used when there's no index to lean on
+    """
+    file_paths = [file_path for file_path, _, _ in iter_script_files(root_folder)]
+    return scan_files(file_paths, matcher, **kwargs)
+
+
+class SearchIndex(object):
+    """
+    Token based inverted index of every script in a folder, saved to disk between sessions.
+
+    The index only narrows down which files can contain the search string,
+    the candidate files are still read to get the matching lines.
+    update_files re-indexes the files whose mtime or size differ from the given file states,
+    so keeping it current doesn't need its own walk of the folder.
+    """
+
+    def __init__(self, root_folder, index_folder):
+        self.root_folder = root_folder.replace("\\", "/")
+        self.index_folder = index_folder
+
+        root_hash = hashlib.md5(self.root_folder.lower().encode("utf-8")).hexdigest()[:12]
+        self.index_path = os.path.join(index_folder, "search_index_{}.pickle".format(root_hash))
+
+        self.refresh_time = 0.0
+        self.files = {}  # file_path: (mtime, size, token_ids)
+        self.vocabulary = []  # token_id: token
+        self.token_ids = {}  # token: token_id
+        self.postings = {}  # token_id: set(file_path), only tokens that are in a file
+        self.sorted_tokens = {}  # reversed: (sorted tokens, their token_ids), built when first needed
+
+        self.lock = threading.RLock()  # held while a search updates or queries the index
+        self.synced = False  # compared against the file system since it was loaded
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return False
+
+        try:
+            with open(self.index_path, "rb") as fp:
+                data = pickle.load(fp)
+        except Exception as e:
+            logging.warning("Failed to load search index {}: {}".format(self.index_path, e))
+            return False
+
+        if data.get("version") != INDEX_VERSION or data.get("root_folder") != self.root_folder:
+            return False
+
+        self.refresh_time = data.get("refresh_time", 0.0)
+        self.files = data.get("files", {})
+        self.vocabulary = data.get("vocabulary", [])
+        self.token_ids = dict((token, token_id) for token_id, token in enumerate(self.vocabulary))
+        self.sorted_tokens = {}
+
+        self.postings = {}
+        for file_path, (_, _, file_token_ids) in self.files.items():
+            for token_id in file_token_ids:
+                self.postings.setdefault(token_id, set()).add(file_path)
+
+        self._prune_vocabulary()  # indexes saved before the vocabulary was pruned
+        return True
+
+    def save(self):
+        if not os.path.exists(self.index_folder):
+            os.makedirs(self.index_folder)
+
+        data = {
+            "version": INDEX_VERSION,
+            "root_folder": self.root_folder,
+            "refresh_time": self.refresh_time,
+            "files": self.files,
+            "vocabulary": self.vocabulary,
+        }
+
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "wb") as fp:
+            pickle.dump(data, fp, protocol=2)
+
+        replace_file(temp_path, self.index_path)
+
+    def refresh(self, is_cancelled=None, get_read_path=None):
+        """
+        Walk the folder and re-index every file where the mtime or size changed,
+        only needed when there's no catalog to take the file states from
+
+        :param is_cancelled: optional function, the refresh stops early if it returns True
+        :param get_read_path: optional function that gives the path to read a file from
+        :return: (updated file count, removed file count)
+        """
+        file_states = {}
+        for file_path, mtime, size in iter_script_files(self.root_folder):
+            if is_cancelled and is_cancelled():
+                return 0, 0
+            file_states[file_path] = (mtime, size)
+
+        return self.update_files(file_states, is_cancelled=is_cancelled, get_read_path=get_read_path)
+
+    def update_files(self, file_states, is_cancelled=None, get_read_path=None):
+        """
+        Re-index every file where the mtime or size differs from what's stored in the index,
+        and drop the files that aren't in file_states anymore
+
+        :param file_states: dict of file_path: (mtime, size) of every script in the folder,
+            from ScriptCatalog.get_script_states for example
+        :param is_cancelled: optional function, the update stops early if it returns True
+        :param get_read_path: optional function that gives the path to read a file from
+        :return: (updated file count, removed file count)
+        """
+        updated_count = 0
+        for file_path, (mtime, size) in file_states.items():
+            if is_cancelled and is_cancelled():
+                return updated_count, 0
+
+            indexed_file = self.files.get(file_path)
+            if indexed_file and indexed_file[0] == mtime and indexed_file[1] == size:
+                continue
+
+            try:
+                text = read_script_text(get_read_path(file_path) if get_read_path else file_path)
+            except (IOError, OSError):
+                continue
+
+            self._remove_file(file_path)
+            self._add_file(file_path, mtime, size, get_tokens(text))
+            updated_count += 1
+
+        removed_files = [file_path for file_path in self.files if file_path not in file_states]
+        for file_path in removed_files:
+            self._remove_file(file_path)
+
+        if updated_count or removed_files:
+            self._prune_vocabulary()
+
+        self.refresh_time = time.time()
+        self.synced = True
+        return updated_count, len(removed_files)
+
+    def _add_file(self, file_path, mtime, size, tokens):
+        file_token_ids = []
+        for token in tokens:
+            token_id = self.token_ids.get(token)
+            if token_id is None:
+                token_id = len(self.vocabulary)
+                self.vocabulary.append(token)
+                self.token_ids[token] = token_id
+                self.sorted_tokens = {}
+
+            file_token_ids.append(token_id)
+            self.postings.setdefault(token_id, set()).add(file_path)
+
+        self.files[file_path] = (mtime, size, file_token_ids)
+
+    def _remove_file(self, file_path):
+        indexed_file = self.files.pop(file_path, None)
+        if not indexed_file:
+            return
+
+        for token_id in indexed_file[2]:
+            token_files = self.postings.get(token_id)
+            if token_files:
+                token_files.discard(file_path)
+                if not token_files:
+                    del self.postings[token_id]
+
+    def _prune_vocabulary(self):
+        """
+        Drop the tokens no file contains anymore and renumber the rest, so the vocabulary doesn't keep growing
+        """
+        if len(self.postings) == len(self.vocabulary):
+            return
+
+        kept_token_ids = sorted(self.postings)
+        new_token_ids = dict((token_id, new_token_id) for new_token_id, token_id in enumerate(kept_token_ids))
+
+        self.vocabulary = [self.vocabulary[token_id] for token_id in kept_token_ids]
+        self.token_ids = dict((token, token_id) for token_id, token in enumerate(self.vocabulary))
+        self.postings = dict((new_token_ids[token_id], token_files) for token_id, token_files in self.postings.items())
+        self.files = dict((file_path, (mtime, size, [new_token_ids[token_id] for token_id in file_token_ids]))
+                          for file_path, (mtime, size, file_token_ids) in self.files.items())
+        self.sorted_tokens = {}
+
+    def _files_for_token(self, token_id):
+        return self.postings.get(token_id, set())
+
+    def _token_ids_with_prefix(self, prefix, reverse=False):
+        """
+        Get the ids of the tokens that start with prefix, or end with it if reverse is set and prefix is reversed
+        """
+        sorted_tokens = self.sorted_tokens.get(reverse)
+        if sorted_tokens is None:
+            token_pairs = sorted((token[::-1] if reverse else token, token_id)
+                                 for token_id, token in enumerate(self.vocabulary))
+            sorted_tokens = ([token for token, _ in token_pairs], [token_id for _, token_id in token_pairs])
+            self.sorted_tokens[reverse] = sorted_tokens
+
+        tokens, token_ids = sorted_tokens
+        start = bisect.bisect_left(tokens, prefix)
+        end = start
+        while end < len(tokens) and tokens[end].startswith(prefix):
+            end += 1
+        return token_ids[start:end]
+
+    def candidates(self, search_string):
+        """
+        Get the files that could contain search_string, in sorted order.
+
+        Every word in the middle of the search string has to exist as a full token in the file.
+        The first and last words may be cut off, so those are matched against part of a token.
+        """
+        query_tokens = token_pattern.findall(search_string.lower())
+        if not query_tokens:
+            return sorted(self.files)
+
+        # figure out if the words at the edges of the search string are complete
+        search_lower = search_string.lower()
+        starts_with_word = bool(token_pattern.match(search_lower))
+        ends_with_word = bool(re.search(r"\w$", search_lower))
+
+        candidate_files = None
+        for i, query_token in enumerate(query_tokens):
+            open_start = i == 0 and starts_with_word
+            open_end = i == len(query_tokens) - 1 and ends_with_word
+
+            if not open_start and not open_end:
+                token_id = self.token_ids.get(query_token)
+                token_files = self._files_for_token(token_id) if token_id is not None else set()
+            else:
+                if open_start and open_end:
+                    matching_token_ids = [token_id for token_id, token in enumerate(self.vocabulary)
+                                          if query_token in token]
+                elif open_start:
+                    matching_token_ids = self._token_ids_with_prefix(query_token[::-1], reverse=True)
+                else:
+                    matching_token_ids = self._token_ids_with_prefix(query_token)
+
+                token_files = set()
+                for token_id in matching_token_ids:
+                    token_files.update(self._files_for_token(token_id))
+
+            if candidate_files is None:
+                candidate_files = set(token_files)
+            else:
+                candidate_files &= token_files
+
+            if not candidate_files:
+                break
+
+        return sorted(candidate_files)
+
+    def search(self, search_string, case_sensitive=False, **kwargs):
+        """
+        Search the files the index says could contain search_string, kwargs are passed on to scan_files
+        """
+        matcher = ContentMatcher(search_string, case_sensitive=case_sensitive)
+        return scan_files(self.candidates(search_string), matcher, **kwargs)
+
+
+search_indexes = {}  # (root_folder, index_folder): SearchIndex
+search_indexes_lock = threading.Lock()
+
+
+def get_search_index(root_folder, index_folder):
+    """
+    Get the index of root_folder, loaded from disk on first use and kept in memory for the searches after that
+    """
+    key = (root_folder.replace("\\", "/"), index_folder)
+    with search_indexes_lock:
+        search_index = search_indexes.get(key)
+        if search_index is None:
+            search_index = SearchIndex(root_folder, index_folder)
+            search_index.load()
+            search_indexes[key] = search_index
+        return search_index
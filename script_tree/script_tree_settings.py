@@ -0,0 +1,209 @@
+import copy
+import io
+import json
+import logging
+import os
+import re
+import sys
+import threading
+
+if sys.version_info[0] >= 3:
+    basestring = str
+
+from .script_tree_backup import write_file_atomic
+
+SIDECAR_FOLDER_SUFFIX = "_data"
+
+
+def convert_value(value, value_type):
+    """
+    Cast a stored value like QSettings.value(key, type=...) does, values migrated from the INI file are all strings
+    """
+    if value is None or value_type is None or isinstance(value, value_type):
+        return value
+    if value_type is bool and isinstance(value, basestring):
+        return value.lower() in ("true", "1", "yes")
+    return value_type(value)
+
+
+def get_sidecar_file_name(key):
+    return re.sub(r"[^\w.-]", "_", key) + ".json"
+
+
+class SettingsFile(object):
+    """
+    Settings of one json file, shared by every SettingsStore using the same path.
+
+    Values live in memory, changes are written after write_delay seconds so a burst of changes is one write.
+    Sidecar keys are kept in their own file next to the main one, so big values (recent files, sessions, stats)
+    are only read when they're first used and only rewritten when they change.
+    Values are copied going in and out, so callers changing their dicts and lists in place
+    never race with the write on the timer thread.
+    """
+
+    def __init__(self, file_path, sidecar_keys=(), write_delay=2.0):
+        self.file_path = file_path
+        self.sidecar_folder = os.path.splitext(file_path)[0] + SIDECAR_FOLDER_SUFFIX
+        self.sidecar_keys = set(sidecar_keys)
+        self.write_delay = write_delay
+        self.lock = threading.RLock()
+
+        self.values = self.read_json(file_path, {})
+        self.sidecar_values = {}
+        self.main_dirty = False
+        self.dirty_sidecar_keys = set()
+        self.write_timer = None  # type: threading.Timer
+
+    @staticmethod
+    def read_json(file_path, default):
+        if not os.path.exists(file_path):
+            return default
+        try:
+            with io.open(file_path, "r", encoding="utf-8") as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning("Failed to read settings {}: {}".format(file_path, e))
+            return default
+
+    def get_sidecar_path(self, key):
+        return os.path.join(self.sidecar_folder, get_sidecar_file_name(key))
+
+    def exists(self):
+        return os.path.exists(self.file_path)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.sidecar_keys:
+                return copy.deepcopy(self.values.get(key, default))
+
+            if key not in self.sidecar_values:
+                self.sidecar_values[key] = self.read_json(self.get_sidecar_path(key), {}).get("value")
+            value = self.sidecar_values[key]
+            return default if value is None else copy.deepcopy(value)
+
+    def set(self, key, value):
+        value = copy.deepcopy(value)
+        with self.lock:
+            if key in self.sidecar_keys:
+                self.sidecar_values[key] = value
+                self.dirty_sidecar_keys.add(key)
+            else:
+                self.values[key] = value
+                self.main_dirty = True
+            self.schedule_write()
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.sidecar_keys:
+                self.set(key, None)
+            elif key in self.values:
+                del self.values[key]
+                self.main_dirty = True
+                self.schedule_write()
+
+    def keys(self):
+        with self.lock:
+            return sorted(set(self.values) | set(key for key in self.sidecar_keys if self.get(key) is not None))
+
+    def schedule_write(self):
+        if self.write_timer is not None:
+            return
+        self.write_timer = threading.Timer(self.write_delay, self.flush)
+        self.write_timer.daemon = True
+        self.write_timer.start()
+
+    def flush(self):
+        """
+        Write whatever changed since the last write
+        """
+        with self.lock:
+            if self.write_timer is not None:
+                self.write_timer.cancel()
+                self.write_timer = None
+
+            # a value that can't be serialized is dropped, a write that failed is tried again with the next change
+            for key in sorted(self.dirty_sidecar_keys):
+                try:
+                    self.write_json(self.get_sidecar_path(key), {"value": self.sidecar_values.get(key)})
+                except (IOError, OSError) as e:
+                    logging.warning("Failed to write setting {} of {}: {}".format(key, self.file_path, e))
+                    continue
+                except (TypeError, ValueError) as e:
+                    logging.warning("Can't save setting {} of {}: {}".format(key, self.file_path, e))
+                self.dirty_sidecar_keys.discard(key)
+
+            if self.main_dirty:
+                try:
+                    self.write_json(self.file_path, self.values)
+                    self.main_dirty = False
+                except (IOError, OSError) as e:
+                    logging.warning("Failed to write settings {}: {}".format(self.file_path, e))
+                except (TypeError, ValueError) as e:
+                    logging.warning("Can't save settings {}: {}".format(self.file_path, e))
+                    self.main_dirty = False
+
+    @staticmethod
+    def write_json(file_path, data):
+        write_file_atomic(file_path, json.dumps(data, indent=1, sort_keys=True).encode("utf-8"))
+
+
+settings_files = {}  # file path: SettingsFile
+settings_files_lock = threading.Lock()
+
+
+def get_settings_file(file_path, sidecar_keys=(), write_delay=2.0):
+    with settings_files_lock:
+        settings_file = settings_files.get(file_path)
+        if settings_file is None:
+            settings_file = SettingsFile(file_path, sidecar_keys=sidecar_keys, write_delay=write_delay)
+            settings_files[file_path] = settings_file
+        return settings_file
+
+
+def flush_all():
+    with settings_files_lock:
+        for settings_file in settings_files.values():
+            settings_file.flush()
+
+
+class SettingsStore(object):
+    """
+    Drop in for the parts of QSettings ScriptTree uses, backed by a cached SettingsFile instead of
+    parsing the INI file on every access. Every store of the same path shares one SettingsFile.
+    """
+
+    def __init__(self, file_path, sidecar_keys=(), write_delay=2.0):
+        self.settings_file = get_settings_file(file_path, sidecar_keys=sidecar_keys, write_delay=write_delay)
+
+    def value(self, key, defaultValue=None, type=None):
+        return convert_value(self.settings_file.get(key, defaultValue), type)
+
+    def setValue(self, key, value):
+        self.settings_file.set(key, value)
+
+    def remove(self, key):
+        self.settings_file.remove(key)
+
+    def contains(self, key):
+        return self.settings_file.get(key) is not None
+
+    def allKeys(self):
+        return self.settings_file.keys()
+
+    def sync(self):
+        self.settings_file.flush()
+
+    def fileName(self):
+        return self.settings_file.file_path
+
+    def get_json_value(self, key, default=None):
+        value = self.settings_file.get(key)
+        if isinstance(value, basestring):  # json string from before the settings were stored as json
+            try:
+                value = json.loads(value)
+            except ValueError:
+                value = None
+        return default if value is None else value
+
+    def set_json_value(self, key, value):
+        self.settings_file.set(key, value)
@@ -0,0 +1,158 @@
+import collections
+import logging
+import os
+import sqlite3
+import time
+
+RunStats = collections.namedtuple("RunStats", ["run_count", "failure_count", "p50", "p95", "last_run_time"])
+RunRecord = collections.namedtuple("RunRecord", ["script_path", "start_time", "duration", "success", "error"])
+
+
+def get_percentile(sorted_values, percentile):
+    """
+    Nearest rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    rank = int(round(percentile / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def format_duration(seconds):
+    if seconds < 1.0:
+        return "{:.0f}ms".format(seconds * 1000)
+    if seconds < 60.0:
+        return "{:.1f}s".format(seconds)
+    return "{:.0f}m{:02.0f}s".format(seconds // 60, seconds % 60)
+
+
+def format_run_stats(run_stats):
+    return "{}x  p50 {}  p95 {}".format(run_stats.run_count,
+                                        format_duration(run_stats.p50),
+                                        format_duration(run_stats.p95))
+
+
+class RunTelemetry(object):
+    """
+    Duration and outcome of every script run, stored in a local SQLite database.
+
+    Only the most recent max_runs_per_script runs are kept for each script.
+    """
+
+    def __init__(self, db_path, max_runs_per_script=500):
+        self.db_path = db_path
+        self.max_runs_per_script = max_runs_per_script
+        self._connection = None
+        self.disabled = False  # set when the database can't be opened, telemetry is off for the rest of the session
+
+    @property
+    def connection(self):
+        """
+        :raises sqlite3.Error: if the database can't be opened, so callers only have to handle sqlite3 errors
+        """
+        if self.disabled:
+            raise sqlite3.OperationalError("run telemetry is disabled")
+
+        if self._connection is None:
+            try:
+                self._connection = self._connect()
+            except (OSError, sqlite3.Error) as e:
+                self.disabled = True
+                logging.warning("Failed to open the run telemetry database {}, "
+                                "run times won't be recorded: {}".format(self.db_path, e))
+                raise sqlite3.OperationalError(str(e))
+        return self._connection
+
+    def _connect(self):
+        db_folder = os.path.dirname(self.db_path)
+        if db_folder and not os.path.exists(db_folder):
+            os.makedirs(db_folder)
+
+        connection = sqlite3.connect(self.db_path)
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS runs ("
+                               "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "script_path TEXT NOT NULL, "
+                               "start_time REAL NOT NULL, "
+                               "duration REAL NOT NULL, "
+                               "success INTEGER NOT NULL, "
+                               "error TEXT)")
+            connection.execute("CREATE INDEX IF NOT EXISTS runs_script_path ON runs (script_path, id)")
+            connection.commit()
+        except sqlite3.Error:
+            connection.close()
+            raise
+        return connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def record_run(self, script_path, duration, success=True, error="", start_time=None):
+        if start_time is None:
+            start_time = time.time() - duration
+
+        try:
+            with self.connection:
+                self.connection.execute("INSERT INTO runs (script_path, start_time, duration, success, error) "
+                                        "VALUES (?, ?, ?, ?, ?)",
+                                        (script_path, start_time, duration, int(bool(success)), error or ""))
+                self.connection.execute("DELETE FROM runs WHERE script_path = ? AND id NOT IN "
+                                        "(SELECT id FROM runs WHERE script_path = ? ORDER BY id DESC LIMIT ?)",
+                                        (script_path, script_path, self.max_runs_per_script))
+        except sqlite3.Error as e:
+            if not self.disabled:  # already reported when it was disabled
+                logging.warning("Failed to record script run: {}".format(e))
+
+    def get_recent_runs(self, script_path, limit=10):
+        """
+        :return: list of RunRecord, newest first
+        """
+        try:
+            rows = self.connection.execute("SELECT script_path, start_time, duration, success, error FROM runs "
+                                           "WHERE script_path = ? ORDER BY id DESC LIMIT ?",
+                                           (script_path, limit)).fetchall()
+        except sqlite3.Error as e:
+            if not self.disabled:  # already reported when it was disabled
+                logging.warning("Failed to read script runs: {}".format(e))
+            return []
+        return [RunRecord(row[0], row[1], row[2], bool(row[3]), row[4]) for row in rows]
+
+    def get_stats(self, script_path):
+        return self.get_folder_stats(script_path, exact_path=True).get(script_path)
+
+    def get_folder_stats(self, folder_path, exact_path=False):
+        """
+        Run statistics of every script under folder_path, in a single query
+
+        :return: dict of script_path: RunStats
+        """
+        if exact_path:
+            query, args = "WHERE script_path = ?", (folder_path,)
+        else:
+            # escape the LIKE wildcards that can show up in folder names
+            like_path = folder_path.rstrip("/").replace("!", "!!").replace("%", "!%").replace("_", "!_") + "/%"
+            query, args = "WHERE script_path LIKE ? ESCAPE '!'", (like_path,)
+
+        try:
+            rows = self.connection.execute("SELECT script_path, start_time, duration, success FROM runs " + query,
+                                           args).fetchall()
+        except sqlite3.Error as e:
+            if not self.disabled:  # already reported when it was disabled
+                logging.warning("Failed to read script runs: {}".format(e))
+            return {}
+
+        runs_per_script = collections.defaultdict(list)
+        for row in rows:
+            runs_per_script[row[0]].append(row[1:])
+
+        folder_stats = {}
+        for script_path, runs in runs_per_script.items():
+            durations = sorted(run[1] for run in runs)
+            folder_stats[script_path] = RunStats(run_count=len(runs),
+                                                 failure_count=sum(1 for run in runs if not run[2]),
+                                                 p50=get_percentile(durations, 50),
+                                                 p95=get_percentile(durations, 95),
+                                                 last_run_time=max(run[0] for run in runs))
+        return folder_stats
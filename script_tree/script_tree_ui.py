@@ -2,27 +2,38 @@ __author__ = "Richard Brenick - RichardBrenick@gmail.com"
 __created__ = "2020-09-26"
 __modified__ = "2020-09-26"
 
+import collections
 import logging
 import os
 import re
-import runpy
-import subprocess
-import sys
-
-from PySide2 import QtCore, QtWidgets
-
-USING_MAYA = os.path.basename(sys.executable) == "maya.exe"
-
-if USING_MAYA:
-    from . import script_tree_dcc_maya as dcc_actions
-else:
-    from . import script_tree_dcc_mobu as dcc_actions
-
+import time
+from functools import partial
+
+from PySide2 import QtCore, QtGui, QtWidgets
+
+from . import script_tree_backup
+from . import script_tree_catalog
+from .script_tree_dcc import USING_MAYA, dcc_actions
+from . import script_tree_fuzzy
+from . import script_tree_models
+from . import script_tree_runner
+from . import script_tree_search
+from . import script_tree_telemetry
 from . import script_tree_utils as stu
+from . import script_tree_watcher
 from . import ui_utils
 
 lk = stu.ScriptTreeConstants
 
+# compiled scripts for "Run Script", so repeated runs skip reading and compiling unchanged files
+code_cache = script_tree_runner.CodeCache(lk.code_cache_folder, mirror=stu.script_mirror)
+
+# duration and outcome of every script run, shown in the tree
+run_telemetry = script_tree_telemetry.RunTelemetry(lk.telemetry_db_path)
+
+# diffs between backed up versions, shared by every version history panel
+version_differ = script_tree_backup.VersionDiffer(stu.backup_store)
+
 
 class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
     docking_object_name = "ScriptTreeWindow"
@@ -34,12 +45,20 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
         self.ui = ScriptTreeWidget()
         self.apply_ui_widget(self.ui)
 
-        self.recently_closed_scripts = []
+        self.profile_dock = None  # type: QtWidgets.QDockWidget
+        self.history_dock = None  # type: QtWidgets.QDockWidget
+        self.tree_backup_worker = None
+        self.tree_backup_progress = None  # type: QtWidgets.QProgressDialog
+        self.retention_worker = None
 
         self.settings = stu.ScriptEditorSettings()
+        self.last_used_times = self.settings.get_json_value(self.settings.k_last_used_times, {})
+        self.recently_closed_scripts = self.settings.get_json_value(self.settings.k_recently_closed_scripts, [])
+        self.saved_session = self.settings.get_json_value(self.settings.k_session_tabs, {})
 
         self.context_menu_actions = [
             {"Run Script": self.action_run_script},
+            {"Run Script (profiled)": self.action_run_script_profiled},
             {"Edit Script": self.action_open_script},
             "-",
             {"RADIO_SETTING": {"settings": self.settings,
@@ -49,13 +68,28 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
                                "on_trigger_command": self.action_setup_double_click_connections
                                }},
             "-",
+            {"RADIO_SETTING": {"settings": self.settings,
+                               "settings_key": self.settings.k_mirror_mode,
+                               "choices": [lk.mirror_online, lk.mirror_offline],
+                               "default": lk.mirror_online,
+                               "on_trigger_command": self.apply_mirror_mode
+                               }},
+            "-",
             {"Copy path": self.action_copy_path_to_clipboard},
             {"Show in explorer": self.action_open_path_in_explorer},
+            {"Version history": self.action_show_version_history},
+            {"DYNAMIC_MENU": {"title": "Recent versions", "build_command": self.build_history_menu}},
+            {"DYNAMIC_MENU": {"title": "Recent runs", "build_command": self.build_recent_runs_menu}},
+            {"DYNAMIC_MENU": {"title": "Saved profiles", "build_command": self.build_profiles_menu}},
             {"Open backup folder": self.action_open_backup_folder},
             "-",
+            {"Add script folder": self.action_add_folder},
+            {"Remove script folder": self.action_remove_folder},
+            "-",
             {"Save all temporary tabs": dcc_actions.save_script_editor},
             {"Backup Script Tree": self.action_backup_tree}
         ]
+        self.context_menu_cache = ui_utils.CachedMenu(self.context_menu_actions, parent=self)
 
 
         # MotionBuilder crashes on menuBar for some reason
@@ -92,9 +126,16 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
 
         self.setup_connections()
 
-        # read folder from settings, otherwise set to default folder
-        folder_path = self.settings.value(stu.ScriptEditorSettings.k_folder_path, defaultValue=lk.default_script_folder)
-        self.action_set_folder(folder_path)
+        self.apply_mirror_mode()
+
+        # read folders from settings, otherwise set to default folder
+        folder_paths = self.settings.value(stu.ScriptEditorSettings.k_folder_paths)
+        if not folder_paths:
+            folder_paths = [self.settings.value(stu.ScriptEditorSettings.k_folder_path,
+                                                defaultValue=lk.default_script_folder)]
+        if not os.path.exists(folder_paths[0]):
+            os.makedirs(folder_paths[0])
+        self.set_script_folders(folder_paths)
 
         # setup QTimer for script filtering (so we don't immediately search for every character)
         self.filter_timer = QtCore.QTimer()
@@ -104,6 +145,15 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
         # hook up shortcut actions to the script editor widget after everything is loaded and the widget might exist
         dcc_actions.eval_deferred(self.add_actions_to_script_editor)
 
+        self.schedule_backup_retention()
+
+        # bring back the script tabs of the last session in one go, once the script editor exists
+        dcc_actions.eval_deferred(self.restore_session)
+        self.session_timer = QtCore.QTimer(self)
+        self.session_timer.setInterval(lk.session_save_interval * 1000)
+        self.session_timer.timeout.connect(self.save_session)
+        self.session_timer.start()
+
     def create_action(self, shortcut, command=None, text="", menu=None):
         shortcut_action = QtWidgets.QAction(self)
         shortcut_action.setShortcut(shortcut)
@@ -127,42 +177,111 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
         # buttons and widget signals
         self.ui.set_folder_btn.clicked.connect(self.action_set_folder)
         self.ui.search_bar.textChanged.connect(self._user_input_filter)
+        self.ui.catalog_changed.connect(self._catalog_changed)
 
         # right click menu
         self.ui.tree_view.customContextMenuRequested.connect(self.context_menu)
+        self.ui.results_list.customContextMenuRequested.connect(self.context_menu)
 
         # double click script
         self.action_setup_double_click_connections()
 
     def context_menu(self):
-        return ui_utils.build_menu_from_action_list(self.context_menu_actions)
+        return self.context_menu_cache.exec_()
+
+    def get_selected_script_path(self):
+        script_path = self.ui.get_selected_path()
+        if not script_path or os.path.isdir(script_path):
+            return ""
+        return script_path
+
+    def build_history_menu(self):
+        script_path = self.get_selected_script_path()
+        if not script_path:
+            return []
+
+        versions = stu.backup_store.load_versions(script_path)[::-1][:lk.context_menu_entry_count]
+        actions = []
+        for version in versions:
+            title = "{}  ({})".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(version.time)),
+                                      script_tree_backup.format_size(version.size))
+            actions.append({title: partial(self.show_version_history, script_path, version)})
+        return actions
+
+    def build_recent_runs_menu(self):
+        script_path = self.get_selected_script_path()
+        if not script_path:
+            return []
+
+        actions = []
+        for run_record in run_telemetry.get_recent_runs(script_path, limit=lk.context_menu_entry_count):
+            title = "{}  {}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run_record.start_time)),
+                                    script_tree_telemetry.format_duration(run_record.duration))
+            if not run_record.success:
+                title += "  failed: {}".format(run_record.error)
+            actions.append({title: None})
+        return actions
+
+    def build_profiles_menu(self):
+        script_path = self.get_selected_script_path()
+        backup_folder = stu.get_backup_folder_for_script(script_path) if script_path else ""
+        if not os.path.isdir(backup_folder):
+            return []
+
+        prof_prefix = os.path.splitext(os.path.basename(script_path))[0] + "_PROFILE_"
+        prof_times = []
+        for file_name in os.listdir(backup_folder):
+            name, extension = os.path.splitext(file_name)
+            if extension == ".prof" and name.startswith(prof_prefix) and name[len(prof_prefix):].isdigit():
+                prof_times.append((int(name[len(prof_prefix):]), os.path.join(backup_folder, file_name)))
+
+        actions = []
+        for prof_time, prof_path in sorted(prof_times, reverse=True)[:lk.context_menu_entry_count]:
+            title = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(prof_time))
+            actions.append({title: partial(self.show_saved_profile, script_path, prof_path)})
+        return actions
 
     ################################################################################
     # signaled from ui
 
+    def _catalog_changed(self):
+        if self.ui.search_bar.text():
+            self.filter_results()
+
     def _user_input_filter(self):
-        self.filter_timer.start(lk.user_input_filter_delay)
+        if "," in self.ui.search_bar.text():
+            # comma separated filters expand the whole tree, so wait for the user to stop typing
+            self.filter_timer.start(lk.user_input_filter_delay)
+        else:
+            self.filter_timer.stop()
+            self.filter_results()
 
     def filter_results(self):
 
         filter_text = re.sub(r'[^\x00-\x7F]+', '', self.ui.search_bar.text())  # strip unicode characters until py3
 
-        if not filter_text:
-            self.ui.model.setNameFilters(self.ui.default_filter)
-            self.ui.tree_view.collapseAll()
-        else:
-            filters = []
-            for filter_string in filter_text.split(","):
-                filter_string = filter_string.replace(" ", "")
-                filters.append("*{}*.py".format(filter_string))
-                filters.append("*{}*.mel".format(filter_string))
+        if "," not in filter_text:
+            # fuzzy search, ranked results are shown in a flat list
+            self.ui.set_filter_terms([])
+            self.ui.show_fuzzy_results(filter_text, self.last_used_times)
+            return
+
+        self.ui.show_fuzzy_results("")
+
+        terms = [term.replace(" ", "").lower() for term in filter_text.split(",")]
+        terms = [term for term in terms if term]
+
+        self.ui.set_filter_terms(terms)
+        if terms:
             self.ui.tree_view.expandAll()
-            self.ui.model.setNameFilters(filters)
+        else:
+            self.ui.tree_view.collapseAll()
 
     def open_script_search_dialog(self):
         win = SearchDialog(self,
-                           root_folder=self.ui.get_script_folder(),
-                           search_string=dcc_actions.get_selected_script_text()
+                           root_folders=self.ui.get_script_folders(),
+                           search_string=dcc_actions.get_selected_script_text(),
+                           get_script_states=self.ui.get_script_states
                            )
         win.show()
         win.resize(800, 300)
@@ -188,11 +307,13 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
             return
 
         dcc_actions.open_script(script_path)
+        self.record_script_used(script_path)
         logging.info("Opened: {}".format(script_path))
 
     def action_save_tab(self, prompt_path=False):
 
-        script_path = dcc_actions.get_selected_script_path()
+        selected_path = dcc_actions.get_selected_script_path()
+        script_path = selected_path
 
         if prompt_path or not script_path:
             script_path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save Script",
@@ -201,12 +322,23 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
             if not script_path:
                 return
 
-        stu.backup_script(script_path)
+        # back up what was on disk before this save, and what was saved, each as its own version.
+        # both come from the editor, reading the file here could block on a network share
+        if script_path == selected_path:
+            previous_text = dcc_actions.get_selected_tab_file_text()
+            if previous_text is not None:
+                stu.backup_script(script_path, content=previous_text.encode("utf-8"))
+
+        saved_text = dcc_actions.get_selected_tab_text()
         dcc_actions.save_selected_tab(script_path)
+        stu.backup_script(script_path, content=saved_text.encode("utf-8") if saved_text is not None else None)
 
     def action_close_tab(self):
         self.recently_closed_scripts.append(dcc_actions.get_selected_script_path())
+        del self.recently_closed_scripts[:-lk.max_recently_closed_scripts]
+        self.settings.set_json_value(self.settings.k_recently_closed_scripts, self.recently_closed_scripts)
         dcc_actions.delete_selected_tab()
+        self.save_session()
 
     def action_open_path_in_explorer(self):
         stu.open_path_in_explorer(self.ui.get_selected_path())
@@ -222,14 +354,84 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
             backup_folder = lk.script_backup_folder
         stu.open_path_in_explorer(backup_folder)
 
+    def action_show_version_history(self):
+        script_path = self.get_selected_script_path()
+        if script_path:
+            self.show_version_history(script_path)
+
+    def show_version_history(self, script_path, selected_version=None):
+        if self.history_dock is None:
+            self.history_dock = QtWidgets.QDockWidget("Version History", self)
+            self.history_dock.setObjectName("ScriptTreeVersionHistory")
+            self.history_dock.setWidget(VersionHistoryWidget())
+            self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.history_dock)
+
+        self.history_dock.widget().set_script_path(script_path, selected_version)
+        self.history_dock.show()
+        self.history_dock.raise_()
+
     def action_backup_tree(self):
         result = QtWidgets.QMessageBox.question(self, "Backup ScriptTree?",
                                                 "This will make a local copy of the entire script tree folder",
                                                 QtWidgets.QMessageBox.Ok,
                                                 QtWidgets.QMessageBox.Cancel
                                                 )
-        if result == QtWidgets.QMessageBox.Ok:
-            stu.backup_tree(self.ui.get_script_folder())
+        if result != QtWidgets.QMessageBox.Ok or self.tree_backup_worker is not None:
+            return
+
+        self.tree_backup_progress = QtWidgets.QProgressDialog("Backing up script folder...", None, 0, 0, self)
+        self.tree_backup_progress.setWindowTitle(lk.window_text)
+        self.tree_backup_progress.setMinimumDuration(500)
+
+        self.tree_backup_worker = TreeBackupWorker(self.ui.get_script_folder())
+        self.tree_backup_worker.signals.progress.connect(self._tree_backup_progress)
+        self.tree_backup_worker.signals.finished.connect(self._tree_backup_finished)
+        QtCore.QThreadPool.globalInstance().start(self.tree_backup_worker)
+
+    def _tree_backup_progress(self, done_count, total_count):
+        if self.tree_backup_progress is not None:
+            self.tree_backup_progress.setMaximum(total_count)
+            self.tree_backup_progress.setValue(done_count)
+
+    def _tree_backup_finished(self, result):
+        self.tree_backup_worker = None
+        if self.tree_backup_progress is not None:
+            self.tree_backup_progress.close()
+            self.tree_backup_progress = None
+
+        if result is None or not result.snapshot_path:
+            QtWidgets.QMessageBox.warning(self, "Backup ScriptTree",
+                                          "The backup is incomplete, see the script editor output for details.\n"
+                                          "Running the backup again will resume it.")
+            return
+
+        self.start_backup_retention()
+
+    def schedule_backup_retention(self):
+        last_retention_time = float(self.settings.value(stu.ScriptEditorSettings.k_last_backup_retention_time, 0))
+        if time.time() - last_retention_time > lk.backup_retention_interval:
+            QtCore.QTimer.singleShot(10000, self.start_backup_retention)  # stay out of the way of startup
+
+    def start_backup_retention(self):
+        if self.retention_worker is not None:
+            return
+
+        remove_legacy_backups = self.settings.value(stu.ScriptEditorSettings.k_remove_legacy_backups, False, type=bool)
+        self.retention_worker = BackupRetentionWorker(remove_legacy_backups=remove_legacy_backups)
+        self.retention_worker.signals.finished.connect(self._backup_retention_finished)
+        QtCore.QThreadPool.globalInstance().start(self.retention_worker)
+
+    def _backup_retention_finished(self, result):
+        self.retention_worker = None
+        if result is None:
+            self.statusBar().showMessage("Backup cleanup failed, see the script editor output for details", 30000)
+            return
+
+        self.settings.setValue(stu.ScriptEditorSettings.k_last_backup_retention_time, time.time())
+        if result.removed_count or result.archived_count or result.reclaimed_bytes:
+            self.statusBar().showMessage("Backup cleanup: {} old backups removed, {} compacted, {} reclaimed".format(
+                result.removed_count, result.archived_count, script_tree_backup.format_size(result.reclaimed_bytes)),
+                30000)
 
     def action_set_folder(self, folder_path=None):
         if not folder_path:
@@ -242,18 +444,76 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
         if not os.path.exists(folder_path):
             os.makedirs(folder_path)
 
-        self.ui.set_script_folder(folder_path)
+        # the chosen folder replaces the first root folder, the other root folders stay
+        self.set_script_folders([folder_path] + self.ui.get_script_folders()[1:])
+
+    def action_add_folder(self):
+        folder_path = QtWidgets.QFileDialog.getExistingDirectory(self,
+                                                                 "Add Script Folder",
+                                                                 dir=self.ui.get_script_folder())
+        if not folder_path:
+            return
+
+        self.set_script_folders(self.ui.get_script_folders() + [folder_path])
+
+    def action_remove_folder(self):
+        root_folder = self.ui.get_root_folder(self.ui.get_selected_path())
+        folder_paths = [folder_path for folder_path in self.ui.get_script_folders() if folder_path != root_folder]
+        if not root_folder or not folder_paths:
+            return  # the last root folder can only be replaced
+
+        self.set_script_folders(folder_paths)
+
+    def set_script_folders(self, folder_paths):
+        self.ui.set_script_folders(folder_paths)
+        stu.script_mirror.set_mirrored_folders([folder_path for folder_path in self.ui.get_script_folders()
+                                                if script_tree_watcher.is_network_path(folder_path)])
 
-        self.settings.setValue(stu.ScriptEditorSettings.k_folder_path, folder_path)
+        self.settings.setValue(stu.ScriptEditorSettings.k_folder_path, folder_paths[0])
+        self.settings.setValue(stu.ScriptEditorSettings.k_folder_paths, self.ui.get_script_folders())
 
     def action_reopen_recently_closed(self):
         if not len(self.recently_closed_scripts):
             return
         recent_script_path = self.recently_closed_scripts.pop(-1)
+        self.settings.set_json_value(self.settings.k_recently_closed_scripts, self.recently_closed_scripts)
         if recent_script_path:  # recent_script_path may be an empty string if it doesn't have a path defined
             dcc_actions.open_script(recent_script_path)
 
-    def action_run_script(self):
+    def closeEvent(self, event):
+        self.save_session()
+        self.settings.sync()
+        super(ScriptTreeWindow, self).closeEvent(event)
+
+    def save_session(self):
+        """
+        Store the open script tabs with their cursor and scroll positions, only written when something changed
+        """
+        try:
+            session = {"tabs": dcc_actions.get_tab_states(),
+                       "selected": dcc_actions.get_selected_script_path()}
+        except Exception as e:
+            logging.debug("Failed to read the script editor tabs: {}".format(e))
+            return
+
+        if session != self.saved_session:
+            self.saved_session = session
+            self.settings.set_json_value(self.settings.k_session_tabs, session)
+
+    def restore_session(self):
+        """
+        Reopen the script tabs of the last session that aren't open anymore, after a crash for example
+        """
+        tab_states = self.saved_session.get("tabs")
+        if not tab_states:
+            return
+
+        try:
+            dcc_actions.restore_tab_states(tab_states, selected_path=self.saved_session.get("selected"))
+        except Exception as e:
+            logging.warning("Failed to restore the script tabs: {}".format(e))
+
+    def action_run_script(self, profile=False):
         file_path = self.ui.get_selected_path()
         if os.path.isdir(file_path):
             return
@@ -261,7 +521,10 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
         if file_path.endswith(".py"):
             cmd = "import runpy; runpy.run_path('{}', init_globals=globals(), run_name='__main__')".format(file_path)
             exec_command = 'python("{}")'.format(cmd)
-            runpy.run_path(file_path, init_globals=globals(), run_name="__main__")
+            if profile is True:
+                self.run_script_profiled(file_path)
+            else:
+                self.run_script(file_path)
 
         elif file_path.endswith(".mel"):
             logging.warning("TODO: add Mel support")
@@ -269,9 +532,76 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
         else:
             exec_command = ""
 
+        self.record_script_used(file_path)
         logging.info("Executed: {}".format(file_path))
         dcc_actions.add_to_repeat_commands(exec_command)
 
+    def run_script(self, file_path):
+        start_time = time.time()
+        try:
+            script_tree_runner.run_path(file_path, init_globals=globals(), run_name="__main__",
+                                        code_cache=code_cache)
+        except Exception as e:
+            self.record_script_run(file_path, start_time, time.time() - start_time, error=e)
+            raise
+        self.record_script_run(file_path, start_time, time.time() - start_time)
+
+    def record_script_run(self, file_path, start_time, duration, error=None):
+        run_telemetry.record_run(file_path, duration, success=error is None,
+                                 error=repr(error) if error else "", start_time=start_time)
+        self.ui.model.update_run_stats(file_path, run_telemetry.get_stats(file_path))
+
+    def action_run_script_profiled(self):
+        self.action_run_script(profile=True)
+
+    def run_script_profiled(self, file_path):
+        """
+        Run the script under cProfile, show the results in the profile panel and save a .prof next to the backups
+        """
+        start_time = time.time()
+        profiled_run = script_tree_runner.profile_path(file_path, init_globals=globals(), run_name="__main__",
+                                                       code_cache=code_cache)
+        self.record_script_run(file_path, start_time, profiled_run.wall_time, error=profiled_run.exception)
+
+        file_name = os.path.splitext(os.path.basename(file_path))[0]
+        prof_file_name = "{}_PROFILE_{}.prof".format(file_name, int(time.time()))
+        prof_path = os.path.join(stu.get_backup_folder_for_script(file_path), prof_file_name)
+        try:
+            profiled_run.save(prof_path)
+        except (IOError, OSError) as e:
+            logging.warning("Failed to save profile: {}".format(e))
+            prof_path = ""
+
+        self.show_profile_results(profiled_run, prof_path)
+
+        logging.info("Profiled: {} - wall {:.3f}s, cpu {:.3f}s".format(file_path,
+                                                                      profiled_run.wall_time,
+                                                                      profiled_run.cpu_time))
+        if profiled_run.exception:
+            raise profiled_run.exception
+
+    def show_profile_results(self, profiled_run, prof_path=""):
+        if self.profile_dock is None:
+            self.profile_dock = QtWidgets.QDockWidget("Profile Results", self)
+            self.profile_dock.setObjectName("ScriptTreeProfileResults")
+            self.profile_dock.setWidget(ProfileResultsWidget())
+            self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.profile_dock)
+
+        self.profile_dock.widget().set_profiled_run(profiled_run, prof_path)
+        self.profile_dock.show()
+        self.profile_dock.raise_()
+
+    def show_saved_profile(self, script_path, prof_path):
+        try:
+            profiled_run = script_tree_runner.ProfiledRun.load(script_path, prof_path)
+        except (IOError, OSError, ValueError, EOFError) as e:
+            logging.warning("Failed to load profile {}: {}".format(prof_path, e))
+            return
+        self.show_profile_results(profiled_run, prof_path)
+
+    def apply_mirror_mode(self):
+        stu.script_mirror.offline = self.settings.value(self.settings.k_mirror_mode) == lk.mirror_offline
+
     def action_setup_double_click_connections(self):
         """
         Switch between opening or running the script on double click.
@@ -279,6 +609,7 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
 
         try:
             self.ui.tree_view.doubleClicked.disconnect()
+            self.ui.results_list.doubleClicked.disconnect()
         except RuntimeError:
             pass
 
@@ -286,42 +617,493 @@ class ScriptTreeWindow(ui_utils.DockableWidget, QtWidgets.QMainWindow):
 
         if settings_value == lk.edit_script_on_click:
             self.ui.tree_view.doubleClicked.connect(self.action_open_script)
+            self.ui.results_list.doubleClicked.connect(self.action_open_script)
         else:
             self.ui.tree_view.doubleClicked.connect(self.action_run_script)
+            self.ui.results_list.doubleClicked.connect(self.action_run_script)
+
+    def record_script_used(self, script_path):
+        """
+        Store when the script was last run or opened, recent scripts get ranked higher in the search results
+        """
+        self.last_used_times[script_path] = time.time()
+
+        if len(self.last_used_times) > lk.max_last_used_scripts:
+            oldest_paths = sorted(self.last_used_times, key=self.last_used_times.get)
+            for path in oldest_paths[:len(self.last_used_times) - lk.max_last_used_scripts]:
+                self.last_used_times.pop(path)
+
+        self.settings.set_json_value(self.settings.k_last_used_times, self.last_used_times)
+
+
+class ProfileResultsWidget(QtWidgets.QWidget):
+    """
+    Hot functions and timings of a profiled script run
+    """
+    hot_function_count = 50
+
+    def __init__(self, *args, **kwargs):
+        super(ProfileResultsWidget, self).__init__(*args, **kwargs)
+        self.profiled_run = None
+
+        self.summary_label = QtWidgets.QLabel()
+        self.summary_label.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
+
+        self.sort_CB = QtWidgets.QComboBox()
+        self.sort_CB.addItem("Own time", "tottime")
+        self.sort_CB.addItem("Cumulative time", "cumtime")
+        self.sort_CB.currentIndexChanged.connect(self.refresh_table)
+
+        self.table = QtWidgets.QTableWidget()
+        self.table.setColumnCount(5)
+        self.table.setHorizontalHeaderLabels(["Function", "Location", "Calls", "Own (s)", "Cumulative (s)"])
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setStretchLastSection(True)
+
+        header_layout = QtWidgets.QHBoxLayout()
+        header_layout.addWidget(self.summary_label)
+        header_layout.addStretch()
+        header_layout.addWidget(self.sort_CB)
+
+        main_layout = QtWidgets.QVBoxLayout()
+        main_layout.addLayout(header_layout)
+        main_layout.addWidget(self.table)
+        main_layout.setContentsMargins(2, 2, 2, 2)
+        self.setLayout(main_layout)
+
+    def set_profiled_run(self, profiled_run, prof_path=""):
+        self.profiled_run = profiled_run
+
+        if profiled_run.cpu_time is None:  # loaded from a saved profile
+            summary = "{}\nProfiled: {:.3f}s".format(os.path.basename(profiled_run.file_path),
+                                                     profiled_run.wall_time)
+        else:
+            summary = "{}\nWall: {:.3f}s   CPU: {:.3f}s".format(os.path.basename(profiled_run.file_path),
+                                                               profiled_run.wall_time,
+                                                               profiled_run.cpu_time)
+        if profiled_run.exception:
+            summary += "   Failed: {}".format(profiled_run.exception)
+        self.summary_label.setText(summary)
+        self.summary_label.setToolTip(prof_path)
+
+        self.refresh_table()
+
+    def refresh_table(self):
+        if not self.profiled_run:
+            return
+
+        sort_by = self.sort_CB.itemData(self.sort_CB.currentIndex())
+        hot_functions = self.profiled_run.get_hot_functions(self.hot_function_count, sort_by=sort_by)
+
+        self.table.setRowCount(len(hot_functions))
+        for row, hot_function in enumerate(hot_functions):
+            location = "{}:{}".format(hot_function.file_path, hot_function.line_number)
+            row_values = [hot_function.name,
+                          location,
+                          str(hot_function.call_count),
+                          "{:.4f}".format(hot_function.total_time),
+                          "{:.4f}".format(hot_function.cumulative_time)]
+            for column, value in enumerate(row_values):
+                self.table.setItem(row, column, QtWidgets.QTableWidgetItem(value))
+
+        self.table.resizeColumnsToContents()
+
+
+class DiffHighlighter(QtGui.QSyntaxHighlighter):
+    """
+    Colors unified diff lines, only the visible blocks get highlighted so long diffs stay responsive
+    """
+    line_colors = (
+        ("+++", None),
+        ("---", None),
+        ("@@", QtGui.QColor(100, 160, 230)),
+        ("+", QtGui.QColor(110, 200, 110)),
+        ("-", QtGui.QColor(230, 100, 100)),
+    )
+
+    def highlightBlock(self, text):
+        for prefix, color in self.line_colors:
+            if text.startswith(prefix):
+                if color is not None:
+                    self.setFormat(0, len(text), color)
+                return
+
+
+class VersionDiffWorkerSignals(QtCore.QObject):
+    finished = QtCore.Signal(object, object)  # request key, list of diff lines or an error string
+
+
+class VersionDiffWorker(QtCore.QRunnable):
+    """
+    Diffs two backed up versions on a QThreadPool thread, an empty old_hash or new_hash means the current file
+    """
+
+    def __init__(self, request_key, script_path, old_version, new_version):
+        super(VersionDiffWorker, self).__init__()
+        self.request_key = request_key
+        self.script_path = script_path
+        self.old_version = old_version
+        self.new_version = new_version
+        self.signals = VersionDiffWorkerSignals()
+
+    def run(self):
+        try:
+            old_hash, old_name = self.get_hash_and_name(self.old_version)
+            new_hash, new_name = self.get_hash_and_name(self.new_version)
+            result = version_differ.get_diff(old_hash, new_hash, old_name, new_name)
+        except Exception as e:
+            result = "Failed to diff versions: {}".format(e)
+        self.signals.finished.emit(self.request_key, result)
+
+    def get_hash_and_name(self, version):
+        if version is None:
+            return version_differ.get_file_hash(self.script_path), "current"
+        return version.hash, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(version.time))
+
+
+class VersionHistoryWidget(QtWidgets.QWidget):
+    """
+    Backed up versions of a script from its version manifest, with a diff of the selected versions.
+
+    Selecting one version diffs it against the version before it, selecting two diffs them against each other.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(VersionHistoryWidget, self).__init__(*args, **kwargs)
+        self.script_path = ""
+        self.diff_request_key = None
+        self.diff_workers = set()  # keep references to the workers until they've finished
+
+        self.script_label = QtWidgets.QLabel()
+        self.script_label.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
+
+        self.restore_BTN = QtWidgets.QPushButton("Restore")
+        self.restore_BTN.setToolTip("Overwrite the script with the selected version, "
+                                    "the current content is backed up first")
+        self.restore_BTN.clicked.connect(self.restore_selected_version)
+
+        self.versions_TW = QtWidgets.QTreeWidget()
+        self.versions_TW.setHeaderLabels(["Version", "Size", "Hash"])
+        self.versions_TW.setRootIsDecorated(False)
+        self.versions_TW.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.versions_TW.itemSelectionChanged.connect(self.selection_changed)
+
+        self.diff_view = QtWidgets.QPlainTextEdit()
+        self.diff_view.setReadOnly(True)
+        self.diff_view.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        self.diff_view.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.diff_highlighter = DiffHighlighter(self.diff_view.document())
+
+        splitter = QtWidgets.QSplitter()
+        splitter.addWidget(self.versions_TW)
+        splitter.addWidget(self.diff_view)
+        splitter.setStretchFactor(1, 3)
+
+        header_layout = QtWidgets.QHBoxLayout()
+        header_layout.addWidget(self.script_label)
+        header_layout.addStretch()
+        header_layout.addWidget(self.restore_BTN)
+
+        main_layout = QtWidgets.QVBoxLayout()
+        main_layout.addLayout(header_layout)
+        main_layout.addWidget(splitter)
+        main_layout.setContentsMargins(2, 2, 2, 2)
+        self.setLayout(main_layout)
+
+    def set_script_path(self, script_path, selected_version=None):
+        self.script_path = script_path
+        self.script_label.setText(script_path)
+        self.refresh_versions(selected_version)
+
+    def refresh_versions(self, selected_version=None):
+        versions = stu.backup_store.load_versions(self.script_path)
+
+        self.versions_TW.clear()
+        self.diff_view.clear()
+
+        current_item = QtWidgets.QTreeWidgetItem(["Current file", "", ""])
+        current_item.setData(0, QtCore.Qt.UserRole, None)
+        items = [current_item]
+        for version in reversed(versions):
+            item = QtWidgets.QTreeWidgetItem([time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(version.time)),
+                                              script_tree_backup.format_size(version.size),
+                                              version.hash[:10]])
+            item.setData(0, QtCore.Qt.UserRole, version)
+            items.append(item)
+        self.versions_TW.addTopLevelItems(items)
+
+        for column in range(self.versions_TW.columnCount()):
+            self.versions_TW.resizeColumnToContents(column)
+
+        selected_items = [item for item in items[1:] if item.data(0, QtCore.Qt.UserRole) == selected_version]
+        if selected_items:
+            selected_items[0].setSelected(True)
+            self.versions_TW.scrollToItem(selected_items[0])
+        elif len(items) > 1:
+            items[1].setSelected(True)
+
+    def get_selected_versions(self):
+        """
+        :return: list of BackupVersion, None for the current file, newest first
+        """
+        selected_items = sorted(self.versions_TW.selectedItems(), key=self.versions_TW.indexOfTopLevelItem)
+        return [item.data(0, QtCore.Qt.UserRole) for item in selected_items]
+
+    def selection_changed(self):
+        selected_items = sorted(self.versions_TW.selectedItems(), key=self.versions_TW.indexOfTopLevelItem)
+        selected_versions = [item.data(0, QtCore.Qt.UserRole) for item in selected_items]
+        self.restore_BTN.setEnabled(len(selected_versions) == 1 and selected_versions[0] is not None)
+
+        if len(selected_items) == 1:
+            # compare against the version before it
+            row = self.versions_TW.indexOfTopLevelItem(selected_items[0])
+            older_item = self.versions_TW.topLevelItem(row + 1)
+            if older_item is None:
+                self.diff_view.setPlainText("First backed up version")
+                self.diff_request_key = None
+                return
+            selected_items.append(older_item)
+        elif len(selected_items) != 2:
+            self.diff_view.clear()
+            self.diff_request_key = None
+            return
+
+        new_version, old_version = [item.data(0, QtCore.Qt.UserRole) for item in selected_items]
+        request_key = (self.script_path, old_version, new_version)
+        self.diff_request_key = request_key
+
+        worker = VersionDiffWorker(request_key, self.script_path, old_version, new_version)
+        worker.signals.finished.connect(partial(self.diff_finished, worker))
+        self.diff_workers.add(worker)
+        QtCore.QThreadPool.globalInstance().start(worker)
+
+    def diff_finished(self, worker, request_key, result):
+        self.diff_workers.discard(worker)
+        if request_key != self.diff_request_key:
+            return  # the selection has changed since
+
+        if not isinstance(result, list):
+            self.diff_view.setPlainText(result)
+        elif not result:
+            self.diff_view.setPlainText("No changes")
+        else:
+            self.diff_view.setPlainText("\n".join(result))
+
+    def restore_selected_version(self):
+        selected_versions = self.get_selected_versions()
+        if len(selected_versions) != 1 or selected_versions[0] is None:
+            return
+
+        version = selected_versions[0]
+        try:
+            stu.backup_store.restore_version(self.script_path, version.hash)
+        except (IOError, OSError) as e:
+            QtWidgets.QMessageBox.warning(self, "Restore Version", "Failed to restore version:\n{}".format(e))
+            return
+
+        logging.info("Restored {} to the version from {}".format(
+            self.script_path, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(version.time))))
+        self.refresh_versions()
+
+
+class CatalogScanWorkerSignals(QtCore.QObject):
+    finished = QtCore.Signal(object)  # ScriptCatalog
+
+
+class CatalogScanWorker(QtCore.QRunnable):
+    """
+    Scans a script folder on a QThreadPool thread and saves the result as the new local snapshot,
+    unless some of the folders couldn't be listed
+    """
+
+    def __init__(self, root_folder, previous_catalog=None, hash_contents=False):
+        super(CatalogScanWorker, self).__init__()
+        self.root_folder = root_folder
+        self.previous_catalog = previous_catalog
+        self.hash_contents = hash_contents  # to find scripts that are in more than one root folder
+        self.scan_errors = []  # (folder path, error), the scan is incomplete if there are any
+        self.signals = CatalogScanWorkerSignals()
+
+    def run(self):
+        catalog = script_tree_catalog.ScriptCatalog(self.root_folder)
+        try:
+            self.scan_errors = catalog.scan()
+            if not self.scan_errors:
+                if self.hash_contents:
+                    catalog.update_content_hashes(self.previous_catalog)
+                catalog.save_snapshot(script_tree_catalog.get_snapshot_path(self.root_folder,
+                                                                            lk.catalog_cache_folder))
+        except Exception as e:
+            logging.exception(e)
+            self.scan_errors.append((self.root_folder, e))
+        self.signals.finished.emit(catalog)
+
+
+class FolderUpdateWorkerSignals(QtCore.QObject):
+    finished = QtCore.Signal(object)  # rel_folder: FolderListing, None if the root folder can't be reached
+
+
+class FolderUpdateWorker(QtCore.QRunnable):
+    """
+    Lists the folders the folder watcher reported on a QThreadPool thread, new sub folders are scanned completely.
+    Only the listings go back to the UI thread, which applies them to the catalog.
+    """
+
+    def __init__(self, root_folder, root_catalog, folder_states, hash_contents=False):
+        """
+        :param root_folder:
+        :param root_catalog: ScriptCatalog the listings are made for
+        :param folder_states: dict of rel_folder: ScriptCatalog.get_child_states(rel_folder)
+        :param hash_contents: hash new and changed scripts, the merged view marks duplicates with them
+        """
+        super(FolderUpdateWorker, self).__init__()
+        self.root_folder = root_folder
+        self.root_catalog = root_catalog
+        self.folder_states = folder_states
+        self.hash_contents = hash_contents
+        self.signals = FolderUpdateWorkerSignals()
+
+    def run(self):
+        folder_listings = None
+        try:
+            if os.path.isdir(self.root_folder):  # the share is unreachable otherwise, keep showing what was there
+                folder_listings = {}
+                for rel_folder, child_states in self.folder_states.items():
+                    folder_path = self.root_folder + "/" + rel_folder if rel_folder else self.root_folder
+                    folder_listings[rel_folder] = script_tree_catalog.read_folder(folder_path, child_states,
+                                                                                   self.hash_contents)
+        except Exception as e:
+            logging.exception(e)
+            folder_listings = None
+        self.signals.finished.emit(folder_listings)
+
+
+class FuzzySearchWorkerSignals(QtCore.QObject):
+    finished = QtCore.Signal(object, list)  # FuzzyMatcher, list of (score, rel_path)
+
+
+class FuzzySearchWorker(QtCore.QRunnable):
+    """
+    Runs a fuzzy search on a QThreadPool thread, so typing never waits for the matcher.
+    Only one runs at a time since the matcher remembers the last query.
+    """
+
+    def __init__(self, matcher, query, last_used_times, paths=None):
+        super(FuzzySearchWorker, self).__init__()
+        self.matcher = matcher
+        self.query = query
+        self.last_used_times = last_used_times
+        self.paths = paths  # build a new matcher from these first
+        self.signals = FuzzySearchWorkerSignals()
+
+    def run(self):
+        results = []
+        try:
+            if self.paths is not None:
+                self.matcher = script_tree_fuzzy.FuzzyMatcher(self.paths)
+            results = self.matcher.search(self.query, limit=lk.fuzzy_result_count,
+                                          last_used_times=self.last_used_times)
+        except Exception as e:
+            logging.exception(e)
+        self.signals.finished.emit(self.matcher, results)
+
+
+class TreeBackupWorkerSignals(QtCore.QObject):
+    progress = QtCore.Signal(int, int)  # done_count, total_count
+    finished = QtCore.Signal(object)  # TreeSnapshotResult, None if the backup failed
+
+
+class TreeBackupWorker(QtCore.QRunnable):
+    """
+    Makes an incremental snapshot of the script folder on a QThreadPool thread
+    """
+
+    def __init__(self, script_folder):
+        super(TreeBackupWorker, self).__init__()
+        self.script_folder = script_folder
+        self.signals = TreeBackupWorkerSignals()
+
+    def run(self):
+        result = None
+        try:
+            result = stu.backup_tree(self.script_folder, progress_callback=self.signals.progress.emit)
+        except Exception as e:
+            logging.exception(e)
+        self.signals.finished.emit(result)
+
+
+class BackupRetentionWorkerSignals(QtCore.QObject):
+    finished = QtCore.Signal(object)  # RetentionResult, None if it failed
+
+
+class BackupRetentionWorker(QtCore.QRunnable):
+    """
+    Prunes and compacts the backup folders on a QThreadPool thread
+    """
+
+    def __init__(self, remove_legacy_backups=False):
+        super(BackupRetentionWorker, self).__init__()
+        self.signals = BackupRetentionWorkerSignals()
+        self.remove_legacy_backups = remove_legacy_backups
+
+    def run(self):
+        result = None
+        try:
+            result = stu.apply_backup_retention(remove_legacy_backups=self.remove_legacy_backups)
+        except Exception as e:
+            logging.exception(e)
+        self.signals.finished.emit(result)
 
 
 class ScriptTreeWidget(QtWidgets.QWidget):
+    catalog_changed = QtCore.Signal()
+
     def __init__(self, *args, **kwargs):
         super(ScriptTreeWidget, self).__init__(*args, **kwargs)
 
+        self.scan_workers = set()  # keep references to the workers until they've finished
+
+        self.root_catalogs = collections.OrderedDict()  # root folder: ScriptCatalog, scanned and cached separately
+        self.folder_watchers = {}  # root folder: ScriptFolderWatcher
+        self.folder_update_workers = {}  # root folder: FolderUpdateWorker, one at a time per root folder
+        self.pending_folder_updates = {}  # root folder: set of rel folders changed while its worker was running
+        self.fuzzy_matcher_outdated = False
+
         self.folder_path = QtWidgets.QLineEdit()
 
         self.search_bar = QtWidgets.QLineEdit()
         self.search_bar.setPlaceholderText("search")
         self.search_bar.setClearButtonEnabled(True)
 
-        self.default_filter = ["*.py", "*.mel"]
-
         self.set_folder_btn = QtWidgets.QPushButton("...")
 
-        self.model = QtWidgets.QFileSystemModel()
-        # self.model.setRootPath(self.folder)
-        self.model.setFilter(QtCore.QDir.AllDirs | QtCore.QDir.NoDotAndDotDot | QtCore.QDir.AllEntries)
-        self.model.setNameFilters(self.default_filter)
-        self.model.setNameFilterDisables(False)
+        self.catalog = script_tree_catalog.ScriptCatalog("")
+        self.model = script_tree_models.ScriptCatalogModel()
+        self.proxy_model = script_tree_models.ScriptCatalogFilterModel()
+        self.proxy_model.setSourceModel(self.model)
 
         self.tree_view = QtWidgets.QTreeView()
-        self.tree_view.setModel(self.model)
-        # self.tree_view.setRootIndex(self.model.index(self.folder))
+        self.tree_view.setModel(self.proxy_model)
+        self.tree_view.setUniformRowHeights(True)
 
         self.tree_view.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
         # self.tree_view.customContextMenuRequested.connect(self.context_menu_file_system)
 
-        # self.treeView.setColumnWidth(0, 300)
-        self.tree_view.hideColumn(1)
-        self.tree_view.hideColumn(2)
-        self.tree_view.hideColumn(3)
         self.tree_view.setHeaderHidden(True)
+        self.tree_view.header().setStretchLastSection(False)
+        self.tree_view.header().setSectionResizeMode(0, QtWidgets.QHeaderView.Stretch)
+        self.tree_view.header().setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeToContents)
+
+        # flat list of ranked results while searching, the matching runs on a worker thread
+        self.fuzzy_matcher = script_tree_fuzzy.FuzzyMatcher([])
+        self.fuzzy_worker = None  # type: FuzzySearchWorker
+        self.fuzzy_query = ""
+        self.pending_fuzzy_search = None  # (query, relative_used_times) to search once the running search is done
+        self.results_list = QtWidgets.QListWidget()
+        self.results_list.setUniformItemSizes(True)
+        self.results_list.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+        self.results_list.hide()
 
         # Add to main layout
         self.main_layout = QtWidgets.QVBoxLayout()
@@ -332,68 +1114,562 @@ class ScriptTreeWidget(QtWidgets.QWidget):
         self.main_layout.addLayout(file_line_layout)
         self.main_layout.addWidget(self.search_bar)
         self.main_layout.addWidget(self.tree_view)
+        self.main_layout.addWidget(self.results_list)
         self.main_layout.setContentsMargins(2, 2, 2, 2)
 
         self.setLayout(self.main_layout)
 
     def get_selected_path(self):
+        if not self.results_list.isHidden():
+            item = self.results_list.currentItem()
+            return item.data(QtCore.Qt.UserRole) if item else ""
+
         index = self.tree_view.currentIndex()
-        file_path = self.model.filePath(index)
+        if not index.isValid():
+            return ""
+        file_path = self.proxy_model.file_path(index)
         return file_path.replace("\\", "/")
 
     def get_script_folder(self):
-        return self.folder_path.text()
+        """
+        :return: the first root folder, new scripts and searches start there
+        """
+        return next(iter(self.root_catalogs), "")
+
+    def get_script_folders(self):
+        return list(self.root_catalogs)
+
+    def get_script_states(self, root_folder):
+        """
+        :return: dict of full path: (mtime, size) of the scripts in root_folder as the folder watcher last saw them,
+            None if root_folder isn't one of the root folders
+        """
+        catalog = self.root_catalogs.get(root_folder.replace("\\", "/").rstrip("/"))
+        return catalog.get_script_states() if catalog is not None else None
+
+    def get_root_folder(self, file_path):
+        """
+        :return: the root folder file_path is in, "" if it isn't in any
+        """
+        file_path = file_path.replace("\\", "/")
+        for root_folder in self.root_catalogs:
+            if file_path == root_folder or file_path.startswith(root_folder + "/"):
+                return root_folder
+        return ""
 
     def set_script_folder(self, folder_path):
-        self.model.setRootPath(folder_path)
-        self.tree_view.setRootIndex(self.model.index(folder_path))
-        self.folder_path.setText(folder_path)
+        self.set_script_folders([folder_path])
+
+    def set_script_folders(self, folder_paths):
+        """
+        Show the locally cached snapshots of the folders straight away, then check the real folders in the background.
+        Every folder is scanned by its own worker, so a slow network folder doesn't hold up the others.
+        """
+        self.root_catalogs = collections.OrderedDict()
+        for folder_path in folder_paths:
+            catalog = script_tree_catalog.ScriptCatalog(folder_path)
+            catalog.load_snapshot(script_tree_catalog.get_snapshot_path(folder_path, lk.catalog_cache_folder))
+            self.root_catalogs[catalog.root_folder] = catalog
+
+        self.set_catalog(script_tree_catalog.merge_catalogs(list(self.root_catalogs.values())))
+        self.folder_path.setText("; ".join(self.root_catalogs))
+
+        for root_folder, catalog in self.root_catalogs.items():
+            worker = CatalogScanWorker(root_folder,
+                                       previous_catalog=catalog,
+                                       hash_contents=len(self.root_catalogs) > 1)
+            worker.signals.finished.connect(partial(self._catalog_scan_finished, worker))
+            self.scan_workers.add(worker)
+            QtCore.QThreadPool.globalInstance().start(worker)
+
+    def set_catalog(self, catalog):
+        self.catalog = catalog
+
+        run_stats = {}
+        for root_folder in self.root_catalogs:
+            run_stats.update(run_telemetry.get_folder_stats(root_folder))
+        self.model.set_catalog(catalog, run_stats=run_stats)
+
+        self.fuzzy_matcher_outdated = True  # built by the next fuzzy search, off the UI thread
+        self.watch_root_folders()
+        self.catalog_changed.emit()
+
+    def get_fuzzy_paths(self):
+        # the same script in several root folders is only listed once
+        return [rel_path for rel_path in self.catalog.get_script_paths() if rel_path not in self.catalog.duplicates]
+
+    def watch_root_folders(self):
+        for root_folder in list(self.folder_watchers):
+            if root_folder not in self.root_catalogs:
+                self.folder_watchers.pop(root_folder).stop()
+
+        for root_folder in self.root_catalogs:
+            folder_watcher = self.folder_watchers.get(root_folder)
+            if folder_watcher is None:
+                folder_watcher = script_tree_watcher.ScriptFolderWatcher(self)
+                folder_watcher.folders_changed.connect(partial(self.update_folders, root_folder))
+                self.folder_watchers[root_folder] = folder_watcher
+
+            rel_root = self.catalog.get_rel_path(root_folder)
+            folder_watcher.watch(root_folder, self.catalog.get_folder_paths(rel_root) if rel_root is not None else [])
+
+    def update_folders(self, root_folder, rel_folders):
+        """
+        Update only the given folders of the catalog, called by the folder watcher of root_folder.
+        The folders are listed on a worker thread, a slow share never blocks the UI.
+        """
+        self.pending_folder_updates.setdefault(root_folder, set()).update(rel_folders)
+        if root_folder not in self.folder_update_workers:
+            self._start_folder_update(root_folder)
+
+    def _start_folder_update(self, root_folder):
+        rel_folders = self.pending_folder_updates.pop(root_folder, set())
+        root_catalog = self.root_catalogs.get(root_folder)
+        if root_catalog is None:
+            return
+
+        folder_states = {}
+        for rel_folder in rel_folders:
+            child_states = root_catalog.get_child_states(rel_folder)
+            if child_states is not None:
+                folder_states[rel_folder] = child_states
+        if not folder_states:
+            return
+
+        worker = FolderUpdateWorker(root_folder, root_catalog, folder_states,
+                                    hash_contents=len(self.root_catalogs) > 1)
+        worker.signals.finished.connect(partial(self._folder_update_finished, worker))
+        self.folder_update_workers[root_folder] = worker
+        QtCore.QThreadPool.globalInstance().start(worker)
+
+    def _folder_update_finished(self, worker, folder_listings):
+        self.folder_update_workers.pop(worker.root_folder, None)
+
+        if self.root_catalogs.get(worker.root_folder) is not worker.root_catalog:
+            if worker.root_folder in self.root_catalogs:  # rescanned while listing, list the folders again
+                self.pending_folder_updates.setdefault(worker.root_folder, set()).update(worker.folder_states)
+        elif folder_listings is not None:
+            self.apply_folder_listings(worker.root_folder, folder_listings)
+
+        if self.pending_folder_updates.get(worker.root_folder):
+            self._start_folder_update(worker.root_folder)
+
+    def apply_folder_listings(self, root_folder, folder_listings):
+        """
+        :param root_folder:
+        :param folder_listings: dict of rel_folder: FolderListing, from a FolderUpdateWorker
+        """
+        root_catalog = self.root_catalogs.get(root_folder)
+        rel_root = self.catalog.get_rel_path(root_folder)
+        if root_catalog is None or rel_root is None:
+            return
+
+        folders_added_or_removed = False
+        catalog_changed = False
+        previous_duplicates = dict(self.catalog.duplicates)
+
+        for rel_folder, folder_listing in sorted(folder_listings.items()):
+            if root_catalog is not self.catalog:
+                # keep it current for when the view is merged again
+                root_catalog.apply_folder_listing(rel_folder, folder_listing)
+
+            catalog_folder = rel_root + "/" + rel_folder if rel_root and rel_folder else rel_root or rel_folder
+            result = self.catalog.apply_folder_listing(catalog_folder, folder_listing)
+            if result is None:
+                continue
+
+            added, removed, changed = result
+            if not added and not removed:
+                continue
+
+            self.model.update_folder(self.catalog.find_entry(catalog_folder), removed)
+            catalog_changed = True
+            if any(self.catalog.is_dir[entry] for entry in added + removed):
+                folders_added_or_removed = True
+
+        if folders_added_or_removed:
+            self.watch_root_folders()
+
+        if self.catalog.duplicates != previous_duplicates:
+            changed_paths = set(self.catalog.duplicates.items()) ^ set(previous_duplicates.items())
+            self.model.update_entries([self.catalog.find_entry(rel_path) for rel_path, _ in changed_paths])
+            catalog_changed = True
+
+        if catalog_changed:
+            self.fuzzy_matcher_outdated = True  # rebuilt on the next search, not on every file system event
+            self.catalog_changed.emit()
+
+    def _catalog_scan_finished(self, worker, scanned_catalog):
+        self.scan_workers.discard(worker)
+        root_catalog = self.root_catalogs.get(scanned_catalog.root_folder)
+        if root_catalog is not worker.previous_catalog:
+            return  # folders were changed while scanning
+
+        if worker.scan_errors:
+            # an unreachable share or a folder that failed to list would show up as removed scripts
+            for folder_path, error in worker.scan_errors:
+                logging.warning("Failed to scan {}: {}".format(folder_path, error))
+            logging.warning("Showing the cached tree of {}".format(scanned_catalog.root_folder))
+            return
+
+        rel_root = self.catalog.get_rel_path(scanned_catalog.root_folder)
+        added, removed, changed = script_tree_catalog.diff_file_states(
+            self.catalog.get_file_states(rel_root) if rel_root is not None else {},
+            scanned_catalog.get_file_states())
+        hashes_changed = worker.hash_contents and scanned_catalog.content_hashes != root_catalog.content_hashes
+
+        if added or removed or changed or hashes_changed:
+            logging.info("ScriptTree folder {} updated: {} added, {} removed, {} changed".format(
+                scanned_catalog.root_folder, len(added), len(removed), len(changed)))
+            self.root_catalogs[scanned_catalog.root_folder] = scanned_catalog
+            self.set_catalog(script_tree_catalog.merge_catalogs(list(self.root_catalogs.values())))
+
+    def show_fuzzy_results(self, query, last_used_times=None):
+        """
+        Show the best matches for query in a flat list instead of the tree, an empty query goes back to the tree
+
+        :param query:
+        :param last_used_times: dict of full script path: time.time() it was last used
+        """
+        self.fuzzy_query = query
+        if not query:
+            self.pending_fuzzy_search = None
+            self.results_list.clear()
+            self.results_list.hide()
+            self.tree_view.show()
+            return
+
+        # the matcher works on paths relative to the script folder
+        relative_used_times = {}
+        for script_path, used_time in (last_used_times or {}).items():
+            rel_path = self.catalog.get_rel_path(script_path)
+            if rel_path:
+                relative_used_times[rel_path] = used_time
+
+        # only the newest query waits for the running search, the ones typed in between are skipped
+        self.pending_fuzzy_search = (query, relative_used_times)
+        if self.fuzzy_worker is None:
+            self._start_fuzzy_search()
+
+    def _start_fuzzy_search(self):
+        query, relative_used_times = self.pending_fuzzy_search
+        self.pending_fuzzy_search = None
+
+        paths = None
+        if self.fuzzy_matcher_outdated:
+            paths = self.get_fuzzy_paths()
+            self.fuzzy_matcher_outdated = False
+
+        self.fuzzy_worker = FuzzySearchWorker(self.fuzzy_matcher, query, relative_used_times, paths=paths)
+        self.fuzzy_worker.signals.finished.connect(partial(self._fuzzy_search_finished, self.fuzzy_worker))
+        QtCore.QThreadPool.globalInstance().start(self.fuzzy_worker)
+
+    def _fuzzy_search_finished(self, worker, matcher, results):
+        self.fuzzy_worker = None
+        self.fuzzy_matcher = matcher
+
+        if self.pending_fuzzy_search is not None:
+            self._start_fuzzy_search()
+            return
+        if worker.query != self.fuzzy_query:
+            return  # the search bar was cleared while searching
+
+        self.results_list.clear()
+        for score, rel_path in results:
+            entry = self.catalog.find_entry(rel_path)
+            if entry is None:
+                continue
+            script_path = self.catalog.get_full_path(entry)
+            item = QtWidgets.QListWidgetItem(rel_path)
+            item.setData(QtCore.Qt.UserRole, script_path)
+            item.setToolTip(script_path)
+            self.results_list.addItem(item)
+
+        if self.results_list.count():
+            self.results_list.setCurrentRow(0)
+
+        self.tree_view.hide()
+        self.results_list.show()
+
+    def set_filter_terms(self, terms):
+        """
+        Only show scripts with any of the terms in their name, an empty list shows everything
+        """
+        if terms:
+            self.proxy_model.set_visible_entries(self.catalog.filter(terms))
+        else:
+            self.proxy_model.set_visible_entries(None)
+
+
+class SearchWorkerSignals(QtCore.QObject):
+    status_changed = QtCore.Signal(str)
+    matches_found = QtCore.Signal(list)
+    finished = QtCore.Signal(bool)  # True if the search was cancelled
+
+
+class SearchWorker(QtCore.QRunnable):
+    """
+    Runs a ScriptTree search on a QThreadPool thread and streams the matches back in batches
+    """
+    batch_size = 50
+    batch_interval = 0.1  # seconds
+
+    def __init__(self, root_folders, search_string, use_index=True, use_regex=False, case_sensitive=False,
+                 file_states=None):
+        """
+        :param root_folders: list of folders to search, in the order the matches are listed
+        :param search_string:
+        :param use_index:
+        :param use_regex:
+        :param case_sensitive:
+        :param file_states: dict of root folder: file states from the catalog, for SearchIndex.update_files.
+            Root folders without file states are walked the first time they're searched.
+        """
+        super(SearchWorker, self).__init__()
+        self.root_folders = root_folders
+        self.file_states = file_states or {}
+        self.search_string = search_string
+        self.use_index = use_index
+        self.use_regex = use_regex
+        self.case_sensitive = case_sensitive
+        self.signals = SearchWorkerSignals()
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def run(self):
+        try:
+            self._run_search()
+        except Exception as e:
+            logging.exception(e)
+            self.signals.status_changed.emit("Search failed: {}".format(e))
+        stu.script_mirror.flush()  # the copies made while searching are saved to the mirror index once
+        self.signals.finished.emit(self._cancelled)
+
+    def _run_search(self):
+        batch = []
+        last_emit_time = time.time()
+        for root_folder in self.root_folders:
+            matches = self._search_folder(root_folder)
+            if matches is None:
+                return
+
+            for match in matches:
+                if self._cancelled:
+                    return
+
+                batch.append(match)
+                if len(batch) >= self.batch_size or time.time() - last_emit_time > self.batch_interval:
+                    self.signals.matches_found.emit(batch)
+                    batch = []
+                    last_emit_time = time.time()
+
+        if batch:
+            self.signals.matches_found.emit(batch)
+
+    def _search_folder(self, root_folder):
+        """
+        :return: generator of SearchMatch, None if the search was cancelled
+        """
+        # files in network folders are read from their local copies
+        scan_kwargs = {"max_file_size": lk.search_max_file_size,
+                       "is_cancelled": self.is_cancelled,
+                       "get_read_path": stu.script_mirror.get_local_path}
+
+        if not self.use_index or self.use_regex:  # the index can't narrow down regular expressions
+            self.signals.status_changed.emit("Searching...")
+            matcher = script_tree_search.ContentMatcher(self.search_string,
+                                                        use_regex=self.use_regex,
+                                                        case_sensitive=self.case_sensitive)
+            return script_tree_search.scan_folder(root_folder, matcher, **scan_kwargs)
+
+        file_states = self.file_states.get(root_folder)
+        search_index = script_tree_search.get_search_index(root_folder, lk.search_index_folder)
+        with search_index.lock:
+            # the index is compared against the file states the folder watcher keeps in the catalog,
+            # only the files that changed since the last search are read again.
+            # offline, the index stays as it was since the share can't be read
+            if not stu.script_mirror.offline and (file_states is not None or not search_index.synced):
+                self.signals.status_changed.emit("Updating search index...")
+                update_kwargs = {"is_cancelled": self.is_cancelled,
+                                 "get_read_path": stu.script_mirror.get_local_path}
+                if file_states is not None:
+                    updated_count, removed_count = search_index.update_files(file_states, **update_kwargs)
+                else:
+                    updated_count, removed_count = search_index.refresh(**update_kwargs)
+                if updated_count or removed_count:
+                    search_index.save()
+                if self._cancelled:
+                    return None
+
+            candidates = search_index.candidates(self.search_string)
+
+        self.signals.status_changed.emit("Searching...")
+        matcher = script_tree_search.ContentMatcher(self.search_string, case_sensitive=self.case_sensitive)
+        return script_tree_search.scan_files(candidates, matcher, **scan_kwargs)
 
 
 class SearchDialog(QtWidgets.QDialog):
-    def __init__(self, parent=ui_utils.get_app_window(), root_folder="", search_string=""):
+    def __init__(self, parent=None, root_folders=(), search_string="", get_script_states=None):
         ui_utils.delete_window(self)
-        super(SearchDialog, self).__init__(parent)
+        super(SearchDialog, self).__init__(parent or ui_utils.get_app_window())
+        ui_utils.register_window(self)
+
+        self.search_worker = None  # type: SearchWorker
+        self.get_script_states = get_script_states  # ScriptTreeWidget.get_script_states, keeps the index current
+        self.running_workers = set()  # keep references to cancelled workers until they've stopped
+        self.match_count = 0
 
         main_layout = QtWidgets.QVBoxLayout()
 
-        desc_text = "Search the entire ScriptTree folder for a specific string"
+        desc_text = "Search every ScriptTree folder for a specific string"
         desc_label = QtWidgets.QLabel(desc_text)
 
-        self.folder_LE = QtWidgets.QLineEdit(root_folder)
+        self.folder_LE = QtWidgets.QLineEdit("; ".join(root_folders))
+        self.folder_LE.setToolTip("Folders to search, separated by ;")
 
         if not search_string:
             search_string = "SEARCH STRING"  # just to make sure it's not blank
         self.search_text_LE = QtWidgets.QLineEdit(search_string)
         self.search_text_LE.setPlaceholderText("search text")
+        self.search_text_LE.returnPressed.connect(self.start_search)
+
+        self.use_index_CB = QtWidgets.QCheckBox("Use Index")
+        self.use_index_CB.setChecked(True)
+        self.use_regex_CB = QtWidgets.QCheckBox("Regex")
+        self.case_sensitive_CB = QtWidgets.QCheckBox("Case Sensitive")
 
         self.search_BTN = QtWidgets.QPushButton("Search")
         self.search_BTN.clicked.connect(self.start_search)
 
+        self.cancel_BTN = QtWidgets.QPushButton("Cancel")
+        self.cancel_BTN.setEnabled(False)
+        self.cancel_BTN.clicked.connect(self.cancel_search)
+
+        self.results_TW = QtWidgets.QTreeWidget()
+        self.results_TW.setHeaderLabels(["File", "Line", "Text"])
+        self.results_TW.setRootIsDecorated(False)
+        self.results_TW.setUniformRowHeights(True)
+        self.results_TW.itemDoubleClicked.connect(self.open_result)
+
+        self.status_label = QtWidgets.QLabel()
+
+        options_layout = QtWidgets.QHBoxLayout()
+        options_layout.addWidget(self.use_index_CB)
+        options_layout.addWidget(self.use_regex_CB)
+        options_layout.addWidget(self.case_sensitive_CB)
+        options_layout.addStretch()
+
+        button_layout = QtWidgets.QHBoxLayout()
+        button_layout.addWidget(self.search_BTN)
+        button_layout.addWidget(self.cancel_BTN)
+
         main_layout.addWidget(desc_label)
         main_layout.addWidget(self.folder_LE)
         main_layout.addWidget(self.search_text_LE)
-        main_layout.addWidget(self.search_BTN)
+        main_layout.addLayout(options_layout)
+        main_layout.addLayout(button_layout)
+        main_layout.addWidget(self.results_TW)
+        main_layout.addWidget(self.status_label)
 
         self.setLayout(main_layout)
         self.setWindowTitle("Search ScriptTree")
 
     def start_search(self):
-        """ Search for string using commandline findstr """
-        root_folder = self.folder_LE.text()
+        """ Search for string on a background thread, results are added to the list as they're found """
+        self.cancel_search()
+
+        root_folders = self.get_root_folders()
         str_to_find = self.search_text_LE.text()
-        print("Searching {} for '{}'".format(root_folder, str_to_find))
-
-        proc = subprocess.Popen("findstr /s /n " + str_to_find + " *.py *.mel",
-                                cwd=root_folder,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        std_out_data, std_err_data = proc.communicate()
-        print("#" * 50)
-        print("Search Results:\n")
-        print(std_out_data)
-        print("#" * 50)
+        if not str_to_find:
+            return
+
+        self.results_TW.clear()
+        self.match_count = 0
+
+        file_states = {}
+        if self.get_script_states:
+            for root_folder in root_folders:
+                root_states = self.get_script_states(root_folder)
+                if root_states is not None:
+                    file_states[root_folder] = root_states
+
+        worker = SearchWorker(root_folders, str_to_find,
+                              use_index=self.use_index_CB.isChecked(),
+                              use_regex=self.use_regex_CB.isChecked(),
+                              case_sensitive=self.case_sensitive_CB.isChecked(),
+                              file_states=file_states)
+        worker.signals.status_changed.connect(partial(self.set_search_status, worker))
+        worker.signals.matches_found.connect(partial(self.add_matches, worker))
+        worker.signals.finished.connect(partial(self.search_finished, worker))
+
+        self.search_worker = worker
+        self.running_workers.add(worker)
+        self.cancel_BTN.setEnabled(True)
+        QtCore.QThreadPool.globalInstance().start(worker)
+
+    def get_root_folders(self):
+        folder_paths = [folder_path.strip().replace("\\", "/").rstrip("/")
+                        for folder_path in self.folder_LE.text().split(";")]
+        return [folder_path for folder_path in folder_paths if folder_path]
+
+    def cancel_search(self):
+        if self.search_worker:
+            self.search_worker.cancel()
+            self.search_worker = None
+        self.cancel_BTN.setEnabled(False)
+
+    def set_search_status(self, worker, status):
+        if worker is self.search_worker:
+            self.status_label.setText(status)
+
+    def add_matches(self, worker, matches):
+        if worker is not self.search_worker:
+            return  # results from a cancelled search
+
+        # with several folders, paths are shown under the same labels as in the tree
+        root_folders = worker.root_folders
+        root_labels = script_tree_catalog.get_root_labels(root_folders) if len(root_folders) > 1 else [""]
+        items = []
+        for match in matches:
+            rel_path = match.file_path
+            for root_folder, root_label in zip(root_folders, root_labels):
+                if match.file_path.startswith(root_folder + "/"):
+                    rel_path = os.path.relpath(match.file_path, root_folder).replace("\\", "/")
+                    rel_path = root_label + "/" + rel_path if root_label else rel_path
+                    break
+            item = QtWidgets.QTreeWidgetItem([rel_path, str(match.line_number), match.line_text])
+            item.setData(0, QtCore.Qt.UserRole, match.file_path)
+            items.append(item)
+
+        self.results_TW.addTopLevelItems(items)
+        self.match_count += len(matches)
+        self.status_label.setText("Searching... {} matches".format(self.match_count))
+
+    def search_finished(self, worker, cancelled):
+        self.running_workers.discard(worker)
+        if worker is not self.search_worker:
+            return
+
+        self.search_worker = None
+        self.cancel_BTN.setEnabled(False)
+        self.results_TW.resizeColumnToContents(0)
+
+        status = "Cancelled" if cancelled else "Done"
+        self.status_label.setText("{} - {} matches".format(status, self.match_count))
+
+    def open_result(self, item):
+        file_path = item.data(0, QtCore.Qt.UserRole)
+        if file_path:
+            dcc_actions.open_script(file_path)
 
+    def closeEvent(self, event):
+        self.cancel_search()
+        super(SearchDialog, self).closeEvent(event)
 
 def main(restore=False, force_refresh=False):
     restore_script = "import script_tree; script_tree.main(restore=True)"
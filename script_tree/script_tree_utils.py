@@ -1,23 +1,22 @@
+import atexit
+import json
 import logging
 import os
 import shutil
 import subprocess
-import sys
 import time
 from functools import partial
 
 from PySide2 import QtCore, QtWidgets, QtGui
 
-if os.path.basename(sys.executable) == "maya.exe":
-    from . import script_tree_dcc_maya as dcc_actions
-    dcc_name = "Maya"
-else:
-    from . import script_tree_dcc_mobu as dcc_actions
-    dcc_name = "Motionbuilder"
+from .script_tree_dcc import dcc_actions, dcc_name
 
 settings_name = "script_tree_" + dcc_name.lower()
 
 from . import ui_utils
+from . import script_tree_backup
+from . import script_tree_mirror
+from . import script_tree_settings
 
 
 class GlobalCache:
@@ -38,27 +37,81 @@ class ScriptTreeConstants:
     # default_script_folder = "M:/Art/Tools/{}/Scripts".format(dcc_name)
     script_backup_folder = os.path.join(script_tree_folder, "ScriptTree_ScriptBackup").replace("\\", "/")
     tree_backup_folder = os.path.join(script_tree_folder, "ScriptTree_TreeBackup").replace("\\", "/")
-
-    user_input_filter_delay = 200
+    search_index_folder = os.path.join(script_tree_folder, "ScriptTree_SearchIndex").replace("\\", "/")
+    catalog_cache_folder = os.path.join(script_tree_folder, "ScriptTree_Cache").replace("\\", "/")
+    code_cache_folder = os.path.join(script_tree_folder, "ScriptTree_CodeCache").replace("\\", "/")
+    mirror_cache_folder = os.path.join(script_tree_folder, "ScriptTree_Mirror").replace("\\", "/")
+    telemetry_db_path = os.path.join(script_tree_folder, "ScriptTree_Telemetry.sqlite").replace("\\", "/")
+
+    user_input_filter_delay = 200  # only used for comma separated filters, fuzzy search runs on every key press
+    fuzzy_result_count = 50
+    max_last_used_scripts = 500
+    search_max_file_size = 2 * 1024 * 1024  # bigger files are skipped when searching
+    tree_backup_keep_count = 20  # newer snapshots stay folders, older ones are compacted into zip archives
+    backup_keep_all_days = 1  # every backup is kept for this long, then one per day
+    backup_keep_daily_days = 30  # then one per month
+    backup_retention_interval = 24 * 60 * 60
+    max_recently_closed_scripts = 20
+    context_menu_entry_count = 10  # entries in the recent runs, history and profiling sub menus
+    session_save_interval = 30  # seconds between saves of the open script tabs, for restoring after a crash
+    settings_path = os.path.join(script_tree_folder, settings_name + ".json").replace("\\", "/")
+    settings_write_delay = 2.0  # changed settings are written together after this many seconds
+    mirror_max_size = 512 * 1024 * 1024  # local copies of scripts in network folders
+    mirror_validate_interval = 2.0  # seconds before a mirrored script is checked against the share again
 
     default_script_content = "import pymel.core as pm"
 
     run_script_on_click = "Run Script on Double-Click"
     edit_script_on_click = "Edit Script on Double-Click"
+    mirror_online = "Read network scripts from the share"
+    mirror_offline = "Work offline (local copies only)"
 
 
-class ScriptEditorSettings(QtCore.QSettings):
+class ScriptEditorSettings(script_tree_settings.SettingsStore):
     k_window_layout = "window/layout"
-    k_folder_path = "script_tree/folder_path"
+    k_folder_path = "script_tree/folder_path"  # first of the folder paths
+    k_folder_paths = "script_tree/folder_paths"
     k_double_click_action = "script_tree/double_click_action"
+    k_last_used_times = "script_tree/last_used_times"
+    k_last_backup_retention_time = "script_tree/last_backup_retention_time"
+    k_remove_legacy_backups = "script_tree/remove_legacy_backups"  # opt in, off unless set in the settings file
+    k_session_tabs = "script_tree/session_tabs"
+    k_recently_closed_scripts = "script_tree/recently_closed_scripts"
+    k_mirror_mode = "script_tree/mirror_mode"
+
+    # growing values get their own file, so the small settings don't rewrite them
+    sidecar_keys = (k_last_used_times, k_session_tabs, k_recently_closed_scripts)
 
     def __init__(self):
         super(ScriptEditorSettings, self).__init__(
+            ScriptTreeConstants.settings_path,
+            sidecar_keys=self.sidecar_keys,
+            write_delay=ScriptTreeConstants.settings_write_delay,
+        )
+        if not self.settings_file.exists() and not self.allKeys():
+            self.migrate_ini_settings()
+
+    def migrate_ini_settings(self):
+        """
+        Copy the values from the QSettings INI file the settings used to live in
+        """
+        ini_settings = QtCore.QSettings(
             QtCore.QSettings.IniFormat,
             QtCore.QSettings.UserScope,
             'ScriptTree',
-            settings_name  # saves in %APPDATA%\ScriptTree\script_tree_maya.ini
+            settings_name  # saved in %APPDATA%\ScriptTree\script_tree_maya.ini
         )
+        ini_keys = ini_settings.allKeys()
+        for key in ini_keys:
+            self.setValue(key, ini_settings.value(key))
+
+        if ini_keys:
+            logging.info("Moved ScriptTree settings from {} to {}".format(ini_settings.fileName(), self.fileName()))
+            self.sync()
+
+
+# write the settings that are still waiting for their delayed write
+atexit.register(script_tree_settings.flush_all)
 
 
 def open_path_in_explorer(file_path):
@@ -164,41 +217,89 @@ def non_specific_hotkey(shortcut, shortcut_seq):
     dcc_actions.eval_deferred(partial(shortcut.setEnabled, 1))  # re-active the shortcut after evaluation has finished
 '''
 
+backup_store = script_tree_backup.BackupStore(ScriptTreeConstants.script_backup_folder)
+backup_writer = script_tree_backup.BackupWriter(backup_store)
+atexit.register(backup_writer.stop)
+
+# scripts in network folders are run, opened and searched from local copies
+script_mirror = script_tree_mirror.ScriptMirror(ScriptTreeConstants.mirror_cache_folder,
+                                                max_size=ScriptTreeConstants.mirror_max_size,
+                                                validate_interval=ScriptTreeConstants.mirror_validate_interval)
+atexit.register(script_mirror.flush)
+
+
 def get_backup_folder_for_script(script_path):
-    file_name, file_extension = os.path.splitext(os.path.basename(script_path))
-    backup_dir = os.path.join(ScriptTreeConstants.script_backup_folder, file_name)
-    return backup_dir
+    return backup_store.get_script_folder(script_path)
+
 
+def backup_script(script_path, content=None):
+    """
+    Queue a backup of script_path on the background backup writer, unchanged content isn't written again
+
+    :param script_path:
+    :param content: bytes to back up, None backs up the file as it is when the writer gets to it
+    """
+    if content is None and not os.path.exists(script_path):
+        return
 
-def backup_script(script_path):
-    if not os.path.exists(script_path):
+    if backup_writer.submit(script_path, content):
         return
 
+    # the writer is stopped or too far behind, write it here instead of dropping the backup
     try:
-        file_name, file_extension = os.path.splitext(os.path.basename(script_path))
+        if content is None:
+            backup_store.backup_file(script_path)
+        else:
+            backup_store.backup_content(script_path, content)
+    except Exception as e:
+        logging.error(e)
 
-        unique_time = str(int(time.time()))
-        backup_file_name = file_name + "_BACKUP_{}".format(unique_time) + file_extension
 
-        backup_file_path = os.path.join(get_backup_folder_for_script(script_path), backup_file_name)
+def get_tree_snapshotter():
+    return script_tree_backup.TreeSnapshotter(ScriptTreeConstants.tree_backup_folder,
+                                              keep_count=ScriptTreeConstants.tree_backup_keep_count)
 
-        if not os.path.exists(os.path.dirname(backup_file_path)):
-            os.makedirs(os.path.dirname(backup_file_path))
 
-        shutil.copy2(script_path, backup_file_path)
+def backup_tree(script_folder, progress_callback=None):
+    """
+    Make an incremental snapshot of script_folder, unchanged files are hardlinked to the previous snapshot
 
-    except Exception as e:
-        logging.error(e)
+    :param script_folder:
+    :param progress_callback: called with (done_count, total_count)
+    :return: TreeSnapshotResult
+    """
+    result = get_tree_snapshotter().create_snapshot(script_folder, progress_callback=progress_callback)
+
+    if result.snapshot_path:
+        logging.info("ScriptTree Network Folder Saved: {} ({} copied, {} unchanged)".format(
+            result.snapshot_path, result.copied_count, result.linked_count))
+    else:
+        logging.error("ScriptTree Network Folder backup incomplete, {} files failed to copy".format(
+            result.failed_count))
+    return result
 
 
-def backup_tree(script_folder):
-    unique_time = str(int(time.time()))
-    backup_directory_name = "ScriptTree_BACKUP_{}".format(unique_time)
-    backup_directory_path = os.path.join(ScriptTreeConstants.tree_backup_folder, backup_directory_name)
+def get_backup_retention_policy():
+    return script_tree_backup.RetentionPolicy(keep_all_days=ScriptTreeConstants.backup_keep_all_days,
+                                              keep_daily_days=ScriptTreeConstants.backup_keep_daily_days)
 
-    copy_directory(script_folder, backup_directory_path)
 
-    logging.info("ScriptTree Network Folder Saved: {}".format(backup_directory_path))
+def apply_backup_retention(now=None, remove_legacy_backups=False):
+    """
+    Thin out old script backups and tree snapshots, and compact older tree snapshots into zip archives
+
+    :param now: epoch time to count backup ages from
+    :param remove_legacy_backups: also thin out the old style <name>_BACKUP_<time> copies
+    :return: RetentionResult of the script backups and tree snapshots combined
+    """
+    policy = get_backup_retention_policy()
+    script_result = backup_store.apply_retention(policy, now=now, remove_legacy_backups=remove_legacy_backups)
+    tree_result = get_tree_snapshotter().apply_retention(policy, now=now)
+
+    result = script_tree_backup.RetentionResult(*[a + b for a, b in zip(script_result, tree_result)])
+    logging.info("ScriptTree backup retention: {} backups removed, {} compacted, {} reclaimed".format(
+        result.removed_count, result.archived_count, script_tree_backup.format_size(result.reclaimed_bytes)))
+    return result
 
 
 def copy_directory(src, dst, symlinks=False, ignore=None):
@@ -0,0 +1,203 @@
+import logging
+import os
+import sys
+import time
+
+from PySide2 import QtCore
+
+NETWORK_FILE_SYSTEMS = ("nfs", "nfs4", "cifs", "smbfs", "smb3", "fuse.sshfs", "afs", "9p")
+
+
+def is_network_path(folder_path):
+    """
+    File system events aren't reliable on network mounts, so those get polled instead
+    """
+    folder_path = folder_path.replace("\\", "/")
+    if folder_path.startswith("//"):
+        return True
+
+    if sys.platform == "win32":
+        try:
+            import ctypes
+            drive = os.path.splitdrive(os.path.abspath(folder_path))[0] + "\\"
+            drive_remote = 4
+            return ctypes.windll.kernel32.GetDriveTypeW(drive) == drive_remote
+        except Exception:
+            return False
+
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/mounts") as fp:
+                mounts = [line.split() for line in fp]
+        except IOError:
+            return False
+
+        # the longest mount point that contains the folder is the one it's on
+        real_path = os.path.realpath(folder_path)
+        best_mount = ("", "")
+        for mount in mounts:
+            if len(mount) < 3:
+                continue
+            mount_point, file_system = mount[1], mount[2]
+            if (real_path == mount_point or real_path.startswith(mount_point.rstrip("/") + "/")) \
+                    and len(mount_point) > len(best_mount[0]):
+                best_mount = (mount_point, file_system)
+        return best_mount[1] in NETWORK_FILE_SYSTEMS
+
+    return False
+
+
+class FolderPollWorkerSignals(QtCore.QObject):
+    finished = QtCore.Signal(dict)  # folder_path: mtime
+
+
+class FolderPollWorker(QtCore.QRunnable):
+    """
+    Reads the modified time of every folder on a QThreadPool thread, so slow network stats never block the UI
+    """
+
+    def __init__(self, folder_paths):
+        super(FolderPollWorker, self).__init__()
+        self.folder_paths = folder_paths
+        self.signals = FolderPollWorkerSignals()
+
+    def run(self):
+        folder_mtimes = {}
+        for folder_path in self.folder_paths:
+            try:
+                folder_mtimes[folder_path] = os.stat(folder_path).st_mtime
+            except OSError:
+                folder_mtimes[folder_path] = None
+        self.signals.finished.emit(folder_mtimes)
+
+
+class ScriptFolderWatcher(QtCore.QObject):
+    """
+    Watches every folder of a script catalog and reports which folders have changed.
+
+    Local folders use QFileSystemWatcher (inotify on Linux, ReadDirectoryChangesW on Windows).
+    Network folders, and any folders past max_watched_folders, are polled by comparing folder modified times.
+    Bursts of events are coalesced into a single folders_changed signal.
+    """
+    folders_changed = QtCore.Signal(list)  # folder paths relative to the root folder
+
+    def __init__(self, parent=None, coalesce_delay=300, max_coalesce_delay=2000, poll_interval=5000,
+                 max_watched_folders=1000):
+        super(ScriptFolderWatcher, self).__init__(parent)
+        self.coalesce_delay = coalesce_delay
+        self.max_coalesce_delay = max_coalesce_delay
+        self.max_watched_folders = max_watched_folders
+
+        self.root_folder = ""
+        self.pending_folders = set()
+        self.first_pending_time = None
+        self.polled_folders = {}  # folder_path: mtime, None until the first poll has finished
+        self.poll_worker = None
+
+        self.fs_watcher = QtCore.QFileSystemWatcher(self)
+        self.fs_watcher.directoryChanged.connect(self._queue_folder)
+
+        self.coalesce_timer = QtCore.QTimer(self)
+        self.coalesce_timer.setSingleShot(True)
+        self.coalesce_timer.timeout.connect(self._emit_pending_folders)
+
+        self.poll_timer = QtCore.QTimer(self)
+        self.poll_timer.setInterval(poll_interval)
+        self.poll_timer.timeout.connect(self._start_poll)
+
+    def watch(self, root_folder, rel_folders):
+        """
+        Start watching root_folder and the given sub folders, replaces whatever was watched before
+
+        :param root_folder:
+        :param rel_folders: folder paths relative to root_folder, "" is the root folder itself
+        """
+        root_folder = root_folder.replace("\\", "/").rstrip("/")
+        folder_paths = [self._get_full_path(root_folder, rel_folder) for rel_folder in rel_folders]
+
+        if root_folder != self.root_folder:
+            self.stop()
+            self.root_folder = root_folder
+
+        if is_network_path(root_folder):
+            watched_paths, polled_paths = [], folder_paths
+        else:
+            watched_paths = folder_paths[:self.max_watched_folders]
+            polled_paths = folder_paths[self.max_watched_folders:]
+
+        current_paths = set(self.fs_watcher.directories())
+        removed_paths = current_paths - set(watched_paths)
+        added_paths = [folder_path for folder_path in watched_paths if folder_path not in current_paths]
+        if removed_paths:
+            self.fs_watcher.removePaths(list(removed_paths))
+        if added_paths:
+            failed_paths = self.fs_watcher.addPaths(added_paths) or []
+            polled_paths.extend(failed_paths)
+
+        # keep the mtimes of folders that were already polled, so changes in between aren't lost
+        self.polled_folders = dict((folder_path, self.polled_folders.get(folder_path)) for folder_path in polled_paths)
+        if self.polled_folders:
+            if not self.poll_timer.isActive():
+                self.poll_timer.start()
+        else:
+            self.poll_timer.stop()
+
+    def stop(self):
+        watched_paths = self.fs_watcher.directories()
+        if watched_paths:
+            self.fs_watcher.removePaths(watched_paths)
+        self.poll_timer.stop()
+        self.coalesce_timer.stop()
+        self.polled_folders = {}
+        self.pending_folders = set()
+        self.first_pending_time = None
+
+    @staticmethod
+    def _get_full_path(root_folder, rel_folder):
+        return root_folder + "/" + rel_folder if rel_folder else root_folder
+
+    def _queue_folder(self, folder_path):
+        self.pending_folders.add(folder_path.replace("\\", "/"))
+
+        now = time.time()
+        if self.first_pending_time is None:
+            self.first_pending_time = now
+
+        # restart the timer on every event, unless events have been coming in for too long already
+        if (now - self.first_pending_time) * 1000 < self.max_coalesce_delay:
+            self.coalesce_timer.start(self.coalesce_delay)
+
+    def _emit_pending_folders(self):
+        rel_folders = []
+        root_prefix = self.root_folder + "/"
+        for folder_path in sorted(self.pending_folders):
+            if folder_path == self.root_folder:
+                rel_folders.append("")
+            elif folder_path.startswith(root_prefix):
+                rel_folders.append(folder_path[len(root_prefix):])
+
+        self.pending_folders = set()
+        self.first_pending_time = None
+
+        if rel_folders:
+            self.folders_changed.emit(rel_folders)
+
+    def _start_poll(self):
+        if self.poll_worker is not None:
+            return  # last poll is still running
+
+        self.poll_worker = FolderPollWorker(list(self.polled_folders))
+        self.poll_worker.signals.finished.connect(self._poll_finished)
+        QtCore.QThreadPool.globalInstance().start(self.poll_worker)
+
+    def _poll_finished(self, folder_mtimes):
+        self.poll_worker = None
+        for folder_path, mtime in folder_mtimes.items():
+            if folder_path not in self.polled_folders:
+                continue  # stopped watching while polling
+
+            previous_mtime = self.polled_folders[folder_path]
+            self.polled_folders[folder_path] = mtime
+            if previous_mtime is not None and previous_mtime != mtime:
+                logging.debug("ScriptTree folder changed: {}".format(folder_path))
+                self._queue_folder(folder_path)
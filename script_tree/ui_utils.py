@@ -22,7 +22,40 @@ QT UTILS BEGIN
 """
 
 
-def get_app_window():
+_app_window = None  # type: QtWidgets.QWidget
+
+# tool windows by window key, so closing the previous instance of a window doesn't need to look at every top level widget
+window_registry = {}  # window key: {id(widget): widget}
+
+
+def get_app_window(refresh=False):
+    """
+    Main window of the dcc, looked up once and cached for as long as the window exists
+
+    :param refresh: look the window up again
+    """
+    global _app_window
+    if _app_window is not None and not refresh and is_widget_valid(_app_window):
+        return _app_window
+
+    _app_window = find_app_window()
+    return _app_window
+
+
+def invalidate_app_window():
+    global _app_window
+    _app_window = None
+
+
+def is_widget_valid(widget):
+    try:
+        from shiboken2 import isValid
+    except ImportError:
+        return True
+    return isValid(widget)
+
+
+def find_app_window():
     top_window = None
     if currently_using_maya:
         try:
@@ -55,16 +88,45 @@ def get_app_window():
     return top_window
 
 
+def get_window_key(widget):
+    # the class as a string, so instances from before a module reload still match
+    return str(widget.__class__)
+
+
+def register_window(widget):
+    """
+    Remember a tool window so delete_window can find it, call after the widget's __init__
+    """
+    key = get_window_key(widget)
+    window_registry.setdefault(key, {})[id(widget)] = widget
+    widget.destroyed.connect(functools.partial(unregister_window, key, id(widget)))
+
+
+def unregister_window(key, widget_id, *args):
+    windows = window_registry.get(key)
+    if windows:
+        windows.pop(widget_id, None)
+
+
 def delete_window(object_to_delete):
     qApp = QtWidgets.QApplication.instance()
     if not qApp:
         return
 
-    for widget in qApp.topLevelWidgets():
-        if "__class__" in dir(widget):
-            if str(widget.__class__) == str(object_to_delete.__class__):
-                widget.deleteLater()
-                widget.close()
+    key = get_window_key(object_to_delete)
+    if key in window_registry:
+        windows = list(window_registry[key].values())
+    else:
+        # first window of this kind since the module was loaded, older ones can only be found by looking
+        windows = [widget for widget in qApp.topLevelWidgets() if get_window_key(widget) == key]
+        window_registry[key] = {}
+
+    for widget in windows:
+        if widget is object_to_delete or not is_widget_valid(widget):
+            continue
+        widget.deleteLater()
+        widget.close()
+    window_registry[key].clear()
 
 
 def load_ui_file(ui_file_name):
@@ -92,9 +154,10 @@ def create_qicon(icon_path):
 
 
 class BaseWindow(QtWidgets.QMainWindow):
-    def __init__(self, parent=get_app_window(), ui_file_name=None):
+    def __init__(self, parent=None, ui_file_name=None):
         delete_window(self)
-        super(BaseWindow, self).__init__(parent)
+        super(BaseWindow, self).__init__(parent or get_app_window())
+        register_window(self)
 
         self.ui = None
         if ui_file_name:
@@ -196,9 +259,10 @@ else:
     class DockableWidget(QtWidgets.QDockWidget):
         docking_object_name = "DockableWidget"
 
-        def __init__(self, parent=get_app_window()):
+        def __init__(self, parent=None):
             delete_window(self)
-            super(DockableWidget, self).__init__(parent=parent)
+            super(DockableWidget, self).__init__(parent=parent or get_app_window())
+            register_window(self)
             # self.setAttribute(QtCore.Qt.WA_DeleteOnClose, True)
             self.setObjectName(self.docking_object_name)  # this one is important
             self.setWindowTitle('MotionBuilder Dockable Widget')
@@ -218,6 +282,29 @@ else:
 
 
 def build_menu_from_action_list(actions, menu=None, is_sub_menu=False):
+    menu = create_menu_from_action_list(actions, menu=menu)
+
+    if not is_sub_menu:
+        cursor = QtGui.QCursor()
+        menu.exec_(cursor.pos())
+
+    return menu
+
+
+def create_menu_from_action_list(actions, menu=None):
+    """
+    Fill a QMenu from an action list without showing it
+
+    Entries of the action list:
+        "-": separator
+        {title: function}: action, a function of None adds a disabled action
+        {title: [action list]}: sub menu
+        {"RADIO_SETTING": {...}}: radio buttons for a QSettings value
+        {"DYNAMIC_MENU": {"title": str, "build_command": function}}: sub menu that is filled
+            with the action list returned by build_command, every time it opens
+
+    :return: QMenu
+    """
     if not menu:
         menu = QtWidgets.QMenu()
 
@@ -235,21 +322,10 @@ def build_menu_from_action_list(actions, menu=None, is_sub_menu=False):
                 default_choice = action_command.get("default")  # type: str
                 on_trigger_command = action_command.get("on_trigger_command")  # function to trigger after setting value
 
-                # Has choice been defined in settings?
-                item_to_check = settings_obj.value(settings_key)
-
-                # If not, read from default option argument
-                if not item_to_check:
-                    item_to_check = default_choice
-
                 grp = QtWidgets.QActionGroup(menu)
                 for choice_key in choices:
                     action = QtWidgets.QAction(choice_key, menu)
                     action.setCheckable(True)
-
-                    if choice_key == item_to_check:
-                        action.setChecked(True)
-
                     action.triggered.connect(functools.partial(set_settings_value,
                                                                settings_obj,
                                                                settings_key,
@@ -259,23 +335,86 @@ def build_menu_from_action_list(actions, menu=None, is_sub_menu=False):
                     grp.addAction(action)
 
                 grp.setExclusive(True)
+
+                # cached menus are shown again and again, the setting may have been changed somewhere else since
+                sync_radio_setting(grp, settings_obj, settings_key, default_choice)
+                menu.aboutToShow.connect(functools.partial(sync_radio_setting,
+                                                           grp,
+                                                           settings_obj,
+                                                           settings_key,
+                                                           default_choice))
+                continue
+
+            if action_title == "DYNAMIC_MENU":
+                sub_menu = menu.addMenu(action_command.get("title"))
+                sub_menu.aboutToShow.connect(functools.partial(fill_dynamic_menu,
+                                                               sub_menu,
+                                                               action_command.get("build_command")))
                 continue
 
             if isinstance(action_command, list):
                 sub_menu = menu.addMenu(action_title)
-                build_menu_from_action_list(action_command, menu=sub_menu, is_sub_menu=True)
+                create_menu_from_action_list(action_command, menu=sub_menu)
                 continue
 
             atn = menu.addAction(action_title)
-            atn.triggered.connect(action_command)
-
-    if not is_sub_menu:
-        cursor = QtGui.QCursor()
-        menu.exec_(cursor.pos())
+            if action_command is None:
+                atn.setEnabled(False)
+            else:
+                atn.triggered.connect(action_command)
 
     return menu
 
 
+def sync_radio_setting(action_group, settings_obj, settings_key, default_choice):
+    """
+    Check the action of the current settings value, or of default_choice if the value hasn't been set
+    """
+    item_to_check = settings_obj.value(settings_key) or default_choice
+    for action in action_group.actions():
+        action.setChecked(action.text() == item_to_check)
+
+
+def fill_dynamic_menu(menu, build_command):
+    menu.clear()
+    actions = build_command()
+    if actions:
+        create_menu_from_action_list(actions, menu=menu)
+    else:
+        menu.addAction("(empty)").setEnabled(False)
+
+
+class CachedMenu(object):
+    """
+    QMenu of an action list that is built once and shown again and again.
+
+    The menu is rebuilt when the action list has changed, or after invalidate().
+    RADIO_SETTING entries check the current settings value every time the menu opens,
+    use DYNAMIC_MENU entries for other content that changes, they're only built when opened.
+    """
+
+    def __init__(self, actions, parent=None):
+        self.actions = actions
+        self.parent = parent
+        self.menu = None  # type: QtWidgets.QMenu
+        self.built_actions = None
+
+    def invalidate(self):
+        if self.menu is not None:
+            self.menu.deleteLater()
+        self.menu = None
+
+    def get_menu(self):
+        if self.menu is None or self.built_actions != self.actions:
+            self.invalidate()
+            self.menu = create_menu_from_action_list(self.actions, menu=QtWidgets.QMenu(self.parent))
+            self.built_actions = list(self.actions)
+        return self.menu
+
+    def exec_(self, pos=None):
+        return self.get_menu().exec_(pos or QtGui.QCursor.pos())
+
+
 def set_settings_value(settings_obj, key, value, post_set_command):
     settings_obj.setValue(key, value)
     post_set_command()